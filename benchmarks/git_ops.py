@@ -0,0 +1,294 @@
+"""
+Time the `marge.git.Repo` operations on synthetic repositories of various shapes.
+
+    python -m benchmarks.git_ops --output before.json
+    python -m benchmarks.git_ops --output after.json
+    python -m benchmarks.git_ops compare before.json after.json
+
+Each scenario generates a bare "remote" repo (with `git fast-import`, so even big ones are quick
+to make) with a long history, many refs, a large tree and/or an MR branch with many commits,
+behind its target branch. We then time cloning it, fetching from it, rebasing and merging the MR
+branch, adding trailers to its commits and pushing it back.
+"""
+import argparse
+import json
+import logging as log
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+from marge.git import Repo
+
+
+MR_BRANCH = 'feature'
+TARGET_BRANCH = 'master'
+OPERATIONS = ('clone', 'fetch', 'rebase', 'merge', 'tag_with_trailer', 'push')
+
+_COMMITTER = 'Bench Mark <bench@example.com>'
+_COMMITTER_ENV = {
+    'GIT_AUTHOR_NAME': 'Bench Mark', 'GIT_AUTHOR_EMAIL': 'bench@example.com',
+    'GIT_COMMITTER_NAME': 'Bench Mark', 'GIT_COMMITTER_EMAIL': 'bench@example.com',
+}
+_EPOCH = 1500000000
+
+
+class Shape(namedtuple('Shape', 'commits files file_size refs mr_commits target_ahead')):
+    """A synthetic repo: `commits` on the target branch, each changing one of `files` files of
+    `file_size` bytes, `refs` other branches and tags, and an MR branch of `mr_commits` commits
+    forking off `target_ahead` commits before the tip of the target branch.
+    """
+    __slots__ = ()
+
+
+SCENARIOS = {
+    'baseline': Shape(commits=200, files=200, file_size=1024, refs=10, mr_commits=5, target_ahead=20),
+    'long-history': Shape(commits=20000, files=200, file_size=1024, refs=10, mr_commits=5, target_ahead=20),
+    'many-refs': Shape(commits=2000, files=200, file_size=1024, refs=10000, mr_commits=5, target_ahead=20),
+    'large-tree': Shape(commits=200, files=50000, file_size=1024, refs=10, mr_commits=5, target_ahead=20),
+    'long-mr': Shape(commits=200, files=200, file_size=1024, refs=10, mr_commits=500, target_ahead=20),
+}
+
+
+class Result(namedtuple('Result', 'scenario operation seconds')):
+    """The `seconds` each repetition of `operation` took in `scenario`."""
+    __slots__ = ()
+
+    def to_dict(self, shape):
+        return {
+            'scenario': self.scenario,
+            'shape': shape._asdict(),
+            'operation': self.operation,
+            'seconds': [round(seconds, 6) for seconds in self.seconds],
+            'min': round(min(self.seconds), 6),
+            'median': round(statistics.median(self.seconds), 6),
+            'max': round(max(self.seconds), 6),
+        }
+
+
+def _fast_import_stream(shape):
+    """Yield the chunks of a `git fast-import` stream creating a repo of `shape`."""
+    content = ('x' * 63 + '\n') * max(1, shape.file_size // 64)
+    fork_point = max(0, shape.commits - shape.target_ahead)
+    timestamp = _EPOCH
+
+    def commit(ref, mark, message, changes, parent=None):
+        nonlocal timestamp
+        timestamp += 60
+        message = message.encode('utf-8')
+        chunks = [
+            'commit {}\nmark :{}\ncommitter {} {} +0000\ndata {}\n'.format(
+                ref, mark, _COMMITTER, timestamp, len(message),
+            ).encode('utf-8'),
+            message, b'\n',
+        ]
+        if parent is not None:
+            chunks.append('from :{}\n'.format(parent).encode('utf-8'))
+        for path, data in changes:
+            data = data.encode('utf-8')
+            chunks.append('M 100644 inline {}\ndata {}\n'.format(path, len(data)).encode('utf-8'))
+            chunks.extend([data, b'\n'])
+        return b''.join(chunks)
+
+    def path_of(number):
+        return 'src/dir-{:03d}/file-{:06d}.txt'.format(number % 1000, number)
+
+    target_ref = 'refs/heads/' + TARGET_BRANCH
+    yield commit(target_ref, 1, 'Initial commit', [
+        (path_of(number), content) for number in range(shape.files)
+    ])
+    for number in range(1, shape.commits):
+        yield commit(target_ref, number + 1, 'Change {}'.format(number), [
+            (path_of(number % shape.files), '{}{}\n'.format(content, number)),
+        ])
+        if number == fork_point:
+            mr_mark = shape.commits + 1
+            for mr_number in range(shape.mr_commits):
+                yield commit(
+                    'refs/heads/' + MR_BRANCH, mr_mark + mr_number, 'MR change {}'.format(mr_number),
+                    [('mr/file-{:06d}.txt'.format(mr_number), '{}{}\n'.format(content, mr_number))],
+                    parent=number + 1 if mr_number == 0 else None,
+                )
+    for number in range(shape.refs):
+        kind = 'tags/v' if number % 2 else 'heads/branch-'
+        yield 'reset refs/{}{}\nfrom :{}\n\n'.format(kind, number, 1 + number % shape.commits).encode('utf-8')
+
+
+def make_remote(path, shape):
+    """Create a bare repo of `shape` at `path`."""
+    subprocess.run(['git', 'init', '--bare', '--quiet', path], check=True)
+    subprocess.run(['git', '-C', path, 'symbolic-ref', 'HEAD', 'refs/heads/' + TARGET_BRANCH], check=True)
+    with subprocess.Popen(['git', '-C', path, 'fast-import', '--quiet'], stdin=subprocess.PIPE) as process:
+        for chunk in _fast_import_stream(shape):
+            process.stdin.write(chunk)
+        process.stdin.close()
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode, 'git fast-import')
+    subprocess.run(['git', '-C', path, 'gc', '--quiet'], check=True)
+
+
+def _advance_remote(remote_path, branch, number):
+    """Add a commit to `branch` of the remote, for the next fetch to get."""
+    with tempfile.TemporaryDirectory(prefix='index-') as index_dir:
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(index_dir, 'index'), **_COMMITTER_ENV)
+
+        def git(*args, stdin=None):
+            return subprocess.run(
+                ['git', '-C', remote_path] + list(args), input=stdin, env=env,
+                stdout=subprocess.PIPE, check=True,
+            ).stdout.decode('ascii').strip()
+
+        parent = git('rev-parse', branch)
+        git('read-tree', parent)
+        blob = git('hash-object', '-w', '--stdin', stdin='fetch {}\n'.format(number).encode('ascii'))
+        git('update-index', '--add', '--cacheinfo', '100644,{},fetched/{}.txt'.format(blob, number))
+        tree = git('write-tree')
+        sha = git('commit-tree', tree, '-p', parent, '-m', 'Fetched change {}'.format(number))
+        git('update-ref', 'refs/heads/' + branch, sha)
+
+
+def _progress(message):
+    sys.stderr.write(message + '\n')
+
+
+def _timed(function, *args, **kwargs):
+    time_0 = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - time_0
+
+
+def run_scenario(name, shape, work_dir, repeat):
+    """Time each of `OPERATIONS` `repeat` times on a repo of `shape`; return the `Result`s."""
+    remote = os.path.join(work_dir, name + '.git')
+    time_0 = time.perf_counter()
+    make_remote(remote, shape)
+    _progress('Generated {} {} in {:.1f}s'.format(name, shape, time.perf_counter() - time_0))
+
+    def new_repo(number):
+        # a file:// url makes git transfer packs as it would over ssh, rather than hardlink the objects
+        local_path = os.path.join(work_dir, '{}-{}'.format(name, number))
+        return Repo('file://' + remote, local_path, ssh_key_file=None, timeout=None, reference=None)
+
+    timings = {operation: [] for operation in OPERATIONS}
+    for number in range(repeat):
+        repo = new_repo(number)
+        timings['clone'].append(_timed(repo.clone))
+        repo.config_user_info(user_name='Marge Bot', user_email='marge-bot@example.com')
+
+        _advance_remote(remote, 'branch-0' if shape.refs else TARGET_BRANCH, number)
+        timings['fetch'].append(_timed(repo.fetch, 'origin'))
+
+        # both fetch, check out the MR branch afresh from origin and fuse it with the target
+        timings['merge'].append(_timed(repo.merge, MR_BRANCH, TARGET_BRANCH))
+        timings['rebase'].append(_timed(repo.rebase, MR_BRANCH, TARGET_BRANCH))
+
+        reviewers = ['A. Reviewer <reviewer@example.com>']
+        timings['tag_with_trailer'].append(_timed(
+            repo.tag_with_trailer, 'Reviewed-by', reviewers, MR_BRANCH, 'origin/' + TARGET_BRANCH,
+        ))
+
+        # a new branch on each repetition, so that there is always something to push
+        push_branch = 'pushed-{}'.format(number)
+        repo.checkout_branch(push_branch, MR_BRANCH)
+        timings['push'].append(_timed(repo.push, push_branch, force=True))
+        shutil.rmtree(repo.local_path)
+
+    shutil.rmtree(remote)
+    return [Result(name, operation, timings[operation]) for operation in OPERATIONS]
+
+
+def _environment():
+    def output(*command):
+        try:
+            return subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+            ).stdout.decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(root, 'version')) as version_file:
+        version = version_file.read().strip()
+    return {
+        'marge_version': version,
+        'marge_commit': output('git', '-C', root, 'rev-parse', 'HEAD'),
+        'git_version': output('git', '--version'),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+    }
+
+
+def compare(old, new):
+    """A table of the median times of the operations in the results `old` and `new`."""
+    def medians(results):
+        return {(result['scenario'], result['operation']): result['median'] for result in results['results']}
+
+    old_medians, new_medians = medians(old), medians(new)
+    lines = ['{:<14}  {:<16}  {:>10}  {:>10}  {:>7}'.format('scenario', 'operation', 'old', 'new', 'change')]
+    for key in sorted(set(old_medians) & set(new_medians)):
+        old_seconds, new_seconds = old_medians[key], new_medians[key]
+        change = (new_seconds - old_seconds) / old_seconds * 100 if old_seconds else 0
+        lines.append('{:<14}  {:<16}  {:>9.3f}s  {:>9.3f}s  {:>+6.1f}%'.format(
+            key[0], key[1], old_seconds, new_seconds, change,
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.git_ops',
+        description=__doc__.strip().split('\n', 1)[0],
+    )
+    parser.add_argument(
+        '--scenario', action='append', choices=sorted(SCENARIOS),
+        help='Scenario to run; repeat for several (default: all of them).',
+    )
+    parser.add_argument('--repeat', type=int, default=3, help='Times to run each operation (default: 3).')
+    parser.add_argument('--output', help='Write the results as JSON to this file instead of stdout.')
+    parser.add_argument('--work-dir', help='Where to generate the repos (default: a temporary directory).')
+    parser.add_argument('--debug', action='store_true', help='Log the git commands.')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    if args and args[0] == 'compare':
+        if len(args) != 3:
+            sys.exit('usage: python -m benchmarks.git_ops compare OLD.json NEW.json')
+        with open(args[1]) as old_file, open(args[2]) as new_file:
+            sys.stdout.write(compare(json.load(old_file), json.load(new_file)))
+        return
+
+    options = _parse_args(args)
+    # marge logs every git command at INFO
+    log.getLogger().setLevel(log.INFO if options.debug else log.WARNING)
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='marge-git-bench-')
+    results = []
+    try:
+        for name in options.scenario or sorted(SCENARIOS):
+            shape = SCENARIOS[name]
+            for result in run_scenario(name, shape, work_dir, options.repeat):
+                median = statistics.median(result.seconds)
+                _progress('{} {}: median {:.3f}s'.format(name, result.operation, median))
+                results.append(result.to_dict(shape))
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(dict(_environment(), results=results), indent=2, sort_keys=True) + '\n'
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,655 @@
+"""
+An offline GitLab, speaking the subset of the REST API marge-bot uses, for benchmarking.
+
+Unlike `tests.gitlab_api_mock.MockLab`, which replays scripted state transitions, this serves
+real HTTP over many projects, each backed by a local bare git repo that marge-bot clones and
+pushes to. Merge requests arrive over time, each one adding a file on its own branch. Pipelines
+start when a branch moves and finish after a while, some of them failing. Every request takes
+a configurable latency.
+
+All durations are in simulated seconds: a `Clock` runs `time_scale` times faster than the wall
+clock, so hours of merging take minutes. Note that work which really takes time (git commands,
+marge-bot's own computations) is then inflated by the same factor.
+"""
+import json
+import logging as log
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlparse
+
+from marge.metrics import endpoint_label
+
+
+BOT_USER = {
+    'id': 1, 'username': 'marge-bot', 'name': 'Marge Bot', 'email': 'marge-bot@example.com',
+    'state': 'active', 'is_admin': False,
+}
+DEVELOPER = {
+    'id': 2, 'username': 'developer', 'name': 'A. Developer', 'email': 'developer@example.com',
+    'state': 'active', 'is_admin': False,
+}
+MAINTAINER_ACCESS = 40
+
+
+class SimConfig(namedtuple('SimConfig', [
+        'projects', 'initial_mrs', 'arrival_rate', 'commits_per_mr', 'ci_duration', 'ci_jitter',
+        'ci_failure_rate', 'latency', 'latency_jitter', 'time_scale', 'seed',
+])):
+    """The simulated GitLab; `arrival_rate` is in MRs per hour, durations in simulated seconds."""
+    __slots__ = ()
+
+    @classmethod
+    def default(cls, **kwargs):
+        defaults = dict(
+            projects=10, initial_mrs=2, arrival_rate=20, commits_per_mr=1, ci_duration=600, ci_jitter=0.25,
+            ci_failure_rate=0.1, latency=0.1, latency_jitter=0.5, time_scale=0.01, seed=None,
+        )
+        defaults.update(kwargs)
+        return cls(**defaults)
+
+
+class Clock:
+    """Simulated time, running `1 / time_scale` times faster than the wall clock."""
+
+    def __init__(self, time_scale):
+        self.time_scale = time_scale
+        self._start = time.time()
+        self._time_0 = time.monotonic()
+
+    def now(self):
+        return self._start + (time.monotonic() - self._time_0) / self.time_scale
+
+    def elapsed(self):
+        return (time.monotonic() - self._time_0) / self.time_scale
+
+    def sleep(self, seconds):
+        threading.Event().wait(max(0, seconds) * self.time_scale)
+
+    def isoformat(self, timestamp=None):
+        when = datetime.fromtimestamp(self.now() if timestamp is None else timestamp, timezone.utc)
+        return when.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class BareRepo:
+    """A bare git repo the simulator writes to with plumbing commands only."""
+
+    AUTHOR_ENV = {
+        'GIT_AUTHOR_NAME': DEVELOPER['name'], 'GIT_AUTHOR_EMAIL': DEVELOPER['email'],
+        'GIT_COMMITTER_NAME': DEVELOPER['name'], 'GIT_COMMITTER_EMAIL': DEVELOPER['email'],
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self._git('init', '--bare', '--quiet', path, in_repo=False)
+        self._git('symbolic-ref', 'HEAD', 'refs/heads/master')
+        # marge-bot pushes batches with `-o ci.skip`
+        self._git('config', 'receive.advertisePushOptions', 'true')
+
+    def _git(self, *args, in_repo=True, stdin=None, env=None):
+        command = ['git', '-C', self.path] + list(args) if in_repo else ['git'] + list(args)
+        full_env = dict(os.environ, **self.AUTHOR_ENV)
+        full_env.update(env or {})
+        result = subprocess.run(
+            command, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=full_env, check=False,
+        )
+        if result.returncode:
+            raise subprocess.CalledProcessError(result.returncode, command, result.stdout, result.stderr)
+        return result.stdout.decode('utf-8').strip()
+
+    def heads(self):
+        output = self._git('for-each-ref', '--format=%(refname:short) %(objectname)', 'refs/heads')
+        return dict(line.split(' ', 1) for line in output.splitlines())
+
+    def add_commits(self, branch, parent, files, message):
+        """Create `branch` from `parent` with one commit per `(path, content)` of `files`."""
+        with tempfile.TemporaryDirectory(prefix='sim-index-') as index_dir:
+            env = {'GIT_INDEX_FILE': os.path.join(index_dir, 'index')}
+            if parent:
+                self._git('read-tree', parent, env=env)
+            sha = parent
+            for number, (path, content) in enumerate(files, start=1):
+                blob = self._git('hash-object', '-w', '--stdin', stdin=content.encode('utf-8'))
+                self._git('update-index', '--add', '--cacheinfo', '100644,{},{}'.format(blob, path), env=env)
+                tree = self._git('write-tree', env=env)
+                parent_args = ['-p', sha] if sha else []
+                title = message if len(files) == 1 else '{} ({}/{})'.format(message, number, len(files))
+                sha = self._git('commit-tree', tree, *parent_args, '-m', title)
+        self._git('update-ref', 'refs/heads/' + branch, sha)
+        return sha
+
+    def is_ancestor(self, ancestor, descendant):
+        try:
+            self._git('merge-base', '--is-ancestor', ancestor, descendant)
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    def update_ref(self, branch, new_sha, old_sha):
+        self._git('update-ref', 'refs/heads/' + branch, new_sha, old_sha)
+
+    def delete_branch(self, branch):
+        self._git('update-ref', '-d', 'refs/heads/' + branch)
+
+    def commit_info(self, sha):
+        fields = self._git('show', '-s', '--format=%H%n%P%n%an%n%ae%n%B', sha).split('\n', 4)
+        sha, parents, author_name, author_email, message = fields + [''] * (5 - len(fields))
+        return {
+            'id': sha, 'short_id': sha[:8], 'title': message.split('\n', 1)[0], 'message': message,
+            'parent_ids': parents.split(), 'author_name': author_name, 'author_email': author_email,
+            'status': None,
+        }
+
+    def commits_between(self, base, head):
+        shas = self._git('rev-list', '{}..{}'.format(base, head)).split()
+        return [self.commit_info(sha) for sha in shas]
+
+
+class Pipeline:
+
+    def __init__(self, pipeline_id, sha, ref, created_at, finishes_at, fails):
+        self.id = pipeline_id
+        self.sha = sha
+        self.ref = ref
+        self.created_at = created_at
+        self.finishes_at = finishes_at
+        self.fails = fails
+        self.canceled = False
+
+    def status(self, now):
+        if self.canceled:
+            return 'canceled'
+        if now < self.finishes_at:
+            return 'running'
+        return 'failed' if self.fails else 'success'
+
+    def info(self, now):
+        return {'id': self.id, 'sha': self.sha, 'ref': self.ref, 'status': self.status(now)}
+
+
+class MergeRequest:
+
+    def __init__(self, project, iid, source_branch, target_branch, title, *, author, assignee, created_at,
+                 labels=()):
+        self.project = project
+        self.iid = iid
+        self.source_branch = source_branch
+        self.target_branch = target_branch
+        self.title = title
+        self.author = author
+        self.assignee = assignee
+        self.created_at = created_at
+        self.labels = list(labels)
+        self.state = 'opened'
+        self.sha = None
+        self.base_sha = None
+        self.merged_at = None
+        self.merge_when_pipeline_succeeds = False
+        self.remove_source_branch = False
+
+    def info(self, clock):
+        project_id = self.project.id
+        return {
+            'id': project_id * 100000 + self.iid, 'iid': self.iid, 'project_id': project_id,
+            'title': self.title, 'state': self.state, 'merge_status': 'can_be_merged',
+            'author': {'id': self.author['id']},
+            'assignee': {'id': self.assignee['id']} if self.assignee else None,
+            'assignees': [{'id': self.assignee['id']}] if self.assignee else [],
+            'source_branch': self.source_branch, 'target_branch': self.target_branch, 'sha': self.sha,
+            'squash': False, 'source_project_id': project_id, 'target_project_id': project_id,
+            'work_in_progress': False,
+            'web_url': '{}/merge_requests/{}'.format(self.project.web_url, self.iid),
+            'blocking_discussions_resolved': True, 'force_remove_source_branch': False,
+            'labels': self.labels, 'created_at': clock.isoformat(self.created_at),
+            'diff_refs': {'base_sha': self.base_sha, 'head_sha': self.sha, 'start_sha': self.base_sha},
+            'rebase_in_progress': False, 'merge_error': None,
+        }
+
+
+class Project:
+
+    def __init__(self, project_id, path_with_namespace, repo):
+        self.id = project_id
+        self.path_with_namespace = path_with_namespace
+        self.repo = repo
+        self.web_url = 'http://gitlab.example.com/' + path_with_namespace
+        self.merge_requests = {}  # iid -> MergeRequest
+        self.pipelines = []
+        self.last_activity_at = None
+
+    def info(self, clock):
+        return {
+            'id': self.id, 'path_with_namespace': self.path_with_namespace, 'name': self.path_with_namespace,
+            'ssh_url_to_repo': self.repo.path, 'http_url_to_repo': self.repo.path, 'web_url': self.web_url,
+            'default_branch': 'master', 'merge_requests_enabled': True, 'archived': False,
+            'only_allow_merge_if_pipeline_succeeds': True,
+            'only_allow_merge_if_all_discussions_are_resolved': False,
+            'approvals_before_merge': 0, 'merge_method': 'ff',
+            'last_activity_at': clock.isoformat(self.last_activity_at),
+            'permissions': {'project_access': {'access_level': MAINTAINER_ACCESS}, 'group_access': None},
+        }
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
+
+
+class GitLabSimulator:
+
+    def __init__(self, config, root_dir):
+        self.config = config
+        self.clock = Clock(config.time_scale)
+        self.requests = Counter()  # (method, endpoint label) -> count
+        self.merged = []  # (project_id, iid, created_at, merged_at)
+        self.notes = Counter()  # (project_id, iid) -> notes
+        self._random = random.Random(config.seed)
+        self._lock = threading.RLock()
+        self._next_pipeline_id = 1
+        self._stopped = threading.Event()
+        self._server = None
+        self.projects = {}
+        for number in range(1, config.projects + 1):
+            path = os.path.join(root_dir, 'project-{}.git'.format(number))
+            project = Project(number, 'group/project-{}'.format(number), BareRepo(path))
+            readme = [('README', 'Project {}\n'.format(number))]
+            project.repo.add_commits('master', None, readme, 'Initial commit')
+            project.last_activity_at = self.clock.now()
+            self.projects[project.id] = project
+            for _ in range(config.initial_mrs):
+                self.open_merge_request(project)
+
+    # MR arrivals
+
+    def open_merge_request(self, project=None):
+        with self._lock:
+            project = project or self._random.choice(list(self.projects.values()))
+            iid = len(project.merge_requests) + 1
+            branch = 'feature-{}'.format(iid)
+            target_sha = project.repo.heads()['master']
+            files = [
+                ('mr-{}/file-{}.txt'.format(iid, number), 'MR {} change {}\n'.format(iid, number))
+                for number in range(1, self.config.commits_per_mr + 1)
+            ]
+            sha = project.repo.add_commits(branch, target_sha, files, 'Change number {}'.format(iid))
+            merge_request = MergeRequest(
+                project, iid, branch, 'master', 'Change number {}'.format(iid),
+                author=DEVELOPER, assignee=BOT_USER, created_at=self.clock.now(),
+            )
+            merge_request.sha, merge_request.base_sha = sha, target_sha
+            project.merge_requests[iid] = merge_request
+            project.last_activity_at = self.clock.now()
+            self._start_pipeline(project, branch, sha)
+            return merge_request
+
+    def _arrivals(self):
+        rate_per_second = self.config.arrival_rate / 3600
+        while not self._stopped.is_set():
+            self.clock.sleep(self._random.expovariate(rate_per_second))
+            if not self._stopped.is_set():
+                self.open_merge_request()
+
+    # pipelines and branch updates
+
+    def _start_pipeline(self, project, ref, sha):
+        now = self.clock.now()
+        jitter = self.config.ci_jitter
+        duration = self.config.ci_duration * self._random.uniform(1 - jitter, 1 + jitter)
+        pipeline = Pipeline(
+            self._next_pipeline_id, sha, ref, created_at=now, finishes_at=now + duration,
+            fails=self._random.random() < self.config.ci_failure_rate,
+        )
+        self._next_pipeline_id += 1
+        project.pipelines.append(pipeline)
+        return pipeline
+
+    def _sync(self, project):
+        """Notice the pushes to the project's branches, as GitLab would on receiving them."""
+        heads = project.repo.heads()
+        now = self.clock.now()
+        for merge_request in project.merge_requests.values():
+            if merge_request.state != 'opened':
+                continue
+            sha = heads.get(merge_request.source_branch)
+            target_sha = heads.get(merge_request.target_branch)
+            if sha is not None and sha != merge_request.sha:
+                merge_request.sha, merge_request.base_sha = sha, target_sha
+                merge_request.merge_when_pipeline_succeeds = False
+                project.last_activity_at = now
+                self._start_pipeline(project, merge_request.source_branch, sha)
+            if sha is not None and target_sha is not None and sha != target_sha and \
+                    project.repo.is_ancestor(sha, target_sha):
+                # pushed straight into the target branch, as batches do
+                self._mark_merged(merge_request)
+            elif merge_request.merge_when_pipeline_succeeds:
+                pipeline = self._pipeline_for(project, merge_request.sha)
+                status = pipeline.status(now) if pipeline else None
+                if status == 'success':
+                    self._merge(merge_request)
+                elif status in ('failed', 'canceled'):
+                    merge_request.merge_when_pipeline_succeeds = False
+
+    def _pipeline_for(self, project, sha):
+        return next((p for p in reversed(project.pipelines) if p.sha == sha), None)
+
+    def _merge(self, merge_request):
+        project = merge_request.project
+        heads = project.repo.heads()
+        target_sha = heads[merge_request.target_branch]
+        if not project.repo.is_ancestor(target_sha, merge_request.sha):
+            raise ApiError(406, 'Branch cannot be merged')  # fast-forward merges only
+        project.repo.update_ref(merge_request.target_branch, merge_request.sha, target_sha)
+        if merge_request.remove_source_branch:
+            project.repo.delete_branch(merge_request.source_branch)
+        self._mark_merged(merge_request)
+
+    def _mark_merged(self, merge_request):
+        merge_request.state = 'merged'
+        merge_request.merged_at = self.clock.now()
+        merge_request.project.last_activity_at = merge_request.merged_at
+        self.merged.append((merge_request.project.id, merge_request.iid, merge_request.created_at,
+                            merge_request.merged_at))
+
+    # the HTTP server
+
+    def start(self, port=0):
+        """Serve the API on `port` (any free one by default) and start MRs arriving; return the API url."""
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keeping connections open lets marge-bot close them, leaving the TIME_WAIT sockets on its
+            # side; when the server closes thousands of them, new connections get reset now and then.
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                simulator.handle(self, 'GET')
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                simulator.handle(self, 'POST')
+
+            def do_PUT(self):  # pylint: disable=invalid-name
+                simulator.handle(self, 'PUT')
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                log.debug('Simulator: ' + format, *args)
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='gitlab-sim', daemon=True).start()
+        if self.config.arrival_rate > 0:
+            threading.Thread(target=self._arrivals, name='gitlab-sim-arrivals', daemon=True).start()
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handle(self, request, method):
+        url = urlparse(request.path)
+        path = unquote(url.path)
+        if not path.startswith('/api/v4/'):
+            return self._respond(request, 404, {'message': '404 Not Found'})
+        path = path[len('/api/v4'):]
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(request.headers.get('Content-Length') or 0)
+        if length:
+            params.update(json.loads(request.rfile.read(length).decode('utf-8')) or {})
+
+        latency = self.config.latency * self._random.uniform(1 - self.config.latency_jitter,
+                                                             1 + self.config.latency_jitter)
+        self.clock.sleep(latency)
+
+        for route_method, pattern, handler in self._routes():
+            match = pattern.match(path)
+            if route_method == method and match:
+                self.requests[(method, endpoint_label(path))] += 1
+                try:
+                    with self._lock:
+                        status, body = handler(request, params, *match.groups())
+                except ApiError as err:
+                    status, body = err.status, {'message': err.message}
+                except Exception as err:  # pylint: disable=broad-except
+                    log.exception('Simulator failed on %s %s', method, path)
+                    status, body = 500, {'message': '500 Internal Server Error: {}'.format(err)}
+                return self._respond(request, status, body)
+        self.requests[(method, 'unknown')] += 1
+        return self._respond(request, 404, {'message': '404 Not Found'})
+
+    @staticmethod
+    def _respond(request, status, body):
+        data = json.dumps(body).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def _routes(self):
+        project = r'/projects/(\d+)'
+        merge_request = project + r'/merge_requests/(\d+)'
+        return [
+            ('GET', re.compile(r'^/version$'), self._get_version),
+            ('GET', re.compile(r'^/user$'), self._get_user),
+            ('GET', re.compile(r'^/users/(\d+)$'), self._get_user_by_id),
+            ('GET', re.compile(r'^/projects$'), self._get_projects),
+            ('GET', re.compile(r'^/merge_requests$'), self._get_all_merge_requests),
+            ('GET', re.compile('^' + project + '$'), self._get_project),
+            ('GET', re.compile('^' + project + r'/merge_requests$'), self._get_merge_requests),
+            ('POST', re.compile('^' + project + r'/merge_requests$'), self._create_merge_request),
+            ('GET', re.compile('^' + merge_request + '$'), self._get_merge_request),
+            ('PUT', re.compile('^' + merge_request + '$'), self._update_merge_request),
+            ('PUT', re.compile('^' + merge_request + r'/merge$'), self._accept_merge_request),
+            ('GET', re.compile('^' + merge_request + r'/approvals$'), self._get_approvals),
+            ('GET', re.compile('^' + merge_request + r'/commits$'), self._get_merge_request_commits),
+            ('GET', re.compile('^' + merge_request + r'/pipelines$'), self._get_merge_request_pipelines),
+            ('GET', re.compile('^' + merge_request + r'/discussions$'), self._get_discussions),
+            ('POST', re.compile('^' + merge_request + r'/notes$'), self._post_note),
+            ('GET', re.compile('^' + project + r'/pipelines$'), self._get_pipelines),
+            ('POST', re.compile('^' + project + r'/pipelines/(\d+)/cancel$'), self._cancel_pipeline),
+            ('GET', re.compile('^' + project + r'/repository/branches/(.+)$'), self._get_branch),
+            ('GET', re.compile('^' + project + r'/repository/commits/([0-9a-f]+)$'), self._get_commit),
+        ]
+
+    def _project(self, project_id):
+        project = self.projects.get(int(project_id))
+        if project is None:
+            raise ApiError(404, '404 Project Not Found')
+        return project
+
+    def _merge_request(self, project_id, iid):
+        project = self._project(project_id)
+        self._sync(project)
+        merge_request = project.merge_requests.get(int(iid))
+        if merge_request is None:
+            raise ApiError(404, '404 Not found')
+        return merge_request
+
+    @staticmethod
+    def _page(items, params):
+        page, per_page = int(params.get('page', 1)), int(params.get('per_page', 20))
+        return 200, items[(page - 1) * per_page:page * per_page]
+
+    def _get_version(self, _request, _params):
+        return 200, {'version': '14.0.0-ee', 'revision': 'simulated'}
+
+    def _get_user(self, request, _params):
+        if request.headers.get('SUDO'):
+            raise ApiError(403, '403 Forbidden - Must be admin to use sudo')
+        return 200, BOT_USER
+
+    def _get_user_by_id(self, _request, _params, user_id):
+        users = {user['id']: user for user in (BOT_USER, DEVELOPER)}
+        if int(user_id) not in users:
+            raise ApiError(404, '404 User Not Found')
+        return 200, users[int(user_id)]
+
+    def _get_projects(self, _request, params):
+        return self._page([project.info(self.clock) for project in self.projects.values()], params)
+
+    def _get_project(self, _request, _params, project_id):
+        return 200, self._project(project_id).info(self.clock)
+
+    def _matching_merge_requests(self, projects, params):
+        merge_requests = []
+        for project in projects:
+            self._sync(project)
+            for merge_request in project.merge_requests.values():
+                if params.get('state') not in (None, merge_request.state):
+                    continue
+                if 'assignee_id' in params and (merge_request.assignee or {}).get('id') != \
+                        int(params['assignee_id']):
+                    continue
+                if 'author_id' in params and merge_request.author['id'] != int(params['author_id']):
+                    continue
+                if params.get('labels') and params['labels'] not in merge_request.labels:
+                    continue
+                if params.get('source_branch') not in (None, merge_request.source_branch):
+                    continue
+                merge_requests.append(merge_request)
+        merge_requests.sort(key=lambda merge_request: merge_request.created_at,
+                            reverse=params.get('sort') == 'desc')
+        return [merge_request.info(self.clock) for merge_request in merge_requests]
+
+    def _get_all_merge_requests(self, _request, params):
+        return self._page(self._matching_merge_requests(self.projects.values(), params), params)
+
+    def _get_merge_requests(self, _request, params, project_id):
+        return self._page(self._matching_merge_requests([self._project(project_id)], params), params)
+
+    def _create_merge_request(self, _request, params, project_id):
+        project = self._project(project_id)
+        heads = project.repo.heads()
+        if params['source_branch'] not in heads:
+            raise ApiError(400, 'Source branch does not exist')
+        iid = len(project.merge_requests) + 1
+        merge_request = MergeRequest(
+            project, iid, params['source_branch'], params['target_branch'], params['title'],
+            author=BOT_USER, assignee=None, created_at=self.clock.now(),
+            labels=[label for label in params.get('labels', '').split(',') if label],
+        )
+        project.merge_requests[iid] = merge_request
+        self._sync(project)
+        return 201, merge_request.info(self.clock)
+
+    def _get_merge_request(self, _request, _params, project_id, iid):
+        return 200, self._merge_request(project_id, iid).info(self.clock)
+
+    def _update_merge_request(self, _request, params, project_id, iid):
+        merge_request = self._merge_request(project_id, iid)
+        if params.get('state_event') == 'close':
+            merge_request.state = 'closed'
+        if 'assignee_id' in params:
+            assignee_id = params['assignee_id']
+            merge_request.assignee = {BOT_USER['id']: BOT_USER, DEVELOPER['id']: DEVELOPER}.get(assignee_id)
+        return 200, merge_request.info(self.clock)
+
+    def _accept_merge_request(self, _request, params, project_id, iid):
+        merge_request = self._merge_request(project_id, iid)
+        if merge_request.state != 'opened':
+            raise ApiError(405, 'Method Not Allowed')
+        if params.get('sha') and params['sha'] != merge_request.sha:
+            raise ApiError(409, 'SHA does not match HEAD of source branch')
+        merge_request.remove_source_branch = bool(params.get('should_remove_source_branch'))
+        pipeline = self._pipeline_for(merge_request.project, merge_request.sha)
+        status = pipeline.status(self.clock.now()) if pipeline else None
+        if status == 'success':
+            self._merge(merge_request)
+        elif status == 'running' and params.get('merge_when_pipeline_succeeds'):
+            merge_request.merge_when_pipeline_succeeds = True
+        else:
+            raise ApiError(405, 'Method Not Allowed')
+        return 200, merge_request.info(self.clock)
+
+    def _get_approvals(self, _request, _params, project_id, iid):
+        merge_request = self._merge_request(project_id, iid)
+        return 200, {
+            'id': merge_request.iid, 'iid': merge_request.iid, 'project_id': merge_request.project.id,
+            'approvals_required': 0, 'approvals_left': 0, 'approved_by': [],
+        }
+
+    def _get_merge_request_commits(self, _request, _params, project_id, iid):
+        merge_request = self._merge_request(project_id, iid)
+        return 200, merge_request.project.repo.commits_between(merge_request.base_sha, merge_request.sha)
+
+    def _get_merge_request_pipelines(self, _request, _params, project_id, iid):
+        merge_request = self._merge_request(project_id, iid)
+        now = self.clock.now()
+        return 200, [
+            pipeline.info(now) for pipeline in reversed(merge_request.project.pipelines)
+            if pipeline.ref == merge_request.source_branch
+        ]
+
+    def _get_discussions(self, _request, _params, project_id, iid):
+        self._merge_request(project_id, iid)
+        return 200, []
+
+    def _post_note(self, _request, params, project_id, iid):
+        merge_request = self._merge_request(project_id, iid)
+        self.notes[(merge_request.project.id, merge_request.iid)] += 1
+        log.info('Note on !%s of %s: %s', merge_request.iid, merge_request.project.path_with_namespace,
+                 params.get('body'))
+        return 201, {'body': params.get('body')}
+
+    def _get_pipelines(self, _request, params, project_id):
+        project = self._project(project_id)
+        self._sync(project)
+        now = self.clock.now()
+        pipelines = [
+            pipeline.info(now) for pipeline in reversed(project.pipelines)
+            if params.get('ref') in (None, pipeline.ref) and
+            params.get('status') in (None, pipeline.status(now))
+        ]
+        return 200, pipelines
+
+    def _cancel_pipeline(self, _request, _params, project_id, pipeline_id):
+        project = self._project(project_id)
+        pipeline = next((p for p in project.pipelines if p.id == int(pipeline_id)), None)
+        if pipeline is None:
+            raise ApiError(404, '404 Not found')
+        if pipeline.status(self.clock.now()) == 'running':
+            pipeline.canceled = True
+        return 200, pipeline.info(self.clock.now())
+
+    def _get_branch(self, _request, _params, project_id, branch):
+        project = self._project(project_id)
+        sha = project.repo.heads().get(branch)
+        if sha is None:
+            raise ApiError(404, '404 Branch Not Found')
+        return 200, {'name': branch, 'protected': branch == 'master', 'commit': project.repo.commit_info(sha)}
+
+    def _get_commit(self, _request, _params, project_id, sha):
+        project = self._project(project_id)
+        try:
+            return 200, project.repo.commit_info(sha)
+        except subprocess.CalledProcessError as err:
+            raise ApiError(404, '404 Commit Not Found') from err
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # marge-bot opens a connection per request
+    request_queue_size = 128
+
+
+def temporary_simulator(config):
+    """A `GitLabSimulator` with its repos in a new temporary directory, and a function to clean up."""
+    root_dir = tempfile.mkdtemp(prefix='gitlab-sim-')
+    simulator = GitLabSimulator(config, root_dir)
+
+    def cleanup():
+        simulator.stop()
+        shutil.rmtree(root_dir, ignore_errors=True)
+
+    return simulator, cleanup
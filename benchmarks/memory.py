@@ -0,0 +1,202 @@
+"""
+Measure the memory a listing of many projects takes, kept as plain and as compact `Project`s.
+
+    python -m benchmarks.memory
+    python -m benchmarks.memory --projects 50000 --json
+
+The projects are generated to look like what GitLab returns from `/projects`, in full and with
+`simple=true` (which is what `ProjectCache` lists), then parsed from JSON as `Api.call` would.
+We measure, with `tracemalloc`, what the `Project`s retain once the parsed listing is dropped.
+"""
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+from collections import namedtuple
+
+from marge.project import Project
+
+LISTINGS = ('full', 'simple')
+MODES = ('plain', 'compact')
+
+
+class Result(namedtuple('Result', 'listing mode projects retained_bytes peak_bytes')):
+    __slots__ = ()
+
+    @property
+    def bytes_per_project(self):
+        return self.retained_bytes / self.projects
+
+    def to_dict(self):
+        return dict(self._asdict(), bytes_per_project=round(self.bytes_per_project))
+
+
+def simple_project_info(project_id):
+    path = 'group-{}/project-{}'.format(project_id % 100, project_id)
+    return {
+        'id': project_id,
+        'description': 'Project number {}'.format(project_id),
+        'name': 'project-{}'.format(project_id),
+        'name_with_namespace': 'Group {} / project-{}'.format(project_id % 100, project_id),
+        'path': 'project-{}'.format(project_id),
+        'path_with_namespace': path,
+        'created_at': '2019-01-01T00:00:00.000Z',
+        'default_branch': 'master',
+        'tag_list': [],
+        'topics': [],
+        'ssh_url_to_repo': 'git@gitlab.example.com:{}.git'.format(path),
+        'http_url_to_repo': 'https://gitlab.example.com/{}.git'.format(path),
+        'web_url': 'https://gitlab.example.com/{}'.format(path),
+        'readme_url': 'https://gitlab.example.com/{}/-/blob/master/README.md'.format(path),
+        'avatar_url': None,
+        'forks_count': 0,
+        'star_count': project_id % 7,
+        'last_activity_at': '2020-06-{:02}T12:00:00.000Z'.format(project_id % 28 + 1),
+        'namespace': {
+            'id': project_id % 100,
+            'name': 'Group {}'.format(project_id % 100),
+            'path': 'group-{}'.format(project_id % 100),
+            'kind': 'group',
+            'full_path': 'group-{}'.format(project_id % 100),
+            'parent_id': None,
+            'avatar_url': None,
+            'web_url': 'https://gitlab.example.com/groups/group-{}'.format(project_id % 100),
+        },
+    }
+
+
+def full_project_info(project_id):
+    info = simple_project_info(project_id)
+    api_url = 'https://gitlab.example.com/api/v4/projects/{}'.format(project_id)
+    info.update({
+        '_links': {
+            'self': api_url,
+            'issues': api_url + '/issues',
+            'merge_requests': api_url + '/merge_requests',
+            'repo_branches': api_url + '/repository/branches',
+            'labels': api_url + '/labels',
+            'events': api_url + '/events',
+            'members': api_url + '/members',
+        },
+        'permissions': {
+            'project_access': {'access_level': 40, 'notification_level': 3},
+            'group_access': None,
+        },
+        'statistics': {
+            'commit_count': project_id % 5000,
+            'storage_size': project_id * 1024,
+            'repository_size': project_id * 512,
+            'wiki_size': 0,
+            'lfs_objects_size': 0,
+            'job_artifacts_size': project_id * 256,
+            'packages_size': 0,
+        },
+        'container_expiration_policy': {
+            'cadence': '1d', 'enabled': False, 'keep_n': 10, 'older_than': '90d',
+            'name_regex': None, 'name_regex_keep': None, 'next_run_at': '2020-06-02T12:00:00.000Z',
+        },
+        'empty_repo': False,
+        'archived': False,
+        'visibility': 'private',
+        'owner': None,
+        'resolve_outdated_diff_discussions': False,
+        'container_registry_enabled': True,
+        'issues_enabled': True,
+        'merge_requests_enabled': True,
+        'wiki_enabled': True,
+        'jobs_enabled': True,
+        'snippets_enabled': False,
+        'service_desk_enabled': False,
+        'can_create_merge_request_in': True,
+        'issues_access_level': 'enabled',
+        'repository_access_level': 'enabled',
+        'merge_requests_access_level': 'enabled',
+        'wiki_access_level': 'enabled',
+        'builds_access_level': 'enabled',
+        'snippets_access_level': 'disabled',
+        'pages_access_level': 'private',
+        'emails_disabled': None,
+        'shared_runners_enabled': True,
+        'lfs_enabled': True,
+        'creator_id': project_id % 50,
+        'import_status': 'none',
+        'open_issues_count': project_id % 30,
+        'ci_default_git_depth': 50,
+        'public_jobs': True,
+        'build_timeout': 3600,
+        'auto_cancel_pending_pipelines': 'enabled',
+        'build_coverage_regex': None,
+        'ci_config_path': None,
+        'shared_with_groups': [],
+        'only_allow_merge_if_pipeline_succeeds': True,
+        'allow_merge_on_skipped_pipeline': None,
+        'request_access_enabled': True,
+        'only_allow_merge_if_all_discussions_are_resolved': False,
+        'remove_source_branch_after_merge': True,
+        'printing_merge_request_link_enabled': True,
+        'merge_method': 'ff',
+        'suggestion_commit_message': None,
+        'auto_devops_enabled': False,
+        'auto_devops_deploy_strategy': 'continuous',
+        'autoclose_referenced_issues': True,
+        'approvals_before_merge': 1,
+        'mirror': False,
+        'compliance_frameworks': [],
+    })
+    return info
+
+
+def measure(listing, mode, count):
+    """Parse a listing of `count` projects and measure what its `Project`s retain."""
+    make_info = full_project_info if listing == 'full' else simple_project_info
+    text = json.dumps([make_info(project_id) for project_id in range(1, count + 1)])
+    make_project = Project.compact if mode == 'compact' else Project
+    gc.collect()
+    tracemalloc.start()
+    try:
+        infos = json.loads(text)
+        projects = [make_project(None, info) for info in infos]
+        del infos
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(projects) == count
+    return Result(listing, mode, count, retained, peak)
+
+
+def _report(results):
+    header = ('listing', 'mode', 'retained', 'peak', 'per project')
+    lines = ['{:<8}  {:<8}  {:>12}  {:>12}  {:>10}'.format(*header)]
+    for result in results:
+        lines.append('{:<8}  {:<8}  {:>10.1f}MB  {:>10.1f}MB  {:>9.0f}B'.format(
+            result.listing, result.mode, result.retained_bytes / 2 ** 20, result.peak_bytes / 2 ** 20,
+            result.bytes_per_project,
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.memory',
+        description=__doc__.strip().split('\n', 1)[0],
+    )
+    parser.add_argument(
+        '--projects', type=int, default=10000, help='Projects in the listing (default: 10000).',
+    )
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = _parse_args(sys.argv[1:] if args is None else args)
+    results = [measure(listing, mode, options.projects) for listing in LISTINGS for mode in MODES]
+    if options.json:
+        sys.stdout.write(json.dumps([result.to_dict() for result in results], indent=2) + '\n')
+    else:
+        sys.stdout.write(_report(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Run the real marge-bot against the GitLab simulator and report its throughput.
+
+    python -m benchmarks.throughput --hours 4 --projects 20 --arrival-rate 30 -- --batch
+
+Arguments after `--` are passed on to marge-bot. The report gives the MRs merged per
+(simulated) hour and the GitLab API calls made per merged MR, overall and per endpoint.
+"""
+import argparse
+import json
+import logging as log
+import os
+import sys
+import threading
+import time
+
+import marge.app
+import marge.batch_job
+import marge.lifecycle
+
+from .gitlab_sim import SimConfig, temporary_simulator
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.throughput',
+        description=__doc__.strip().split('\n', 1)[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    defaults = SimConfig.default()
+    parser.add_argument('--hours', type=float, default=2, help='Simulated hours to run marge-bot for.')
+    parser.add_argument('--projects', type=int, default=defaults.projects, help='Projects to simulate.')
+    parser.add_argument(
+        '--initial-mrs', type=int, default=defaults.initial_mrs,
+        help='MRs waiting in each project when marge-bot starts.',
+    )
+    parser.add_argument(
+        '--arrival-rate', type=float, default=defaults.arrival_rate,
+        help='New MRs per hour, over all projects (Poisson arrivals).',
+    )
+    parser.add_argument(
+        '--commits-per-mr', type=int, default=defaults.commits_per_mr, help='Commits in each MR.',
+    )
+    parser.add_argument(
+        '--ci-duration', type=float, default=defaults.ci_duration, help='Mean seconds a pipeline runs for.',
+    )
+    parser.add_argument(
+        '--ci-jitter', type=float, default=defaults.ci_jitter,
+        help='Pipelines take the mean CI duration, give or take this fraction of it.',
+    )
+    parser.add_argument(
+        '--ci-failure-rate', type=float, default=defaults.ci_failure_rate,
+        help='Fraction of pipelines failing.',
+    )
+    parser.add_argument(
+        '--latency', type=float, default=defaults.latency, help='Mean seconds to answer an API call.',
+    )
+    parser.add_argument(
+        '--latency-jitter', type=float, default=defaults.latency_jitter,
+        help='API calls take the mean latency, give or take this fraction of it.',
+    )
+    parser.add_argument(
+        '--time-scale', type=float, default=defaults.time_scale,
+        help='Wall-clock seconds per simulated second.',
+    )
+    parser.add_argument('--seed', type=int, default=defaults.seed, help='Seed of the random numbers.')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+    parser.add_argument('--debug', action='store_true', help='Log marge-bot\'s debug output.')
+    parser.add_argument('marge_args', nargs='*', help='Extra marge-bot arguments, after `--`.')
+    return parser.parse_args(args)
+
+
+# simulated seconds for marge-bot to finish its current phase once asked to stop
+STOP_TIMEOUT = 3600
+
+
+def run(config, hours, marge_args=(), debug=False):
+    """Run marge-bot against a simulator with `config` for `hours` of simulated time; return the report."""
+    simulator, cleanup = temporary_simulator(config)
+    real_sleep = time.sleep
+    bot_thread = None
+    try:
+        url = simulator.start()
+        # marge-bot sleeps in simulated time too
+        time.sleep = simulator.clock.sleep
+        marge.batch_job.sleep = simulator.clock.sleep
+
+        # marge-bot only takes its secrets from the environment
+        os.environ.update(MARGE_AUTH_TOKEN='simulated', MARGE_SSH_KEY='simulated')
+        args = ['--gitlab-url', url] + (['--debug'] if debug else []) + list(marge_args)
+        bot_thread = threading.Thread(target=marge.app.main, args=(args,), name='marge-bot', daemon=True)
+        bot_thread.start()
+        time_0 = time.monotonic()
+        while simulator.clock.elapsed() < hours * 3600:
+            if not bot_thread.is_alive():
+                raise RuntimeError('marge-bot stopped after {:.0f}s'.format(simulator.clock.elapsed()))
+            simulator.clock.sleep(min(60, hours * 3600 - simulator.clock.elapsed()))
+        wall_seconds = time.monotonic() - time_0
+        return report(simulator, hours, wall_seconds)
+    finally:
+        try:
+            # the simulator has to outlive marge-bot, which polls it until it stops
+            if bot_thread is not None:
+                marge.lifecycle.request_stop()
+                bot_thread.join(STOP_TIMEOUT * config.time_scale)
+                if bot_thread.is_alive():
+                    raise RuntimeError('marge-bot did not stop within {}s'.format(STOP_TIMEOUT))
+        finally:
+            time.sleep = real_sleep
+            marge.batch_job.sleep = real_sleep
+            cleanup()
+
+
+def report(simulator, hours, wall_seconds):
+    merged = len(simulator.merged)
+    api_calls = sum(simulator.requests.values())
+    time_to_merge = sorted(merged_at - created_at for _, _, created_at, merged_at in simulator.merged)
+    open_mrs = sum(
+        1 for project in simulator.projects.values() for merge_request in project.merge_requests.values()
+        if merge_request.state == 'opened'
+    )
+    return {
+        'hours': hours,
+        'wall_seconds': round(wall_seconds, 1),
+        'merged': merged,
+        'merged_per_hour': round(merged / hours, 2),
+        'still_open': open_mrs,
+        'mean_time_to_merge': round(sum(time_to_merge) / merged, 1) if merged else None,
+        'api_calls': api_calls,
+        'api_calls_per_merge': round(api_calls / merged, 1) if merged else None,
+        'api_calls_by_endpoint': {
+            '{} {}'.format(method, pattern): count
+            for (method, pattern), count in simulator.requests.most_common()
+        },
+        'notes': sum(simulator.notes.values()),
+        'config': simulator.config._asdict(),
+    }
+
+
+def format_report(result):
+    lines = [
+        'Simulated {hours}h in {wall_seconds}s'.format(**result),
+        'Merged: {merged} ({merged_per_hour}/h), still open: {still_open}, notes: {notes}'.format(**result),
+        'Mean time to merge: {}s'.format(result['mean_time_to_merge']),
+        'API calls: {api_calls} ({api_calls_per_merge} per merge)'.format(**result),
+    ]
+    width = max((len(endpoint) for endpoint in result['api_calls_by_endpoint']), default=0)
+    for endpoint, count in result['api_calls_by_endpoint'].items():
+        lines.append('  {:<{width}}  {:>7}'.format(endpoint, count, width=width))
+    return '\n'.join(lines) + '\n'
+
+
+def main(args=None):
+    options = _parse_args(sys.argv[1:] if args is None else args)
+    # marge-bot's own logging is set up when importing it; --debug also makes it verbose
+    log.getLogger().setLevel(log.DEBUG if options.debug else log.WARNING)
+    config = SimConfig.default(
+        projects=options.projects,
+        initial_mrs=options.initial_mrs,
+        arrival_rate=options.arrival_rate,
+        commits_per_mr=options.commits_per_mr,
+        ci_duration=options.ci_duration,
+        ci_jitter=options.ci_jitter,
+        ci_failure_rate=options.ci_failure_rate,
+        latency=options.latency,
+        latency_jitter=options.latency_jitter,
+        time_scale=options.time_scale,
+        seed=options.seed,
+    )
+    result = run(config, options.hours, options.marge_args, debug=options.debug)
+    if options.json:
+        sys.stdout.write(json.dumps(result, indent=2, sort_keys=True) + '\n')
+    else:
+        sys.stdout.write(format_report(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+An asyncio flavour of the GitLab client, and a runtime polling GitLab for the jobs.
+
+`AsyncApi` wraps a `gitlab.Api`, sharing its pool of connections, and runs its calls on a
+bounded pool of threads (requests is synchronous), so that coroutines can await any number
+of them at once. The fetches and waits below build on it and return the usual resources,
+bound to the synchronous api.
+
+The jobs themselves stay synchronous. With `--concurrent-projects`, the bot runs a `Runtime`:
+an event loop on a thread of its own, on which the jobs poll GitLab for their CI, their
+`merge_status` and their merge. All the waits of all the jobs then take one thread, and as
+many connections and request threads as there are requests in flight; the thread of a job
+just waits for its poll to end.
+"""
+import asyncio
+import logging as log
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from . import job
+from . import lifecycle
+from . import tracing
+from .merge_request import MergeRequest
+from .pipeline import Pipeline
+from .project import Project
+
+
+class AsyncApi:
+
+    def __init__(self, api, max_concurrent_requests=10):
+        """Wrap `api`, which should have a `gitlab.pooled_session` to share between threads."""
+        self._sync = api
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_requests, thread_name_prefix='gitlab')
+        self._version = None
+
+    @property
+    def sync(self):
+        """The synchronous `gitlab.Api`, sharing our connections."""
+        return self._sync
+
+    async def run(self, fun, *args, **kwargs):
+        """Await `fun(*args, **kwargs)`, run on one of our threads."""
+        parent_span = tracing.current_span()
+
+        def traced_fun():
+            with tracing.attach(parent_span):
+                return fun(*args, **kwargs)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, traced_fun)
+
+    async def call(self, command, sudo=None):
+        return await self.run(self._sync.call, command, sudo=sudo)
+
+    async def collect_all_pages(self, get_command):
+        return await self.run(self._sync.collect_all_pages, get_command)
+
+    async def version(self):
+        if self._version is None:
+            self._version = await self.run(self._sync.version)
+        return self._version
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+async def fetch_project(api, project_id):
+    return await api.run(Project.fetch_by_id, project_id, api.sync)
+
+
+async def fetch_merge_request(api, project_id, merge_request_iid):
+    return await api.run(MergeRequest.fetch_by_iid, project_id, merge_request_iid, api.sync)
+
+
+async def fetch_all_open_for_user(api, project_id, user, merge_order='created_at'):
+    return await api.run(
+        MergeRequest.fetch_all_open_for_user,
+        project_id=project_id, user=user, api=api.sync, merge_order=merge_order,
+    )
+
+
+async def fetch_approvals(api, merge_request):
+    return await api.run(merge_request.fetch_approvals)
+
+
+async def get_mr_ci_status(api, merge_request, commit_sha=None):
+    """Like `MergeJob.get_mr_ci_status`."""
+    if (await api.version()).release >= (10, 5, 0):
+        pipelines = await api.run(
+            Pipeline.pipelines_by_merge_request, merge_request.target_project_id, merge_request.iid, api.sync,
+        )
+    else:
+        pipelines = await api.run(
+            Pipeline.pipelines_by_branch,
+            merge_request.source_project_id, merge_request.source_branch, api.sync,
+        )
+    return job.pipeline_status(pipelines, merge_request, commit_sha or merge_request.sha)
+
+
+async def wait_for_ci_to_pass(api, merge_request, commit_sha=None, *, timeout, waiting_time_in_secs=10):
+    """Like `MergeJob.wait_for_ci_to_pass`, raising `CannotMerge` if CI fails or takes over `timeout`."""
+    time_0 = datetime.utcnow()
+    while datetime.utcnow() - time_0 < timeout:
+        lifecycle.check()
+        ci_status = await get_mr_ci_status(api, merge_request, commit_sha)
+        if job.ci_passed(merge_request, ci_status):
+            return
+        log.debug('Waiting for %s secs before polling CI status again', waiting_time_in_secs)
+        await asyncio.sleep(waiting_time_in_secs)
+    raise job.CannotMerge('CI is taking too long.')
+
+
+async def wait_for_merge_status_to_resolve(api, merge_request, attempts=3, waiting_time_in_secs=5):
+    """Like `MergeJob.wait_for_merge_status_to_resolve`, refetching `merge_request` in place."""
+    for attempt in range(attempts):
+        lifecycle.check()
+        await api.run(merge_request.refetch_info)
+        if job.merge_status_resolved(merge_request, attempt):
+            return
+        await asyncio.sleep(waiting_time_in_secs)
+
+
+async def wait_for_branch_to_be_merged(api, merge_request, *, timeout, waiting_time_in_secs=10):
+    """Like `SingleMergeJob.wait_for_branch_to_be_merged`, refetching `merge_request` in place."""
+    time_0 = datetime.utcnow()
+    while datetime.utcnow() - time_0 < timeout:
+        lifecycle.check()
+        await api.run(merge_request.refetch_info)
+        if job.merged(merge_request):
+            return
+        log.info('Giving %s more secs for !%s to be merged...', waiting_time_in_secs, merge_request.iid)
+        await asyncio.sleep(waiting_time_in_secs)
+    raise job.CannotMerge('It is taking too long to see the request marked as merged!')
+
+
+class Runtime:
+    """An event loop on a thread of its own, on which the synchronous jobs run their waits.
+
+    It starts and stops with the bot, like its other background services.
+    """
+
+    def __init__(self, api, max_concurrent_requests):
+        self.api = AsyncApi(api, max_concurrent_requests)
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop.run_forever, name='aio-runtime', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop and close the loop; the jobs are done, and their waits with them."""
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._loop.close()
+        self.api.close()
+
+    def run(self, coroutine):
+        """Run `coroutine` on the loop, from another thread, and return its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def wait_for_ci_to_pass(self, merge_request, commit_sha, *, timeout, waiting_time_in_secs):
+        self.run(wait_for_ci_to_pass(
+            self.api, merge_request, commit_sha, timeout=timeout, waiting_time_in_secs=waiting_time_in_secs,
+        ))
+
+    def wait_for_merge_status_to_resolve(self, merge_request, *, attempts, waiting_time_in_secs):
+        self.run(wait_for_merge_status_to_resolve(
+            self.api, merge_request, attempts=attempts, waiting_time_in_secs=waiting_time_in_secs,
+        ))
+
+    def wait_for_branch_to_be_merged(self, merge_request, *, timeout, waiting_time_in_secs):
+        self.run(wait_for_branch_to_be_merged(
+            self.api, merge_request, timeout=timeout, waiting_time_in_secs=waiting_time_in_secs,
+        ))
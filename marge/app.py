@@ -4,9 +4,12 @@ An auto-merger of merge requests for GitLab
 
 import contextlib
 import logging
+import os
 import re
+import socket
 import sys
 import tempfile
+import time
 from datetime import timedelta
 
 import configargparse
@@ -14,6 +17,12 @@ import configargparse
 from . import bot
 from . import interval
 from . import gitlab
+from . import http_log
+from . import job
+from . import latency
+from . import metrics
+from . import profiling
+from . import tracing
 from . import user as user_module
 
 
@@ -32,7 +41,17 @@ def time_interval(str_interval):
         ) from err
 
 
-def _parse_config(args):  # pylint: disable=too-many-statements
+def disk_size(str_size):
+    try:
+        quant, unit = re.match(r'\A([\d.]+) ?([KMGT]?)B?\Z', str_size, re.IGNORECASE).groups()
+        return int(float(quant) * 1024 ** ' KMGT'.index(unit.upper() or ' '))
+    except (AttributeError, ValueError) as err:
+        raise configargparse.ArgumentTypeError(
+                'Invalid disk size (e.g. 500M, 10G): %s' % str_size
+        ) from err
+
+
+def _parse_config(args):  # pylint: disable=too-many-statements,too-many-branches
 
     def regexp(str_regex):
         try:
@@ -40,6 +59,12 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         except re.error as err:
             raise configargparse.ArgumentTypeError('Invalid regexp: %r (%s)' % (str_regex, err.msg))
 
+    def sample_rates(str_rates):
+        try:
+            return http_log.parse_sample_rates(str_rates)
+        except ValueError as err:
+            raise configargparse.ArgumentTypeError('Invalid sample rates: %s' % err) from err
+
     parser = configargparse.ArgParser(
         auto_env_var_prefix='MARGE_',
         ignore_unknown_config_file_keys=True,  # Don't parse unknown args
@@ -137,6 +162,164 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         action='store_true',
         help='Enable processing MRs in batches\n',
     )
+    parser.add_argument(
+        '--batch-adaptive-size',
+        action='store_true',
+        help=(
+            'Size batches from the recent failure rates and CI times of batches for the same target branch,\n'
+            'to maximize the number of MRs merged per hour of CI.\n'
+        ),
+    )
+    parser.add_argument(
+        '--batch-max-size',
+        type=int,
+        default=None,
+        help='Maximum number of MRs in a batch.\n',
+    )
+    parser.add_argument(
+        '--batch-history-file',
+        type=str,
+        default=None,
+        metavar='FILE',
+        help='File in which to keep the outcomes of past batches, so they survive restarts.\n',
+    )
+    parser.add_argument(
+        '--job-state-file',
+        type=str,
+        default=None,
+        metavar='FILE',
+        help=(
+            'SQLite database in which to record the branches I pushed and am waiting on CI for,\n'
+            'so I can pick up where I left off after a restart instead of pushing them again.\n'
+        ),
+    )
+    parser.add_argument(
+        '--latency-file',
+        type=str,
+        default=None,
+        metavar='FILE',
+        help=(
+            'SQLite database in which to record how long each MR queued and spent in each phase of its job.\n'
+            'See `marge.app latency-report`.\n'
+        ),
+    )
+    parser.add_argument(
+        '--latency-max-age',
+        type=time_interval,
+        default='2160h',
+        help='How long to keep the history in --latency-file for.\n',
+    )
+    parser.add_argument(
+        '--concurrent-projects',
+        type=int,
+        default=1,
+        metavar='N',
+        help=(
+            'Work on up to N projects at once, e.g. waiting for CI on several of them.\n'
+            'Jobs on the same project still go one at a time.\n'
+        ),
+    )
+    parser.add_argument(
+        '--git-workers',
+        type=int,
+        default=0,
+        metavar='N',
+        help=(
+            'Run up to N git operations at once in the background, one at a time per repo, and clone\n'
+            'new repos there while going on with the other projects. 0 runs them in the jobs.\n'
+        ),
+    )
+    parser.add_argument(
+        '--prewarm',
+        action='store_true',
+        help=(
+            'Clone the repos of the projects likely to get merge requests ahead of time, and fetch\n'
+            'them every --prewarm-refresh-interval, on the --git-workers pool.\n'
+        ),
+    )
+    parser.add_argument(
+        '--prewarm-projects',
+        type=regexp,
+        default=None,
+        metavar='REGEXP',
+        help='With --prewarm, the projects to keep warm first, active or not.\n',
+    )
+    parser.add_argument(
+        '--prewarm-active-within',
+        type=time_interval,
+        default='1h',
+        help='With --prewarm, also keep warm the projects active within this interval, most recent first.\n',
+    )
+    parser.add_argument(
+        '--prewarm-concurrency',
+        type=int,
+        default=2,
+        metavar='N',
+        help='With --prewarm, clone or fetch up to N repos ahead of time at once.\n',
+    )
+    parser.add_argument(
+        '--prewarm-disk-budget',
+        type=disk_size,
+        default='10G',
+        metavar='SIZE',
+        help=(
+            'With --prewarm, stop cloning ahead of time once the repos cloned so take up SIZE,\n'
+            'and remove those of the projects no longer likely to get merge requests.\n'
+        ),
+    )
+    parser.add_argument(
+        '--prewarm-refresh-interval',
+        type=time_interval,
+        default='10min',
+        help='With --prewarm, how often to fetch the repos kept warm.\n',
+    )
+    parser.add_argument(
+        '--shard-file',
+        type=str,
+        default=None,
+        metavar='FILE',
+        help=(
+            'SQLite database shared by several instances running as the same user, which then split\n'
+            'the projects between them. It must be on a filesystem they all can lock, e.g. a local one.\n'
+        ),
+    )
+    parser.add_argument(
+        '--shard-id',
+        type=str,
+        default='{}:{}'.format(socket.gethostname(), os.getpid()),
+        metavar='ID',
+        help='The name of this instance in --shard-file and --lock-dir. Defaults to hostname:pid.\n',
+    )
+    parser.add_argument(
+        '--shard-ttl',
+        type=time_interval,
+        default='2min',
+        help='How long an instance can go without heartbeating before the others take over its projects.\n',
+    )
+    parser.add_argument(
+        '--lock-dir',
+        type=str,
+        default=None,
+        metavar='DIR',
+        help=(
+            'Directory shared by several instances, in which each takes a lease on a project before\n'
+            'working on it, so that they never push to the same project at once.\n'
+        ),
+    )
+    parser.add_argument(
+        '--lease-ttl',
+        type=time_interval,
+        default='5min',
+        help='How long a lease outlives the instance holding it, if it stops renewing it.\n',
+    )
+    parser.add_argument(
+        '--use-graphql',
+        action='store_true',
+        help=(
+            'Check all batch candidates with a single GraphQL query, instead of several\n'
+            'REST requests per merge request. Needs GitLab 14.0+.\n'
+        ),
+    )
     parser.add_argument(
         '--add-part-of',
         action='store_true',
@@ -147,6 +330,19 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         action='store_true',
         help='Add "Reviewed-by: $approver" for each approver of MR to each commit in MR.\n',
     )
+    parser.add_argument(
+        '--user-cache-ttl',
+        type=time_interval,
+        default='1h',
+        help='How long to remember the names and emails of approvers for --add-reviewers.\n',
+    )
+    parser.add_argument(
+        '--user-cache-file',
+        type=str,
+        default=None,
+        metavar='FILE',
+        help='File in which to keep the approvers looked up for --add-reviewers, so they survive restarts.\n',
+    )
     parser.add_argument(
         '--impersonate-approvers',
         action='store_true',
@@ -175,6 +371,59 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         default='.*',
         help="Only process projects that match; e.g. 'some_group/.*' or '(?!exclude/me)'.\n",
     )
+    parser.add_argument(
+        '--project-refresh-interval',
+        type=time_interval,
+        default='10min',
+        help=(
+            'How often to list all my projects. In between, only the projects active since\n'
+            'the previous cycle are listed again.\n'
+        ),
+    )
+    parser.add_argument(
+        '--skip-idle-projects',
+        action='store_true',
+        help=(
+            'Only fetch the merge requests of projects which have some assigned to me, or\n'
+            'have been active since I last looked, except for a full sweep every --full-sweep-interval.\n'
+        ),
+    )
+    parser.add_argument(
+        '--full-sweep-interval',
+        type=time_interval,
+        default='10min',
+        help='How often to look at all projects with --skip-idle-projects.\n',
+    )
+    parser.add_argument(
+        '--priority-scheduling',
+        action='store_true',
+        help=(
+            'Fetch the merge requests of all projects first, then work on the most urgent ones first:\n'
+            'those with a --priority-labels label, then those targeting a --priority-branch-regexp branch,\n'
+            'then the others. Ties go to the ones waiting the longest and to projects with shorter jobs.\n'
+        ),
+    )
+    parser.add_argument(
+        '--priority-labels',
+        type=lambda labels: [label.strip() for label in labels.split(',') if label.strip()],
+        default='',
+        metavar='LABEL[,LABEL...]',
+        help='Comma-separated labels of urgent merge requests, e.g. "hotfix,security".\n',
+    )
+    parser.add_argument(
+        '--priority-branch-regexp',
+        type=regexp,
+        default=None,
+        help='Merge requests targeting a branch that matches go before other unlabelled ones.\n',
+    )
+    parser.add_argument(
+        '--priority-aging',
+        type=time_interval,
+        default='1h',
+        help=(
+            'How long a merge request has to wait to move up a priority class, so none starve.\n'
+        ),
+    )
     parser.add_argument(
         '--ci-timeout',
         type=time_interval,
@@ -216,6 +465,57 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         action='store_true',
         help='Debug logging (includes all HTTP requests etc).\n',
     )
+    parser.add_argument(
+        '--debug-http-body-size',
+        type=int,
+        default=1024,
+        metavar='BYTES',
+        help='With --debug, log at most BYTES of each HTTP request and response body; 0 logs none.\n',
+    )
+    parser.add_argument(
+        '--debug-http-sample',
+        type=sample_rates,
+        default='',
+        metavar='ENDPOINT=RATE[,ENDPOINT=RATE...]',
+        help=(
+            'With --debug, only log the response bodies of a fraction of the requests to ENDPOINT,\n'
+            'e.g. "/projects/:id/merge_requests=0.1,*=0.5"; "*" is for the other endpoints.\n'
+            'Error responses are always logged.\n'
+        ),
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=None,
+        metavar='PORT',
+        help='Serve Prometheus metrics on http://<host>:PORT/metrics.\n',
+    )
+    parser.add_argument(
+        '--profile-dir',
+        type=str,
+        default=tempfile.gettempdir(),
+        metavar='DIR',
+        help='Where to write the profiles started and stopped with SIGUSR2.\n',
+    )
+    parser.add_argument(
+        '--profile-format',
+        default=profiling.COLLAPSED,
+        choices=profiling.FORMATS,
+        help='Format of the profiles: collapsed stacks (for flamegraph.pl) or speedscope.\n',
+    )
+    parser.add_argument(
+        '--profile-duration',
+        type=time_interval,
+        default='1min',
+        help='How long a profile started with SIGUSR2 lasts at most.\n',
+    )
+    parser.add_argument(
+        '--trace-file',
+        type=str,
+        default=None,
+        metavar='FILE',
+        help='Append tracing spans of the jobs, GitLab API calls and git commands to FILE, as JSON lines.\n',
+    )
     parser.add_argument(
         '--use-no-ff-batches',
         action='store_true',
@@ -237,6 +537,23 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         action='store_true',
         help='Run marge-bot as a single CLI command, not a service'
     )
+    parser.add_argument(
+        '--reuse-pipelines',
+        action='store_true',
+        help=(
+            'Merge without updating a merge request which already contains the head of its target branch\n'
+            'and has a successful pipeline, rather than rewriting it and waiting for CI again.\n'
+            'Not compatible with the options that add trailers, nor with --guarantee-final-pipeline.\n'
+        ),
+    )
+    parser.add_argument(
+        '--reuse-merge-result-pipelines',
+        action='store_true',
+        help=(
+            'With --reuse-pipelines, in projects using merge commits, also merge without updating a merge\n'
+            'request if a successful merged results pipeline tested it on the head of its target branch.\n'
+        ),
+    )
     parser.add_argument(
         '--guarantee-final-pipeline',
         action='store_true',
@@ -247,6 +564,18 @@ def _parse_config(args):  # pylint: disable=too-many-statements
 
     if config.use_merge_strategy and config.batch:
         raise MargeBotCliArgError('--use-merge-strategy and --batch are currently mutually exclusive')
+    if config.reuse_merge_result_pipelines and not config.reuse_pipelines:
+        raise MargeBotCliArgError('--reuse-merge-result-pipelines needs --reuse-pipelines')
+    if config.batch_max_size is not None and config.batch_max_size < 2:
+        raise MargeBotCliArgError('--batch-max-size must be at least 2')
+    if config.concurrent_projects < 1:
+        raise MargeBotCliArgError('--concurrent-projects must be at least 1')
+    if config.git_workers < 0:
+        raise MargeBotCliArgError('--git-workers must be at least 0')
+    if config.prewarm and not config.git_workers:
+        raise MargeBotCliArgError('--prewarm needs --git-workers')
+    if config.prewarm_concurrency < 1:
+        raise MargeBotCliArgError('--prewarm-concurrency must be at least 1')
     if config.use_merge_strategy and config.add_tested:
         raise MargeBotCliArgError('--use-merge-strategy and --add-tested are currently mutually exclusive')
     if config.rebase_remotely:
@@ -259,6 +588,16 @@ def _parse_config(args):  # pylint: disable=too-many-statements
         for flag in conflicting_flag:
             if getattr(config, flag[2:].replace("-", "_")):
                 raise MargeBotCliArgError('--rebase-remotely and %s are mutually exclusive' % flag)
+    if config.reuse_pipelines:
+        conflicting_flag = [
+            '--add-tested',
+            '--add-reviewers',
+            '--add-part-of',
+            '--guarantee-final-pipeline',
+        ]
+        for flag in conflicting_flag:
+            if getattr(config, flag[2:].replace("-", "_")):
+                raise MargeBotCliArgError('--reuse-pipelines and %s are mutually exclusive' % flag)
 
     cli_args = []
     # pylint: disable=protected-access
@@ -287,20 +626,75 @@ def _secret_auth_token_and_ssh_key(options):
                 tmp_ssh_key_file.close()
 
 
+def latency_report(args, out=sys.stdout):
+    parser = configargparse.ArgParser(
+        prog='marge.app latency-report',
+        auto_env_var_prefix='MARGE_',
+        formatter_class=configargparse.ArgumentDefaultsRawHelpFormatter,
+        description='Percentiles of the time merge requests spent queued and in each phase of their jobs.',
+    )
+    parser.add_argument(
+        '--latency-file',
+        type=str,
+        required=True,
+        metavar='FILE',
+        help='The database recorded by marge-bot with --latency-file.\n',
+    )
+    parser.add_argument(
+        '--since',
+        type=time_interval,
+        default=None,
+        help='Only count the jobs which finished in this last interval (e.g. 168h).\n',
+    )
+    parser.add_argument(
+        '--outcome',
+        type=str,
+        default=latency.MERGED,
+        help="Only count the jobs with this outcome (e.g. 'cannot merge', or 'ci_failed' for batches).\n",
+    )
+    options = parser.parse_args(args)
+
+    since = time.time() - options.since.total_seconds() if options.since is not None else None
+    store = latency.LatencyStore(options.latency_file)
+    try:
+        out.write(latency.report(store, since=since, outcome=options.outcome))
+    finally:
+        store.close()
+
+
+def _make_api(options, auth_token):
+    if options.concurrent_projects == 1:
+        return gitlab.Api(options.gitlab_url, auth_token)
+    # each job makes up to MAX_CONCURRENT_REQUESTS requests at once
+    pool_size = options.concurrent_projects * job.MergeJob.MAX_CONCURRENT_REQUESTS
+    return gitlab.Api(options.gitlab_url, auth_token, session=gitlab.pooled_session(pool_size))
+
+
+SUBCOMMANDS = {'latency-report': latency_report}
+
+
 def main(args=None):
     if args is None:
         args = sys.argv[1:]
+    if args and args[0] in SUBCOMMANDS:
+        SUBCOMMANDS[args[0]](args[1:])
+    else:
+        _run_bot(args)
+
+
+def _run_bot(args):
     logging.basicConfig()
 
     options = _parse_config(args)
 
     if options.debug:
         logging.getLogger().setLevel(logging.DEBUG)
+        http_log.configure(max_body_size=options.debug_http_body_size, sample_rates=options.debug_http_sample)
     else:
         logging.getLogger("requests").setLevel(logging.WARNING)
 
     with _secret_auth_token_and_ssh_key(options) as (auth_token, ssh_key_file):
-        api = gitlab.Api(options.gitlab_url, auth_token)
+        api = _make_api(options, auth_token)
         user = user_module.User.myself(api)
         if options.max_ci_time_in_minutes:
             logging.warning(
@@ -312,6 +706,12 @@ def main(args=None):
         if options.batch:
             logging.warning('Experimental batch mode enabled')
 
+        if options.use_graphql and api.version().release < (14, 0):
+            raise Exception(
+                "Need GitLab 14.0+ to use GraphQL, "
+                "but your instance is {}".format(api.version())
+            )
+
         if options.use_merge_strategy:
             fusion = bot.Fusion.merge
         elif options.rebase_remotely:
@@ -349,10 +749,51 @@ def main(args=None):
                 use_merge_commit_batches=options.use_merge_commit_batches,
                 skip_ci_batches=options.skip_ci_batches,
                 guarantee_final_pipeline=options.guarantee_final_pipeline,
+                use_graphql=options.use_graphql,
+                reuse_pipelines=options.reuse_pipelines,
+                reuse_merge_result_pipelines=options.reuse_merge_result_pipelines,
             ),
             batch=options.batch,
             cli=options.cli,
+            batch_adaptive_size=options.batch_adaptive_size,
+            batch_max_size=options.batch_max_size,
+            batch_history_file=options.batch_history_file,
+            job_state_file=options.job_state_file,
+            latency_file=options.latency_file,
+            latency_max_age=options.latency_max_age,
+            concurrent_projects=options.concurrent_projects,
+            git_workers=options.git_workers,
+            prewarm=options.prewarm,
+            prewarm_projects=options.prewarm_projects,
+            prewarm_active_within=options.prewarm_active_within,
+            prewarm_concurrency=options.prewarm_concurrency,
+            prewarm_disk_budget=options.prewarm_disk_budget,
+            prewarm_refresh_interval=options.prewarm_refresh_interval,
+            shard_file=options.shard_file,
+            shard_id=options.shard_id,
+            shard_ttl=options.shard_ttl,
+            lock_dir=options.lock_dir,
+            lease_ttl=options.lease_ttl,
+            user_cache_ttl=options.user_cache_ttl,
+            user_cache_file=options.user_cache_file,
+            project_refresh_interval=options.project_refresh_interval,
+            skip_idle_projects=options.skip_idle_projects,
+            full_sweep_interval=options.full_sweep_interval,
+            priority_scheduling=options.priority_scheduling,
+            priority_labels=options.priority_labels,
+            priority_branch_regexp=options.priority_branch_regexp,
+            priority_aging=options.priority_aging,
+        )
+
+        if options.metrics_port is not None:
+            metrics.start_http_server(options.metrics_port)
+        profiling.configure(
+            duration=options.profile_duration.total_seconds(),
+            output_dir=options.profile_dir,
+            output_format=options.profile_format,
         )
+        if options.trace_file:
+            tracing.configure(tracing.JsonLinesExporter(options.trace_file))
 
         marge_bot = bot.Bot(api=api, config=config)
         marge_bot.start()
@@ -1,10 +1,18 @@
 # pylint: disable=too-many-branches,too-many-statements,arguments-differ
+import hashlib
 import logging as log
+import time
+from collections import namedtuple
+from datetime import datetime
 from time import sleep
 
 from . import git
 from . import gitlab
+from . import graphql
+from . import metrics
+from . import tracing
 from .commit import Commit
+from .concurrency import map_concurrently
 from .job import MergeJob, CannotMerge, SkipMerge
 from .merge_request import MergeRequest
 from .pipeline import Pipeline
@@ -17,18 +25,54 @@ class CannotBatch(Exception):
 class BatchMergeJob(MergeJob):
     BATCH_BRANCH_NAME = 'marge_bot_batch_merge_job'
 
-    def __init__(self, *, api, user, project, repo, options, merge_requests):
-        super().__init__(api=api, user=user, project=project, repo=repo, options=options)
+    def __init__(
+            self, *, api, user, project, repo, options, merge_requests,
+            batch_sizer=None, services=None,
+    ):
+        super().__init__(api=api, user=user, project=project, repo=repo, options=options, services=services)
         self._merge_requests = merge_requests
+        self._batch_sizer = batch_sizer
+        self._settled_branches = set()  # the target branches whose batch we merged, or gave up on
+        self._ci_phases = {}  # target branch -> the (name, started_at, seconds) of the wait for its CI
+
+    def status(self):
+        return dict(super().status(), merge_requests=[mr.iid for mr in self._merge_requests])
+
+    @property
+    def unbatched_merge_requests(self):
+        """The merge requests of the target branches we have not settled, to be merged on their own.
+
+        These are the branches we could not batch (e.g. only one of their MRs was ready), or whose
+        batch failed its CI.
+        """
+        return [
+            merge_request for merge_request in self._merge_requests
+            if merge_request.target_branch not in self._settled_branches
+        ]
 
-    def remove_batch_branch(self):
-        log.info('Removing local batch branch')
+    @classmethod
+    def batch_branch_name(cls, target_branch):
+        """Each target branch gets its own batch branch, so their batches can run side by side.
+
+        Slashes are escaped, as `..._release` and `..._release/1.0` can't both be refs, with a
+        hash of the target branch so that `release/1.0` and `release-1.0` still get different names.
+        """
+        if '/' not in target_branch:
+            return '{}_{}'.format(cls.BATCH_BRANCH_NAME, target_branch)
+        return '{}_{}_{}'.format(
+            cls.BATCH_BRANCH_NAME,
+            target_branch.replace('/', '-'),
+            hashlib.sha1(target_branch.encode()).hexdigest()[:8],
+        )
+
+    def remove_batch_branch(self, target_branch):
+        log.info('Removing local batch branch for %s', target_branch)
         try:
-            self._repo.remove_branch(BatchMergeJob.BATCH_BRANCH_NAME)
+            self._repo.remove_branch(self.batch_branch_name(target_branch))
         except git.GitError:
             pass
 
-    def close_batch_mr(self):
+    def close_batch_mr(self, keep_iids=()):
         log.info('Closing batch MRs')
         params = {
             'author_id': self._user.id,
@@ -43,14 +87,16 @@ class BatchMergeJob(MergeJob):
             params=params,
         )
         for batch_mr in batch_mrs:
+            if batch_mr.iid in keep_iids:
+                continue
             log.info('Closing batch MR !%s', batch_mr.iid)
             batch_mr.close()
 
     def create_batch_mr(self, target_branch):
-        self.push_batch()
-        log.info('Creating batch MR')
+        self.push_batch(target_branch)
+        log.info('Creating batch MR for %s', target_branch)
         params = {
-            'source_branch': BatchMergeJob.BATCH_BRANCH_NAME,
+            'source_branch': self.batch_branch_name(target_branch),
             'target_branch': target_branch,
             'title': 'Marge Bot Batch MR - DO NOT TOUCH',
             'labels': BatchMergeJob.BATCH_BRANCH_NAME,
@@ -70,23 +116,37 @@ class BatchMergeJob(MergeJob):
             if merge_request.target_branch == target_branch
         ]
 
-    def ensure_mergeable_mr(self, merge_request, skip_ci=False):
-        super().ensure_mergeable_mr(merge_request)
+    def ensure_mergeable_mr(self, merge_request, prefetched=None, *, skip_ci=False):
+        super().ensure_mergeable_mr(merge_request, prefetched=prefetched)
 
         if self._project.only_allow_merge_if_pipeline_succeeds and not skip_ci:
-            ci_status = self.get_mr_ci_status(merge_request)
+            head_pipeline = prefetched.head_pipeline if prefetched is not None else None
+            if head_pipeline is not None and head_pipeline['sha'] == merge_request.sha:
+                ci_status = head_pipeline['status']
+            else:
+                ci_status = self.get_mr_ci_status(merge_request)
             if ci_status != 'success':
                 raise CannotBatch('This MR has not passed CI.')
 
     def get_mergeable_mrs(self, merge_requests):
         log.info('Filtering mergeable MRs')
-        mergeable_mrs = []
-        for merge_request in merge_requests:
+        prefetched = self.prefetch_merge_request_states(merge_requests)
+
+        def check_mergeable(merge_request):
             try:
-                self.ensure_mergeable_mr(merge_request)
-            except (CannotBatch, SkipMerge) as ex:
+                self.ensure_mergeable_mr(merge_request, prefetched=prefetched.get(merge_request.iid))
+            except (CannotBatch, CannotMerge) as ex:
+                return ex
+            return None
+
+        # The checks are only reads, so do them concurrently; act on their outcome in order afterwards
+        errors = map_concurrently(check_mergeable, merge_requests, max_workers=self.MAX_CONCURRENT_REQUESTS)
+
+        mergeable_mrs = []
+        for merge_request, ex in zip(merge_requests, errors):
+            if isinstance(ex, (CannotBatch, SkipMerge)):
                 log.warning('Skipping unbatchable MR: "%s"', ex)
-            except CannotMerge as ex:
+            elif isinstance(ex, CannotMerge):
                 log.warning('Skipping unmergeable MR: "%s"', ex)
                 self.unassign_from_mr(merge_request)
                 merge_request.comment("I couldn't merge this branch: {}".format(ex))
@@ -94,9 +154,22 @@ class BatchMergeJob(MergeJob):
                 mergeable_mrs.append(merge_request)
         return mergeable_mrs
 
-    def push_batch(self):
-        log.info('Pushing batch branch')
-        self._repo.push(BatchMergeJob.BATCH_BRANCH_NAME, force=True)
+    def prefetch_merge_request_states(self, merge_requests):
+        """Fetch the state of all `merge_requests` in one GraphQL query, if enabled; `{iid: state}`."""
+        if not self._options.use_graphql:
+            return {}
+        try:
+            return graphql.fetch_merge_request_states(
+                self._api, self._project, [merge_request.iid for merge_request in merge_requests],
+            )
+        except gitlab.ApiError as err:
+            log.warning('Failed to fetch MR states through GraphQL, falling back to REST: %s', err)
+            return {}
+
+    def push_batch(self, target_branch):
+        log.info('Pushing batch branch for %s', target_branch)
+        self.ensure_lease()
+        self._repo.push(self.batch_branch_name(target_branch), force=True)
 
     def ensure_mr_not_changed(self, merge_request):
         log.info('Ensuring MR !%s did not change', merge_request.iid)
@@ -179,6 +252,7 @@ class BatchMergeJob(MergeJob):
             self._options.use_no_ff_batches,
         )
         # Don't force push in case the remote has changed.
+        self.ensure_lease()
         self._repo.push(merge_request.target_branch, force=False)
 
         sleep(2)
@@ -197,20 +271,189 @@ class BatchMergeJob(MergeJob):
 
         return final_sha
 
+    def _record_batch_outcome(self, target_branch, merge_requests, success, ci_start):
+        if self._batch_sizer is not None:
+            self._batch_sizer.record(
+                self._project.id,
+                target_branch,
+                size=len(merge_requests),
+                success=success,
+                ci_seconds=(datetime.utcnow() - ci_start).total_seconds(),
+            )
+
+    def get_target_branches(self):
+        target_branches = []
+        for merge_request in self._merge_requests:
+            if merge_request.target_branch not in target_branches:
+                target_branches.append(merge_request.target_branch)
+        return target_branches
+
     def execute(self):
+        with tracing.span(
+                'BatchMergeJob.execute',
+                project=self._project.path_with_namespace,
+                iids=','.join(str(merge_request.iid) for merge_request in self._merge_requests),
+        ):
+            self._execute()
+
+    def _execute(self):
+        started_at = time.time()
+        resumed_batches = {}
+        for target_branch in self.get_target_branches():
+            batch = self.resume_batch(target_branch)
+            if batch is not None:
+                resumed_batches[target_branch] = batch
+
         # Cleanup previous batch work
-        self.remove_batch_branch()
-        self.close_batch_mr()
+        self.close_batch_mr(keep_iids={batch.batch_mr.iid for batch in resumed_batches.values()})
+
+        # Assemble one batch per target branch. This needs the local repo, so it is sequential.
+        # The branches we can't batch are left for the caller to merge on their own.
+        batches = []
+        unbatched = []
+        # target branch -> when we started on its batch, and the phases of the job it went through
+        timelines = {}
+        for target_branch in self.get_target_branches():
+            if target_branch in resumed_batches:
+                batches.append(resumed_batches[target_branch])
+                timelines[target_branch] = started_at, []
+                continue
+            batch_started_at, log_start = time.time(), len(self._phase_log)
+            self.remove_batch_branch(target_branch)
+            try:
+                batch = self.prepare_batch(target_branch)
+            except CannotBatch as err:
+                log.warning('Not batching MRs targeting %s: %s', target_branch, err)
+                unbatched.append(err)
+            else:
+                self.record_batch(batch)
+                batches.append(batch)
+                timelines[target_branch] = batch_started_at, self._phase_log[log_start:]
+
+        if not batches:
+            raise unbatched[0] if unbatched else CannotBatch('not enough ready merge requests')
+
+        # CI of the batches runs concurrently, so target branches don't wait on each other
+        ci_errors = self.wait_for_batches_ci(batches)
+        errors = []
 
-        target_branch = self._merge_requests[0].target_branch
+        for batch, ci_error in zip(batches, ci_errors):
+            metrics.BATCH_SIZE.observe(len(batch.merge_requests))
+            outcome = 'merged' if ci_error is None else 'ci_failed'
+            log_start = len(self._phase_log)
+            try:
+                if ci_error is not None:
+                    self.report_batch_ci_failure(batch, ci_error)
+                with tracing.span('batch accept', **self._batch_span_attributes(batch)), self.phase('accept'):
+                    self.accept_batch(batch)
+            except CannotBatch as err:
+                # its MRs are left for the caller to merge on their own, as with those we didn't batch
+                unbatched.append(err)
+                if ci_error is None:
+                    outcome = 'failed'
+            except CannotMerge as err:
+                errors.append(err)
+                self._settled_branches.add(batch.target_branch)
+                if ci_error is None:
+                    outcome = 'failed'
+            else:
+                self._settled_branches.add(batch.target_branch)
+                for merge_request in batch.merge_requests:
+                    self.record_time_to_merge(merge_request)
+            metrics.BATCHES.inc(outcome=outcome)
+            # only the phases of this batch, not those of the batches of other target branches
+            batch_started_at, phases = timelines[batch.target_branch]
+            ci_phase = self._ci_phases.get(batch.target_branch)
+            phases = phases + ([ci_phase] if ci_phase else []) + self._phase_log[log_start:]
+            self.record_latency(batch.merge_requests, outcome, batch_started_at, phases)
+            self.forget_batch(batch)
+
+        if errors or unbatched:
+            # Let the caller know about the first problem once every batch has had its go
+            raise (errors or unbatched)[0]
+
+    def resume_batch(self, target_branch):
+        """Return our recorded batch for `target_branch` if it can still be merged as it was pushed."""
+        if self._services.job_state is None:
+            return None
+        state = self._services.job_state.batch_state(self._project.id, target_branch)
+        if state is None:
+            return None
+
+        merge_requests_by_iid = {merge_request.iid: merge_request for merge_request in self._merge_requests}
+        merge_requests = [merge_requests_by_iid.get(iid) for iid, _ in state.members]
+        unchanged = all(
+            merge_request is not None and merge_request.sha == sha
+            for merge_request, (_, sha) in zip(merge_requests, state.members)
+        )
+        batch_mr = None
+        if unchanged:
+            try:
+                batch_mr = MergeRequest.fetch_by_iid(self._project.id, state.batch_mr_iid, self._api)
+            except gitlab.NotFound:
+                pass
+        if batch_mr is not None and batch_mr.state == 'opened' and batch_mr.sha == state.batch_sha:
+            target_sha = Commit.last_on_branch(self._project.id, target_branch, self._api).id
+            if target_sha == state.target_sha:
+                log.info('Resuming batch MR !%s for %s', batch_mr.iid, target_branch)
+                # accepting merges into the local <target_branch>, so set it up as assembling would have
+                self._repo.fetch('origin')
+                self._repo.checkout_branch(target_branch, 'origin/%s' % target_branch)
+                return Batch(
+                    target_branch=target_branch,
+                    batch_mr=batch_mr,
+                    batch_mr_sha=state.batch_sha,
+                    merge_requests=merge_requests,
+                    remote_target_branch_sha=state.target_sha,
+                )
+
+        log.info('Batch MR !%s for %s changed since we pushed it', state.batch_mr_iid, target_branch)
+        self._services.job_state.forget_batch(self._project.id, target_branch)
+        return None
+
+    def record_batch(self, batch):
+        if self._services.job_state is not None:
+            self._services.job_state.record_batch(
+                self._project.id,
+                batch.target_branch,
+                batch_mr_iid=batch.batch_mr.iid,
+                batch_sha=batch.batch_mr_sha,
+                target_sha=batch.remote_target_branch_sha,
+                members=[(merge_request.iid, merge_request.sha) for merge_request in batch.merge_requests],
+            )
+
+    def forget_batch(self, batch):
+        if self._services.job_state is not None:
+            self._services.job_state.forget_batch(self._project.id, batch.target_branch)
+
+    def prepare_batch(self, target_branch):
+        """Build the batch branch and MR for `target_branch` and return the resulting `Batch`."""
         merge_requests = self.get_mrs_with_common_target_branch(target_branch)
-        merge_requests = self.get_mergeable_mrs(merge_requests)
+        with self.phase('prechecks'):
+            merge_requests = self.get_mergeable_mrs(merge_requests)
 
         if len(merge_requests) <= 1:
             # Either no merge requests are ready to be merged, or there's only one for this target branch.
             # Let's raise an error to do a basic job for these cases.
             raise CannotBatch('not enough ready merge requests')
 
+        if self._batch_sizer is not None:
+            batch_size = self._batch_sizer.batch_size(self._project.id, target_branch, len(merge_requests))
+            merge_requests = merge_requests[:batch_size]
+
+        with self.phase('resolve source projects'):
+            self.resolve_source_projects(merge_requests)
+
+        with self.phase('assembly'):
+            batch = self._assemble_batch(target_branch, merge_requests)
+        log.info('Batch for %s assembled; time spent so far: %s', target_branch, ', '.join(
+            '{} {:.2f}s'.format(name, seconds) for name, seconds in self.phase_timings.items()
+        ))
+        return batch
+
+    def _assemble_batch(self, target_branch, merge_requests):
+        batch_branch = self.batch_branch_name(target_branch)
+
         self._repo.fetch('origin')
 
         # Save the sha of remote <target_branch> so we can use it to make sure
@@ -218,7 +461,7 @@ class BatchMergeJob(MergeJob):
         remote_target_branch_sha = self._repo.get_commit_hash('origin/%s' % target_branch)
 
         self._repo.checkout_branch(target_branch, 'origin/%s' % target_branch)
-        self._repo.checkout_branch(BatchMergeJob.BATCH_BRANCH_NAME, 'origin/%s' % target_branch)
+        self._repo.checkout_branch(batch_branch, 'origin/%s' % target_branch)
 
         batch_mr = self.create_batch_mr(
             target_branch=target_branch,
@@ -226,10 +469,17 @@ class BatchMergeJob(MergeJob):
         batch_mr_sha = batch_mr.sha
 
         working_merge_requests = []
+        fetched_source_repo_url = None
 
         for merge_request in merge_requests:
             try:
-                _, source_repo_url, merge_request_remote = self.fetch_source_project(merge_request)
+                _, source_repo_url, merge_request_remote = self.fetch_source_project(
+                    merge_request, fetch=False,
+                )
+                # MRs from the same fork share the "source" remote, so fetch it only when the fork changes
+                if source_repo_url is not None and source_repo_url != fetched_source_repo_url:
+                    self._repo.fetch(remote_name=merge_request_remote, remote_url=source_repo_url)
+                    fetched_source_repo_url = source_repo_url
                 self._repo.checkout_branch(
                     merge_request.source_branch,
                     '%s/%s' % (merge_request_remote, merge_request.source_branch),
@@ -243,7 +493,7 @@ class BatchMergeJob(MergeJob):
                     )
                     # Update <batch> branch with MR changes
                     batch_mr_sha = self._repo.merge(
-                        BatchMergeJob.BATCH_BRANCH_NAME,
+                        batch_branch,
                         merge_request.source_branch,
                         '-m',
                         'Batch merge !%s into %s (!%s)' % (
@@ -257,13 +507,13 @@ class BatchMergeJob(MergeJob):
                     # Update <source_branch> on latest <batch> branch so it contains previous MRs
                     self.fuse(
                         merge_request.source_branch,
-                        BatchMergeJob.BATCH_BRANCH_NAME,
+                        batch_branch,
                         source_repo_url=source_repo_url,
                         local=True,
                     )
                     # Update <batch> branch with MR changes
                     batch_mr_sha = self._repo.fast_forward(
-                        BatchMergeJob.BATCH_BRANCH_NAME,
+                        batch_branch,
                         merge_request.source_branch,
                         local=True,
                     )
@@ -286,29 +536,68 @@ class BatchMergeJob(MergeJob):
             raise CannotBatch('not enough ready merge requests')
 
         # This switches git to <batch> branch
-        self.push_batch()
+        self.push_batch(target_branch)
         for merge_request in working_merge_requests:
             merge_request.comment('I will attempt to batch this MR (!{})...'.format(batch_mr.iid))
 
-        # wait for the CI of the batch MR
-        if self._project.only_allow_merge_if_pipeline_succeeds:
+        return Batch(
+            target_branch=target_branch,
+            batch_mr=batch_mr,
+            batch_mr_sha=batch_mr_sha,
+            merge_requests=working_merge_requests,
+            remote_target_branch_sha=remote_target_branch_sha,
+        )
+
+    def wait_for_batches_ci(self, batches):
+        """Wait for the CI of all `batches` at once; return the `CannotMerge` error of each, if any."""
+        if not self._project.only_allow_merge_if_pipeline_succeeds:
+            return [None] * len(batches)
+
+        def wait_for_batch_ci(batch):
+            ci_start = datetime.utcnow()
+            started_at, time_0 = time.time(), time.monotonic()
             try:
-                self.wait_for_ci_to_pass(batch_mr, commit_sha=batch_mr_sha)
+                with tracing.span('batch ci', **self._batch_span_attributes(batch)):
+                    self.wait_for_ci_to_pass(batch.batch_mr, commit_sha=batch.batch_mr_sha)
             except CannotMerge as err:
-                for merge_request in working_merge_requests:
-                    merge_request.comment(
-                        'Batch MR !{batch_mr_iid} failed: {error} I will retry later...'.format(
-                            batch_mr_iid=batch_mr.iid,
-                            error=err.reason,
-                        ),
-                    )
-                raise CannotBatch(err.reason) from err
+                self._record_batch_outcome(batch.target_branch, batch.merge_requests, False, ci_start)
+                return err
+            finally:
+                self._ci_phases[batch.target_branch] = ('ci', started_at, time.monotonic() - time_0)
+            self._record_batch_outcome(batch.target_branch, batch.merge_requests, True, ci_start)
+            return None
+
+        with self.phase('ci'):
+            return map_concurrently(wait_for_batch_ci, batches, max_workers=len(batches))
+
+    @staticmethod
+    def _batch_span_attributes(batch):
+        return {
+            'target_branch': batch.target_branch,
+            'batch_mr_iid': batch.batch_mr.iid,
+            'sha': batch.batch_mr_sha,
+            'iids': ','.join(str(merge_request.iid) for merge_request in batch.merge_requests),
+        }
+
+    def report_batch_ci_failure(self, batch, err):
+        for merge_request in batch.merge_requests:
+            merge_request.comment(
+                'Batch MR !{batch_mr_iid} failed: {error} I will retry later...'.format(
+                    batch_mr_iid=batch.batch_mr.iid,
+                    error=err.reason,
+                ),
+            )
+        raise CannotBatch(err.reason) from err
+
+    def accept_batch(self, batch):
+        batch_mr = batch.batch_mr
+        remote_target_branch_sha = batch.remote_target_branch_sha
 
         # check each sub MR, and accept each sub MR if using the normal batch
-        for merge_request in working_merge_requests:
+        for merge_request in batch.merge_requests:
             try:
-                # FIXME: this should probably be part of the merge request
-                _, source_repo_url, merge_request_remote = self.fetch_source_project(merge_request)
+                # No need to fetch the fork here: accept_mr fetches it again before fusing
+                _, source_repo_url, _ = self.fetch_source_project(merge_request, fetch=False)
                 self.ensure_mr_not_changed(merge_request)
                 # we know the batch MR's CI passed, so we skip CI for sub MRs this time
                 self.ensure_mergeable_mr(merge_request, skip_ci=True)
@@ -339,19 +628,25 @@ class BatchMergeJob(MergeJob):
         if self._options.use_merge_commit_batches:
             # Approve the batch MR using the last sub MR's approvers
             if not batch_mr.fetch_approvals().sufficient:
-                approvals = working_merge_requests[-1].fetch_approvals()
+                approvals = batch.merge_requests[-1].fetch_approvals()
                 try:
                     approvals.approve(batch_mr)
                 except (gitlab.Forbidden, gitlab.Unauthorized):
                     log.exception('Failed to approve MR:')
 
+            self.ensure_lease()
             try:
                 ret = batch_mr.accept(
                     remove_branch=batch_mr.force_remove_source_branch,
-                    sha=batch_mr_sha,
+                    sha=batch.batch_mr_sha,
                     merge_when_pipeline_succeeds=bool(self._project.only_allow_merge_if_pipeline_succeeds),
                 )
                 log.info('batch_mr.accept result: %s', ret)
             except gitlab.ApiError as err:
                 log.exception('Gitlab API Error:')
                 raise CannotMerge('Gitlab API Error: %s' % err) from err
+
+
+class Batch(namedtuple('Batch',
+                       'target_branch batch_mr batch_mr_sha merge_requests remote_target_branch_sha')):
+    __slots__ = ()
@@ -0,0 +1,181 @@
+import logging as log
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+
+from . import json_file
+from . import metrics
+
+
+class BatchOutcome(namedtuple('BatchOutcome', 'size success ci_seconds timestamp')):
+    __slots__ = ()
+
+
+class BatchSizer:
+    """Picks how many MRs to put in a batch, per project and target branch.
+
+    Every batch outcome is recorded. From that history we estimate the probability `q`
+    that a single MR passes CI, assuming a batch of `n` MRs passes with probability `q**n`.
+    A batch of size `n` is then expected to merge `n * q**n` MRs per CI run. CI may take longer
+    for bigger batches, so we also fit the CI time of a batch to `a + b * n` from the history,
+    and pick the `n` that maximizes the MRs merged per hour of CI, `n * q**n / (a + b * n)`.
+    """
+
+    # Resolution of the grid we use to find the maximum likelihood estimate of `q`
+    _ESTIMATE_STEPS = 1000
+
+    def __init__(self, *, adaptive=True, min_size=2, max_size=None, history_size=50, history_file=None):
+        assert min_size >= 2, min_size
+        assert max_size is None or max_size >= min_size, (min_size, max_size)
+        self._adaptive = adaptive
+        self._min_size = min_size
+        self._max_size = max_size
+        self._history_size = history_size
+        self._history_file = history_file
+        self._history = {}
+        self._lock = threading.Lock()
+        if history_file is not None and os.path.exists(history_file):
+            self._load()
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    def batch_size(self, project_id, target_branch, candidates):
+        """Return how many of `candidates` mergeable MRs should go in the next batch."""
+        upper_bound = candidates if self._max_size is None else min(candidates, self._max_size)
+        if not self._adaptive or upper_bound <= self._min_size:
+            return upper_bound
+
+        outcomes = self._outcomes(project_id, target_branch)
+        pass_rate = _estimate_pass_rate(outcomes, self._ESTIMATE_STEPS)
+        size = self._optimal_size(outcomes, pass_rate, upper_bound)
+        labels = {'project_id': project_id, 'target_branch': target_branch}
+        metrics.BATCH_TARGET_SIZE.set(size, **labels)
+        if pass_rate is not None:
+            metrics.BATCH_MR_PASS_RATE.set(pass_rate, **labels)
+        if log.getLogger().isEnabledFor(log.INFO):
+            log.info(
+                'Batch size for project %s, branch %s: %s out of %s candidates (%s)',
+                project_id, target_branch, size, candidates, _format_stats(self._stats(outcomes, pass_rate)),
+            )
+        return size
+
+    def record(self, project_id, target_branch, size, success, ci_seconds=None):
+        outcome = BatchOutcome(size=size, success=success, ci_seconds=ci_seconds, timestamp=time.time())
+        log.info(
+            'Batch of %s MRs for project %s, branch %s %s',
+            size, project_id, target_branch, 'passed' if success else 'failed',
+        )
+        with self._lock:
+            outcomes = self._history.setdefault(_key(project_id, target_branch), [])
+            outcomes.append(outcome)
+            del outcomes[:-self._history_size]
+            if self._history_file is not None:
+                json_file.save(self._history_file, self._history)
+
+    def stats(self, project_id, target_branch):
+        outcomes = self._outcomes(project_id, target_branch)
+        return self._stats(outcomes, _estimate_pass_rate(outcomes, self._ESTIMATE_STEPS))
+
+    def _stats(self, outcomes, mr_pass_rate):
+        ci_seconds = [outcome.ci_seconds for outcome in outcomes if outcome.ci_seconds]
+        size = self._optimal_size(outcomes, mr_pass_rate, self._max_size)
+        mean_ci_seconds = sum(ci_seconds) / len(ci_seconds) if ci_seconds else None
+        ci_seconds_of = _fit_ci_seconds(outcomes)
+        return {
+            'batches': len(outcomes),
+            'failed_batches': sum(1 for outcome in outcomes if not outcome.success),
+            'mean_size': sum(outcome.size for outcome in outcomes) / len(outcomes) if outcomes else None,
+            'mr_pass_rate': mr_pass_rate,
+            'mean_ci_seconds': mean_ci_seconds,
+            'optimal_size': size,
+            'merged_per_ci_hour': (
+                _expected_merged(size, mr_pass_rate) * 3600 / ci_seconds_of(size)
+                if mean_ci_seconds and size is not None else None
+            ),
+        }
+
+    def _outcomes(self, project_id, target_branch):
+        with self._lock:
+            return list(self._history.get(_key(project_id, target_branch), []))
+
+    def _optimal_size(self, outcomes, pass_rate, upper_bound):
+        """Return the batch size maximizing expected merges per CI hour; `None` if unbounded."""
+        if not outcomes or all(outcome.success for outcome in outcomes):
+            return upper_bound
+        # n * q**n peaks at n = -1 / ln(q), and CI doesn't get faster with more MRs: past that
+        # peak the merges per CI hour only go down, so the sizes up to it are all we check
+        largest = max(math.ceil(-1 / math.log(pass_rate)), self._min_size)
+        if upper_bound is not None:
+            largest = min(largest, upper_bound)
+        ci_seconds_of = _fit_ci_seconds(outcomes)
+        return max(
+            range(self._min_size, largest + 1),
+            key=lambda size: _expected_merged(size, pass_rate) / ci_seconds_of(size),
+        )
+
+    def _load(self):
+        history = json_file.load(self._history_file, 'batch history')
+        if history is None:
+            return
+        self._history = {
+            key: [BatchOutcome(*outcome) for outcome in outcomes][-self._history_size:]
+            for key, outcomes in history.items()
+        }
+
+
+def _key(project_id, target_branch):
+    return '{}:{}'.format(project_id, target_branch)
+
+
+def _format_stats(stats):
+    return ', '.join(
+        '{}={}'.format(name, round(value, 3) if isinstance(value, float) else value)
+        for name, value in sorted(stats.items())
+    )
+
+
+def _expected_merged(size, pass_rate):
+    return size * pass_rate ** size
+
+
+def _fit_ci_seconds(outcomes):
+    """Least squares fit of the CI time of a batch to its size; return it as a function of the size.
+
+    Without CI times for at least two sizes, it is taken to be the same for all sizes.
+    """
+    timed = [(outcome.size, outcome.ci_seconds) for outcome in outcomes if outcome.ci_seconds]
+    if not timed:
+        return lambda size: 1
+    mean_size = sum(size for size, _ in timed) / len(timed)
+    mean_seconds = sum(seconds for _, seconds in timed) / len(timed)
+    variance = sum((size - mean_size) ** 2 for size, _ in timed)
+    covariance = sum((size - mean_size) * (seconds - mean_seconds) for size, seconds in timed)
+    # more MRs in a batch never make its CI faster; a negative slope is noise
+    per_mr = max(0, covariance / variance) if variance > 0 else 0
+    base = mean_seconds - per_mr * mean_size
+    if base < 0:
+        # nor does CI take less than nothing to start: go through the origin instead
+        base, per_mr = 0, mean_seconds / mean_size
+    return lambda size: base + per_mr * size
+
+
+def _estimate_pass_rate(outcomes, steps):
+    """Maximum likelihood estimate of the probability that a single MR passes CI."""
+    if not outcomes:
+        return None
+
+    def log_likelihood(pass_rate):
+        total = 0
+        for outcome in outcomes:
+            batch_pass_rate = pass_rate ** outcome.size
+            likelihood = batch_pass_rate if outcome.success else 1 - batch_pass_rate
+            if likelihood <= 0:
+                return -math.inf
+            total += math.log(likelihood)
+        return total
+
+    return max((step / steps for step in range(1, steps)), key=log_likelihood)
@@ -3,13 +3,26 @@ import time
 from collections import namedtuple
 from tempfile import TemporaryDirectory
 
+from . import aio
 from . import batch_job
+from . import batch_sizer
+from . import concurrency
 from . import git
+from . import git_pool
 from . import job
+from . import job_state
+from . import latency
+from . import lease as lease_module
+from . import lifecycle
 from . import merge_request as merge_request_module
+from . import metrics
+from . import prewarm
 from . import single_merge_job
+from . import scheduler
+from . import sharding
 from . import store
-from .project import AccessLevel, Project
+from . import user as user_module
+from .project import AccessLevel, ProjectCache
 
 MergeRequest = merge_request_module.MergeRequest
 
@@ -21,6 +34,58 @@ class Bot:
 
         user = config.user
         opts = config.merge_opts
+        self._batch_sizer = batch_sizer.BatchSizer(
+            adaptive=config.batch_adaptive_size,
+            max_size=config.batch_max_size,
+            history_file=config.batch_history_file,
+        ) if config.batch else None
+        self._scheduler = scheduler.Scheduler(
+            labels=config.priority_labels,
+            branch_regexp=config.priority_branch_regexp,
+            aging=config.priority_aging.total_seconds(),
+            assigned_at=lambda merge_request: MergeRequest.fetch_assigned_at(user, api, merge_request.info),
+        ) if config.priority_scheduling else None
+        self._polled_activity = {}  # project_id -> its last_activity_at when we last fetched its MRs
+        self._last_full_sweep = None
+        self._project_cache = ProjectCache(
+            api,
+            full_refresh_interval=config.project_refresh_interval.total_seconds(),
+        )
+        self._latency_store = latency.LatencyStore(
+            config.latency_file,
+            max_age=config.latency_max_age.total_seconds(),
+        ) if config.latency_file else None
+        # the jobs on the projects in progress poll GitLab on its event loop, rather than each on its own
+        self._runtime = aio.Runtime(
+            api, max_concurrent_requests=config.concurrent_projects,
+        ) if config.concurrent_projects > 1 else None
+        self._job_services = job.JobServices(
+            user_cache=user_module.UserCache(
+                api,
+                ttl=config.user_cache_ttl.total_seconds(),
+                cache_file=config.user_cache_file,
+            ) if opts.add_reviewers else None,
+            project_cache=self._project_cache,
+            job_state=job_state.JobStateStore(config.job_state_file) if config.job_state_file else None,
+            latency_store=self._latency_store,
+            lease=None,
+            runtime=self._runtime,
+        )
+        self._shard = sharding.ShardCoordinator(
+            config.shard_file,
+            instance_id=config.shard_id,
+            ttl=config.shard_ttl.total_seconds(),
+        ) if config.shard_file else None
+        self._leases = lease_module.LeaseManager(
+            config.lock_dir,
+            owner=config.shard_id,
+            ttl=config.lease_ttl.total_seconds(),
+        ) if config.lock_dir else None
+        self._jobs = lifecycle.JobRegistry()
+        # background threads to start with the bot and stop, in reverse, when it stops
+        self._services = [
+            service for service in (self._shard, self._leases, self._runtime) if service is not None
+        ]
 
         if not user.is_admin:
             assert not opts.reapprove, (
@@ -31,6 +96,7 @@ class Bot:
             )
 
     def start(self):
+        pool = git_pool.GitPool(self._config.git_workers) if self._config.git_workers else None
         with TemporaryDirectory() as root_dir:
             if self._config.use_https:
                 repo_manager = store.HttpsRepoManager(
@@ -39,6 +105,7 @@ class Bot:
                     auth_token=self._config.auth_token,
                     timeout=self._config.git_timeout,
                     reference=self._config.git_reference_repo,
+                    git_pool=pool,
                 )
             else:
                 repo_manager = store.SshRepoManager(
@@ -47,8 +114,29 @@ class Bot:
                     ssh_key_file=self._config.ssh_key_file,
                     timeout=self._config.git_timeout,
                     reference=self._config.git_reference_repo,
+                    git_pool=pool,
                 )
-            self._run(repo_manager)
+            prewarmer = prewarm.Prewarmer(
+                repo_manager,
+                pool,
+                allowlist=self._config.prewarm_projects,
+                active_within=self._config.prewarm_active_within.total_seconds(),
+                concurrency=self._config.prewarm_concurrency,
+                disk_budget=self._config.prewarm_disk_budget,
+                refresh_interval=self._config.prewarm_refresh_interval.total_seconds(),
+            ) if self._config.prewarm else None
+            with lifecycle.signal_handlers(self._jobs):
+                for service in self._services:
+                    service.start()
+                try:
+                    self._run(repo_manager, prewarmer)
+                except lifecycle.ShutdownRequested:
+                    log.info('Shutting down as requested')
+                finally:
+                    for service in reversed(self._services):
+                        service.stop()
+                    if pool is not None:
+                        pool.close()  # before root_dir goes
 
     @property
     def user(self):
@@ -58,16 +146,24 @@ class Bot:
     def api(self):
         return self._api
 
-    def _run(self, repo_manager):
+    def _run(self, repo_manager, prewarmer=None):
         time_to_sleep_between_projects_in_secs = 1
         min_time_to_sleep_after_iterating_all_projects_in_secs = 30
         while True:
+            time_0 = time.monotonic()
             projects = self._get_projects()
+            if self._shard is not None:
+                projects = self._shard.select(projects)
+            if prewarmer is not None:
+                prewarmer.update(projects)
+            if self._config.skip_idle_projects:
+                projects = self._select_active_projects(projects)
             self._process_projects(
                 repo_manager,
                 time_to_sleep_between_projects_in_secs,
                 projects,
             )
+            metrics.CYCLE_DURATION.observe(time.monotonic() - time_0)
             if self._config.cli:
                 return
 
@@ -75,11 +171,12 @@ class Bot:
                             min_time_to_sleep_after_iterating_all_projects_in_secs -
                             time_to_sleep_between_projects_in_secs * len(projects))
             log.info('Sleeping for %s seconds...', big_sleep)
-            time.sleep(big_sleep)
+            with lifecycle.interruptible():
+                time.sleep(big_sleep)
 
     def _get_projects(self):
         log.info('Finding out my current projects...')
-        my_projects = Project.fetch_all_mine(self._api)
+        my_projects = self._project_cache.fetch_all_mine()
         project_regexp = self._config.project_regexp
         filtered_projects = [p for p in my_projects if project_regexp.match(p.path_with_namespace)]
         log.debug(
@@ -94,22 +191,113 @@ class Bot:
             )
         return filtered_projects
 
+    def _select_active_projects(self, projects):
+        """Leave out the projects that can't have anything new for us since we last looked.
+
+        That is, unless it is time for a full sweep, the projects with no MRs assigned to us and
+        whose `last_activity_at` hasn't changed since we last fetched their MRs.
+        """
+        now = time.time()
+        full_sweep_interval = self._config.full_sweep_interval.total_seconds()
+        if self._last_full_sweep is None or now - self._last_full_sweep >= full_sweep_interval:
+            log.info('Sweeping all %s projects...', len(projects))
+            self._last_full_sweep = now
+            return projects
+
+        assigned_project_ids = merge_request_module.fetch_project_ids_assigned_to(self.user, self._api)
+        active_projects = [
+            project for project in projects
+            if project.id in assigned_project_ids or
+            project.info.get('last_activity_at') != self._polled_activity.get(project.id)
+        ]
+        log.info('Skipping %s idle projects out of %s', len(projects) - len(active_projects), len(projects))
+        return active_projects
+
     def _process_projects(
         self,
         repo_manager,
         time_to_sleep_between_projects_in_secs,
         projects,
     ):
+        work = []
         for project in projects:
+            lifecycle.check()
             project_name = project.path_with_namespace
 
             if project.access_level < AccessLevel.reporter:
                 log.warning("Don't have enough permissions to browse merge requests in %s!", project_name)
                 continue
+            self._polled_activity[project.id] = project.info.get('last_activity_at')
             merge_requests = self._get_merge_requests(project, project_name)
+            metrics.QUEUE_DEPTH.set(len(merge_requests), project=project_name)
+            if self._latency_store is not None:
+                self._latency_store.mark_seen(project.id, [mr.iid for mr in merge_requests])
+            if self._scheduler is not None:
+                self._scheduler.enqueue(project, merge_requests)
+                continue
+            if self._config.concurrent_projects > 1:
+                work.append((project, merge_requests))
+                continue
+            self._process_merge_requests(repo_manager, project, merge_requests)
+            with lifecycle.interruptible():
+                time.sleep(time_to_sleep_between_projects_in_secs)
+
+        if work:
+            self._process_concurrently(
+                repo_manager, iter(work).__next__, time_to_sleep_between_projects_in_secs,
+            )
+        if self._scheduler is not None:
+            self._process_queue(repo_manager, time_to_sleep_between_projects_in_secs)
+
+    def _process_queue(self, repo_manager, time_to_sleep_between_projects_in_secs):
+        """Work on the projects queued in the scheduler, most urgent first."""
+        for priority_class, class_stats in sorted(self._scheduler.stats().items()):
+            mean_dispatch_wait = class_stats['mean_dispatch_wait']
+            log.info(
+                'Merge queue %s: %s MRs, longest waiting for %.0fs, mean wait before dispatch %s',
+                priority_class, class_stats['queued'], class_stats['max_wait'],
+                '-' if mean_dispatch_wait is None else '%.0fs' % mean_dispatch_wait,
+            )
+        if self._config.concurrent_projects > 1:
+            self._process_concurrently(
+                repo_manager, self._scheduler.pop, time_to_sleep_between_projects_in_secs,
+            )
+            return
+
+        next_up = self._scheduler.pop()
+        while next_up is not None:
+            project, merge_requests = next_up
+            time_0 = time.monotonic()
+            self._process_merge_requests(repo_manager, project, merge_requests)
+            self._scheduler.record_duration(project.id, time.monotonic() - time_0)
+            with lifecycle.interruptible():
+                time.sleep(time_to_sleep_between_projects_in_secs)
+            next_up = self._scheduler.pop()
+
+    def _process_concurrently(self, repo_manager, next_up, time_to_sleep_between_projects_in_secs):
+        """Work on the `(project, merge_requests)` that `next_up()` returns, several projects at once.
+
+        Jobs on different projects share nothing but thread-safe caches and stores, and each has
+        its own repo. Each project runs on a thread of its own, for the cycle.
+        """
+        def next_item():
+            if lifecycle.stopping():
+                return None  # the projects in progress finish their current phase on their own
+            try:
+                return next_up()
+            except StopIteration:
+                return None
+
+        def process(item):
+            project, merge_requests = item
+            time_0 = time.monotonic()
             self._process_merge_requests(repo_manager, project, merge_requests)
+            if self._scheduler is not None:
+                self._scheduler.record_duration(project.id, time.monotonic() - time_0)
             time.sleep(time_to_sleep_between_projects_in_secs)
 
+        concurrency.drain(next_item, process, self._config.concurrent_projects)
+
     def _get_merge_requests(self, project, project_name):
         log.info('Fetching merge requests assigned to me in %s...', project_name)
         my_merge_requests = MergeRequest.fetch_all_open_for_user(
@@ -151,12 +339,32 @@ class Bot:
             log.info('Nothing to merge at this point...')
             return
 
+        if self._leases is None:
+            self._merge(repo_manager, project, merge_requests, lease=None)
+            return
+        lease = self._leases.acquire(project.id)
+        if lease is None:
+            log.info('Another instance is working on %s, leaving it be', project.path_with_namespace)
+            return
+        try:
+            self._merge(repo_manager, project, merge_requests, lease)
+        finally:
+            lease.release()
+
+    def _merge(self, repo_manager, project, merge_requests, lease):
+        # the project listing only has the basics; the jobs need all the project's settings
+        project = self._project_cache.fetch_by_id(project.id)
+        if not self._config.cli and not repo_manager.clone_in_background(project):
+            # it is cloning on the git pool: we get on with the other projects and come back next cycle
+            log.info('Cloning %s in the background, will merge once it is done', project.path_with_namespace)
+            return
         try:
             repo = repo_manager.repo_for_project(project)
         except git.GitError:
             log.exception("Couldn't initialize repository for project!")
             raise
 
+        services = self._job_services._replace(lease=lease)
         log.info('Got %s requests to merge;', len(merge_requests))
         if self._config.batch and len(merge_requests) > 1:
             log.info('Attempting to merge as many MRs as possible using BatchMergeJob...')
@@ -167,26 +375,32 @@ class Bot:
                 merge_requests=merge_requests,
                 repo=repo,
                 options=self._config.merge_opts,
+                batch_sizer=self._batch_sizer,
+                services=services,
             )
             try:
-                batch_merge_job.execute()
-                return
+                with self._jobs.running(batch_merge_job):
+                    batch_merge_job.execute()
             except batch_job.CannotBatch as err:
                 log.warning('BatchMergeJob aborted: %s', err)
             except batch_job.CannotMerge as err:
                 log.warning('BatchMergeJob failed: %s', err)
-                return
             except git.GitError as err:
                 log.exception('BatchMergeJob failed: %s', err)
+            # The target branches it merged, or gave up on, are done with: not so the others
+            merge_requests = batch_merge_job.unbatched_merge_requests
+            if not merge_requests:
+                return
         log.info('Attempting to merge the oldest MR...')
         merge_request = merge_requests[0]
         merge_job = self._get_single_job(
             project=project, merge_request=merge_request, repo=repo,
-            options=self._config.merge_opts,
+            options=self._config.merge_opts, services=services,
         )
-        merge_job.execute()
+        with self._jobs.running(merge_job):
+            merge_job.execute()
 
-    def _get_single_job(self, project, merge_request, repo, options):
+    def _get_single_job(self, project, merge_request, repo, options, services):
         return single_merge_job.SingleMergeJob(
             api=self._api,
             user=self.user,
@@ -194,12 +408,21 @@ class Bot:
             merge_request=merge_request,
             repo=repo,
             options=options,
+            services=services,
         )
 
 
 class BotConfig(namedtuple('BotConfig',
                            'user use_https auth_token ssh_key_file project_regexp merge_order merge_opts ' +
-                           'git_timeout git_reference_repo branch_regexp source_branch_regexp batch cli')):
+                           'git_timeout git_reference_repo branch_regexp source_branch_regexp batch cli ' +
+                           'batch_adaptive_size batch_max_size batch_history_file ' +
+                           'user_cache_ttl user_cache_file project_refresh_interval ' +
+                           'skip_idle_projects full_sweep_interval ' +
+                           'priority_scheduling priority_labels priority_branch_regexp priority_aging ' +
+                           'job_state_file latency_file latency_max_age concurrent_projects ' +
+                           'shard_file shard_id shard_ttl lock_dir lease_ttl git_workers ' +
+                           'prewarm prewarm_projects prewarm_active_within prewarm_concurrency ' +
+                           'prewarm_disk_budget prewarm_refresh_interval')):
     pass
 
 
@@ -38,6 +38,10 @@ class Commit(gitlab.Resource):
     def title(self):
         return self.info['title']
 
+    @property
+    def parent_ids(self):
+        return self.info['parent_ids']
+
     @property
     def author_name(self):
         return self.info['author_name']
@@ -0,0 +1,53 @@
+"""
+Running blocking work on threads, a few items at a time.
+"""
+import logging as log
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import lifecycle
+from . import tracing
+
+
+def map_concurrently(fun, items, max_workers):
+    """Like `map`, but running up to `max_workers` calls at once. Returns a list in the order of `items`."""
+    items = list(items)
+    if len(items) <= 1:
+        return [fun(item) for item in items]
+    parent_span = tracing.current_span()
+
+    def traced_fun(item):
+        with tracing.attach(parent_span):
+            return fun(item)
+
+    with ThreadPoolExecutor(max_workers=min(len(items), max_workers)) as executor:
+        return list(executor.map(traced_fun, items))
+
+
+def drain(next_item, handle, max_workers):
+    """Call `handle(item)` for each item `next_item()` returns until it returns `None`, up to
+    `max_workers` at once. Errors are raised (the first of them) once all the items are handled.
+    """
+    parent_span = tracing.current_span()
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        with tracing.attach(parent_span):
+            while True:
+                with lock:
+                    item = next_item()
+                if item is None:
+                    return
+                try:
+                    handle(item)
+                except (Exception, lifecycle.ShutdownRequested) as err:  # pylint: disable=broad-except
+                    errors.append(err)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(worker) for _ in range(max_workers)]:
+            future.result()
+    if errors:
+        if len(errors) > 1:
+            log.error('%s more errors after the first: %s', len(errors) - 1, errors[1:])
+        raise errors[0]
@@ -3,11 +3,14 @@ import shlex
 import os
 import sys
 import subprocess
+import time
 from subprocess import PIPE, TimeoutExpired
 
 from collections import namedtuple
 
 
+from . import metrics
+from . import tracing
 from . import trailerfilter
 
 # Turning off StrictHostKeyChecking is a nasty hack to approximate
@@ -180,14 +183,25 @@ class Repo(namedtuple('Repo', 'remote_url local_path ssh_key_file timeout refere
         command.extend([arg for arg in args if str(arg)])
 
         log.info('Running %s', ' '.join(shlex.quote(w) for w in command))
+        time_0 = time.monotonic()
+        status = 'error'
         try:
             timeout_seconds = self.timeout.total_seconds() if self.timeout is not None else None
-            return _run(*command, env=env, check=True, timeout=timeout_seconds)
+            # no arguments in the span: they may include a remote url with credentials
+            with tracing.span('git ' + args[0]):
+                result = _run(*command, env=env, check=True, timeout=timeout_seconds)
+            status = 'ok'
+            return result
         except subprocess.CalledProcessError as err:
             log.warning('git returned %s', err.returncode)
             log.warning('stdout: %r', err.stdout)
             log.warning('stderr: %r', err.stderr)
             raise GitError(err) from err
+        except TimeoutExpired:
+            status = 'timeout'
+            raise
+        finally:
+            metrics.GIT_COMMAND_DURATION.observe(time.monotonic() - time_0, command=args[0], status=status)
 
 
 def _run(*args, env=None, check=False, timeout=None):
@@ -0,0 +1,129 @@
+"""
+Run the git operations of all the repos on a bounded pool of threads.
+
+Each git operation runs a subprocess for as long as it takes: a clone of a big repo can take
+minutes. On the pool, a job waits for its own operations only, while the bot goes on polling
+GitLab and waiting for CI in the other projects, and clones happen in the background. The pool
+caps how many operations run at once, all repos together, and runs those of each repo one at a
+time, in the order they were submitted.
+"""
+import collections
+import functools
+import logging as log
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import metrics
+from . import tracing
+
+
+class GitPool:
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='git')
+        self._lock = threading.Lock()
+        # repo key -> the operations waiting for the one running on the repo to finish
+        self._queues = {}
+        self._closed = False
+
+    def submit(self, key, fun, *args, **kwargs):
+        """Run `fun(*args, **kwargs)` once the operations submitted before with the same `key` (the
+        path of a repo) are done; return a `Future` of its result.
+        """
+        task = (Future(), functools.partial(fun, *args, **kwargs), tracing.current_span())
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('The git pool is closed')
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append(task)
+                self._update_metrics()
+                return task[0]
+            self._queues[key] = collections.deque()
+            self._update_metrics()
+            self._executor.submit(self._run, key, task)
+        return task[0]
+
+    def run(self, key, fun, *args, **kwargs):
+        """Like `submit`, but wait for the result."""
+        return self.submit(key, fun, *args, **kwargs).result()
+
+    def pending(self):
+        """The number of operations running or waiting to."""
+        with self._lock:
+            return sum(1 + len(queue) for queue in self._queues.values())
+
+    def close(self):
+        """Cancel the operations that are waiting, and wait for the running ones to finish."""
+        with self._lock:
+            self._closed = True
+            cancelled = [future for queue in self._queues.values() for future, _, _ in queue]
+            for queue in self._queues.values():
+                queue.clear()
+        for future in cancelled:
+            future.cancel()
+        running = self.pending()
+        if running:
+            log.info('Waiting for %s git operations to finish...', running)
+        self._executor.shutdown(wait=True)
+
+    def _run(self, key, task):
+        future, call, parent_span = task
+        result, error = None, None
+        running = future.set_running_or_notify_cancel()
+        if running:
+            try:
+                with tracing.attach(parent_span):
+                    result = call()
+            except BaseException as err:  # pylint: disable=broad-except
+                error = err
+        with self._lock:
+            queue = self._queues[key]
+            if queue:
+                # back of the line, so that a busy repo doesn't hog a thread
+                self._executor.submit(self._run, key, queue.popleft())
+            else:
+                del self._queues[key]
+            self._update_metrics()
+        # only now, so that whoever waits on it sees the pool as it is after the operation
+        if not running:
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _update_metrics(self):
+        metrics.GIT_OPERATIONS.set(len(self._queues), state='running')
+        metrics.GIT_OPERATIONS.set(sum(len(queue) for queue in self._queues.values()), state='waiting')
+
+
+class PooledRepo:
+    """A `git.Repo` whose operations run on a `GitPool`, one at a time, keyed on its local path.
+
+    Its other attributes are those of the repo.
+    """
+
+    OPERATIONS = frozenset([
+        'clone', 'config_user_info', 'fetch', 'tag_with_trailer', 'merge', 'fast_forward', 'rebase',
+        'remove_branch', 'checkout_branch', 'push', 'get_commit_hash', 'get_remote_url', 'git',
+    ])
+
+    def __init__(self, repo, pool):
+        self.repo = repo
+        self._pool = pool
+
+    def submit(self, operation, *args, **kwargs):
+        """Submit `operation` (e.g. 'fetch') to the pool, without waiting for it; return its `Future`."""
+        assert operation in self.OPERATIONS, operation
+        return self._pool.submit(self.repo.local_path, getattr(self.repo, operation), *args, **kwargs)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.repo, name)
+        if name not in self.OPERATIONS:
+            return attribute
+        return functools.partial(self._pool.run, self.repo.local_path, attribute)
+
+    def __repr__(self):
+        return 'PooledRepo({!r})'.format(self.repo)
@@ -1,32 +1,69 @@
 import json
 import logging as log
+import time
 from collections import namedtuple
+from datetime import datetime
 
 import requests
 
+from . import http_log
+from . import metrics
+from . import tracing
+
 
 class Api:
-    def __init__(self, gitlab_url, auth_token):
+    VERSION_TTL = 3600
+
+    def __init__(self, gitlab_url, auth_token, session=None):
         self._auth_token = auth_token
+        self._session = session  # a `requests.Session` to reuse connections, see `pooled_session`
         self._api_base_url = gitlab_url.rstrip('/') + '/api/v4'
+        self._graphql_url = gitlab_url.rstrip('/') + '/api/graphql'
+        self._version = None  # (version, monotonic time it was fetched at), see `version`
 
     def call(self, command, sudo=None):
-        method = command.method
         url = self._api_base_url + command.endpoint
         headers = {'PRIVATE-TOKEN': self._auth_token}
         if sudo:
             headers['SUDO'] = '%d' % sudo
-        log.debug('REQUEST: %s %s %r %r', method.__name__.upper(), url, headers, command.call_args)
+        return self._request(
+            command.method, url, headers, command.call_args, command.extract,
+            endpoint=metrics.endpoint_label(command.endpoint),
+        )
+
+    def graphql(self, query, variables=None):
+        """Run a GraphQL `query` and return the `data` of the result. Needs GitLab 12.0+."""
+        headers = {'PRIVATE-TOKEN': self._auth_token}
+        call_args = {'json': {'query': query, 'variables': variables or {}}}
+        result = self._request(
+            requests.post, self._graphql_url, headers, call_args, None, endpoint='/graphql',
+        )
+        if result.get('errors'):
+            raise GraphQLError(200, {'message': '; '.join(error['message'] for error in result['errors'])})
+        return result['data']
+
+    def _request(self, method, url, headers, call_args, extract, endpoint):
+        method_name = method.__name__.upper()
+        if self._session is not None:
+            method = getattr(self._session, method.__name__)
+        http_log.HTTP_LOG.request(method_name, url, endpoint, headers, call_args)
         # Timeout to prevent indefinitely hanging requests. 60s is very conservative,
         # but should be short enough to not cause any practical annoyances. We just
         # crash rather than retry since marge-bot should be run in a restart loop anyway.
-        try:
-            response = method(url, headers=headers, timeout=60, **command.call_args)
-        except requests.exceptions.Timeout as err:
-            log.error('Request timeout: %s', err)
-            raise
-        log.debug('RESPONSE CODE: %s', response.status_code)
-        log.debug('RESPONSE BODY: %r', response.content)
+        with tracing.span('gitlab {} {}'.format(method_name, endpoint), url=url) as span:
+            time_0 = time.monotonic()
+            try:
+                response = method(url, headers=headers, timeout=60, **call_args)
+            except requests.exceptions.Timeout as err:
+                log.error('Request timeout: %s', err)
+                metrics.API_REQUESTS.inc(method=method_name, endpoint=endpoint, status='timeout')
+                raise
+            finally:
+                elapsed = time.monotonic() - time_0
+                metrics.API_REQUEST_DURATION.observe(elapsed, method=method_name, endpoint=endpoint)
+            span.set_attribute('status', response.status_code)
+        metrics.API_REQUESTS.inc(method=method_name, endpoint=endpoint, status=response.status_code)
+        http_log.HTTP_LOG.response(method_name, endpoint, response, elapsed)
 
         if response.status_code == 202:
             return True  # Accepted
@@ -35,7 +72,7 @@ class Api:
             return True  # NoContent
 
         if response.status_code < 300:
-            return command.extract(response.json()) if command.extract else response.json()
+            return extract(response.json()) if extract else response.json()
 
         if response.status_code == 304:
             return False  # Not Modified
@@ -78,8 +115,31 @@ class Api:
         return result
 
     def version(self):
-        response = self.call(GET('/version'))
-        return Version.parse(response['version'])
+        """GitLab's version, fetched at most once every `VERSION_TTL` seconds, as every poll checks it."""
+        now = time.monotonic()
+        if self._version is None or now - self._version[1] >= self.VERSION_TTL:
+            response = self.call(GET('/version'))
+            self._version = (Version.parse(response['version']), now)
+        return self._version[0]
+
+
+def pooled_session(pool_size):
+    """A `requests.Session` keeping up to `pool_size` connections open, to share between threads."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def timestamp(value):
+    """The seconds since the epoch of a GitLab date-time such as `created_at`, or `None` if it isn't one."""
+    for time_format in ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z'):
+        try:
+            return datetime.strptime(value, time_format).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return None
 
 
 def from_singleton_list(fun=None):
@@ -198,11 +258,29 @@ class UnexpectedError(ApiError):
     pass
 
 
+class GraphQLError(ApiError):
+    pass
+
+
 class Resource:
+    # The fields of `info` kept by `compact` resources
+    COMPACT_FIELDS = ()
+
     def __init__(self, api, info):
         self._info = info
         self._api = api
 
+    @classmethod
+    def compact(cls, api, info):
+        """A resource keeping only the `COMPACT_FIELDS` of `info`, to save memory on big listings.
+
+        Looking up any other field fetches the full info once, with the `fetch_info()` method that
+        the classes with `COMPACT_FIELDS` have.
+        """
+        resource = cls(api, None)
+        resource._info = _compact_info_type(cls)(resource, info)
+        return resource
+
     @property
     def info(self):
         return self._info
@@ -219,6 +297,75 @@ class Resource:
         return '{0.__class__.__name__}({0._api}, {0.info})'.format(self)
 
 
+class CompactInfo:
+    """Some of the fields of the info of a resource, in slots rather than a dict.
+
+    It reads like the info dict; looking up any field but `FIELDS` fetches the full info.
+    """
+    __slots__ = ('_resource',)
+    FIELDS = frozenset()
+
+    def __init__(self, resource, info):
+        self._resource = resource
+        for field in self.FIELDS:
+            if field in info:
+                setattr(self, field, info[field])
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            return self._expand()[key]
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None  # like the info it came from
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def _expand(self):
+        """Fetch the full info, and have the resource keep it instead of us."""
+        resource = self._resource
+        if resource.info is self:
+            log.debug('Fetching the full info of %s %s', resource.__class__.__name__, resource.id)
+            resource._info = resource.fetch_info()  # pylint: disable=protected-access
+        return resource.info
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in sorted(self.FIELDS) if hasattr(self, field)}
+
+    def __eq__(self, other):
+        if isinstance(other, CompactInfo):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.to_dict())
+
+
+_MISSING = object()
+_COMPACT_INFO_TYPES = {}  # Resource subclass -> its CompactInfo subclass
+
+
+def _compact_info_type(resource_class):
+    info_type = _COMPACT_INFO_TYPES.get(resource_class)
+    if info_type is None:
+        fields = tuple(resource_class.COMPACT_FIELDS)
+        info_type = type(resource_class.__name__ + 'Info', (CompactInfo,), {
+            '__slots__': fields,
+            'FIELDS': frozenset(fields),
+        })
+        _COMPACT_INFO_TYPES[resource_class] = info_type
+    return info_type
+
+
 class Version(namedtuple('Version', 'release edition')):
     @classmethod
     def parse(cls, string):
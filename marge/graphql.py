@@ -0,0 +1,139 @@
+"""
+Bulk reads of merge request state through GitLab's GraphQL API.
+
+The REST resources cost one request per MR for each of its state, approvals and pipelines.
+Here we fetch exactly the fields the job code checks for many MRs, across projects, in one
+request, use them to hydrate the usual `MergeRequest` and `Approvals` objects, and keep the
+status of the head pipeline for the batch job to check.
+"""
+from collections import namedtuple
+
+from .approvals import Approvals
+
+# GitLab caps connections at 100 nodes per page
+MAX_IIDS_PER_QUERY = 100
+
+MERGE_REQUEST_FIELDS = '''
+    nodes {
+      iid
+      state
+      draft
+      squash
+      diffHeadSha
+      mergeStatusEnum
+      mergeableDiscussionsState
+      assignees { nodes { id } }
+      approvalsLeft
+      approvedBy { nodes { id username } }
+      headPipeline { id status sha }
+    }
+'''
+
+
+def fetch_merge_request_states(api, project, iids):
+    """Return `{iid: MergeRequestState}` for the MRs of `project` with the given `iids`."""
+    states = fetch_merge_request_states_across_projects(api, {project.path_with_namespace: iids})
+    return {iid: state for (_, iid), state in states.items()}
+
+
+def fetch_merge_request_states_across_projects(api, iids_by_project_path):
+    """Return `{(project_path, iid): MergeRequestState}`, with one GraphQL request per 100 MRs."""
+    states = {}
+    for chunk in _chunks(iids_by_project_path):
+        query, variables = _build_query(chunk)
+        data = api.graphql(query, variables)
+        for index, (project_path, _) in enumerate(chunk):
+            project = data.get('p%d' % index)
+            if project is None:
+                continue
+            for node in project['mergeRequests']['nodes']:
+                state = MergeRequestState.from_node(node)
+                states[project_path, state.iid] = state
+    return states
+
+
+def _chunks(iids_by_project_path):
+    chunk, chunk_size = [], 0
+    for project_path, iids in iids_by_project_path.items():
+        iids = list(iids)
+        while iids:
+            taken, iids = iids[:MAX_IIDS_PER_QUERY - chunk_size], iids[MAX_IIDS_PER_QUERY - chunk_size:]
+            chunk.append((project_path, taken))
+            chunk_size += len(taken)
+            if chunk_size == MAX_IIDS_PER_QUERY:
+                yield chunk
+                chunk, chunk_size = [], 0
+    if chunk:
+        yield chunk
+
+
+def _build_query(chunk):
+    parameters, selections, variables = [], [], {}
+    for index, (project_path, iids) in enumerate(chunk):
+        parameters.append('$path{0}: ID!, $iids{0}: [String!]'.format(index))
+        selections.append(
+            'p{0}: project(fullPath: $path{0}) {{ '
+            'mergeRequests(iids: $iids{0}, first: {1}) {{ {2} }} }}'.format(
+                index, MAX_IIDS_PER_QUERY, MERGE_REQUEST_FIELDS,
+            )
+        )
+        variables['path%d' % index] = project_path
+        variables['iids%d' % index] = [str(iid) for iid in iids]
+    query = 'query({}) {{ {} }}'.format(', '.join(parameters), ' '.join(selections))
+    return query, variables
+
+
+def _id_from_gid(gid):
+    """GraphQL ids look like 'gid://gitlab/User/123'."""
+    return int(gid.rsplit('/', 1)[-1])
+
+
+class MergeRequestState(namedtuple('MergeRequestState', [
+        'iid', 'state', 'draft', 'squash', 'sha', 'merge_status', 'blocking_discussions_resolved',
+        'assignee_ids', 'approvals_left', 'approved_by', 'head_pipeline',
+])):
+    __slots__ = ()
+
+    @classmethod
+    def from_node(cls, node):
+        pipeline = node.get('headPipeline')
+        return cls(
+            iid=int(node['iid']),
+            state=node['state'],
+            draft=node['draft'],
+            squash=node.get('squash', False),
+            sha=node['diffHeadSha'],
+            merge_status=(node.get('mergeStatusEnum') or '').lower() or None,
+            blocking_discussions_resolved=node['mergeableDiscussionsState'],
+            assignee_ids=[_id_from_gid(assignee['id']) for assignee in node['assignees']['nodes']],
+            approvals_left=node.get('approvalsLeft') or 0,
+            approved_by=[
+                {'user': {'id': _id_from_gid(user['id']), 'username': user['username']}}
+                for user in (node.get('approvedBy') or {}).get('nodes', [])
+            ],
+            head_pipeline={
+                'id': _id_from_gid(pipeline['id']),
+                'status': pipeline['status'].lower(),
+                'sha': pipeline['sha'],
+            } if pipeline else None,
+        )
+
+    def hydrate(self, merge_request):
+        """Update `merge_request` in place and return its approvals."""
+        assert merge_request.iid == self.iid, (merge_request.iid, self.iid)
+        merge_request.info.update(
+            state=self.state,
+            work_in_progress=self.draft,
+            squash=self.squash,
+            sha=self.sha,
+            merge_status=self.merge_status,
+            blocking_discussions_resolved=self.blocking_discussions_resolved,
+            assignees=[{'id': assignee_id} for assignee_id in self.assignee_ids],
+        )
+        return Approvals(merge_request.api, {
+            'id': merge_request.id,
+            'iid': merge_request.iid,
+            'project_id': merge_request.project_id,
+            'approvals_left': self.approvals_left,
+            'approved_by': self.approved_by,
+        })
@@ -0,0 +1,105 @@
+"""
+Debug logging of the GitLab API requests and responses, kept cheap.
+
+Nothing is formatted unless debug logging is on. Then every request and response gets a
+one-line record (method, endpoint, status, duration and size), but bodies are only decoded
+and logged for a sample of the responses of each endpoint, and for all the error responses;
+they are cut to `max_body_size` bytes first. Tokens, passwords and the like are redacted.
+"""
+import logging as log
+import random
+import re
+
+REDACTED = '[REDACTED]'
+
+_SECRET_HEADERS = frozenset(['private-token', 'authorization', 'job-token'])
+# "..._token": "...", "password": "..." etc., in JSON or Python reprs; the value may have been cut short
+_SECRET_FIELD = re.compile(
+    r'''((["'])[a-z_]*(?:token|password|secret)\2\s*:\s*)(["'])(?:(?!\3)[^\\]|\\.)*(?:\3|$)''',
+    re.IGNORECASE,
+)
+_SECRET_PARAM = re.compile(r'((?:private|access|job)_token=)[^&\s\'"]*', re.IGNORECASE)
+
+
+class HttpLog:
+
+    def __init__(self, max_body_size=1024, sample_rates=None):
+        """`sample_rates` maps endpoints, as in `metrics.endpoint_label`, to the fraction of their
+        response bodies to log; '*' is the default for the others, 1 if not given.
+        """
+        self.max_body_size = max_body_size
+        self.sample_rates = dict(sample_rates or {})
+
+    @staticmethod
+    def enabled():
+        return log.getLogger().isEnabledFor(log.DEBUG)
+
+    def request(self, method, url, endpoint, headers, call_args):
+        if not self.enabled():
+            return
+        log.debug(
+            'REQUEST: method=%s endpoint=%s url=%s headers=%s args=%s',
+            method, endpoint, redact(url), self._headers(headers), redact(self._truncate(repr(call_args))),
+        )
+
+    def response(self, method, endpoint, response, seconds):
+        if not self.enabled():
+            return
+        size = len(response.content) if response.content is not None else 0
+        log.debug(
+            'RESPONSE: method=%s endpoint=%s status=%s duration=%.3fs size=%s',
+            method, endpoint, response.status_code, seconds, size,
+        )
+        if self.max_body_size and size and (response.status_code >= 400 or self._sampled(endpoint)):
+            body = response.content[:self.max_body_size].decode('utf-8', 'replace')
+            log.debug(
+                'RESPONSE BODY: method=%s endpoint=%s body=%s%s',
+                method, endpoint, redact(body),
+                ' ... ({} bytes)'.format(size) if size > self.max_body_size else '',
+            )
+
+    def _sampled(self, endpoint):
+        rate = self.sample_rates.get(endpoint, self.sample_rates.get('*', 1))
+        return rate >= 1 or random.random() < rate
+
+    @staticmethod
+    def _headers(headers):
+        return {
+            name: REDACTED if name.lower() in _SECRET_HEADERS else value
+            for name, value in headers.items()
+        }
+
+    def _truncate(self, text):
+        if self.max_body_size and len(text) > self.max_body_size:
+            return '{} ... ({} chars)'.format(text[:self.max_body_size], len(text))
+        return text
+
+
+def redact(text):
+    """`text` with the values of the fields and query parameters that look secret replaced."""
+    text = _SECRET_FIELD.sub(r'\1\3{}\3'.format(REDACTED), text)
+    return _SECRET_PARAM.sub(r'\1{}'.format(REDACTED), text)
+
+
+def parse_sample_rates(text):
+    """Parse e.g. '/projects/:id/merge_requests=0.1,*=0.5' into a dict of endpoint -> rate."""
+    rates = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        endpoint, sep, rate = item.rpartition('=')
+        if not sep or not endpoint.strip():
+            raise ValueError('Expected ENDPOINT=RATE, got {!r}'.format(item))
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError('Sample rates are between 0 and 1, got {!r}'.format(item))
+        rates[endpoint.strip()] = rate
+    return rates
+
+
+HTTP_LOG = HttpLog()
+
+
+def configure(max_body_size, sample_rates):
+    HTTP_LOG.max_body_size = max_body_size
+    HTTP_LOG.sample_rates = dict(sample_rates)
@@ -1,12 +1,16 @@
 # pylint: disable=too-many-locals,too-many-branches,too-many-statements
+import contextlib
 import enum
 import logging as log
+import sqlite3
 import time
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from datetime import datetime, timedelta
 
-from . import git, gitlab
+from . import git, gitlab, lease as lease_module, lifecycle, metrics, profiling, tracing
 from .branch import Branch
+from .commit import Commit
+from .concurrency import map_concurrently
 from .interval import IntervalUnion
 from .merge_request import MergeRequestRebaseFailed
 from .project import Project
@@ -15,14 +19,23 @@ from .pipeline import Pipeline
 
 
 class MergeJob:
+    # Upper bound on the number of GitLab requests a job makes concurrently
+    MAX_CONCURRENT_REQUESTS = 8
 
-    def __init__(self, *, api, user, project, repo, options):
+    def __init__(self, *, api, user, project, repo, options, services=None):
         self._api = api
         self._user = user
         self._project = project
         self._repo = repo
         self._options = options
         self._merge_timeout = options.ci_timeout
+        self._source_projects = {project.id: project}
+        self._phase_timings = OrderedDict()
+        self._phase_log = []  # (name, started_at, seconds) of each phase, in the order they ended
+        # what the job is doing right now, for state dumps: a token -> (kind, name, monotonic start)
+        # for each phase in progress and each wait on GitLab
+        self._in_progress = {}
+        self._services = services or JobServices.none()
 
     @property
     def repo(self):
@@ -36,11 +49,106 @@ class MergeJob:
     def opts(self):
         return self._options
 
+    @property
+    def phase_timings(self):
+        """Seconds spent so far in each phase of the job, in the order they started."""
+        return dict(self._phase_timings)
+
+    @property
+    def phase_log(self):
+        """The `(name, started_at, seconds)` of each phase of the job so far."""
+        return list(self._phase_log)
+
     def execute(self):
         raise NotImplementedError
 
-    def ensure_mergeable_mr(self, merge_request):
-        merge_request.refetch_info()
+    def status(self):
+        """What the job is doing right now: its phases in progress and what it is waiting on."""
+        now = time.monotonic()
+        in_progress = list(self._in_progress.values())
+        return {
+            'job': self.__class__.__name__,
+            'project': self._project.path_with_namespace,
+            'merge_requests': [],
+            'phases': [(name, now - time_0) for kind, name, time_0 in in_progress if kind == 'phase'],
+            'waiting_on': [(name, now - time_0) for kind, name, time_0 in in_progress if kind == 'wait'],
+        }
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # a new phase is a safe point to stop at, as the previous one is done
+        lifecycle.check()
+        started_at = time.time()
+        time_0 = time.monotonic()
+        cpu_0 = time.thread_time()
+        token = object()
+        self._in_progress[token] = ('phase', name, time_0)
+        try:
+            with tracing.span('phase ' + name):
+                yield
+        finally:
+            del self._in_progress[token]
+            elapsed = time.monotonic() - time_0
+            # only counts the thread of the job, not the threads it waits on for concurrent requests
+            cpu = time.thread_time() - cpu_0
+            self._phase_timings[name] = self._phase_timings.get(name, 0) + elapsed
+            self._phase_log.append((name, started_at, elapsed))
+            metrics.JOB_PHASE_DURATION.observe(elapsed, job=self.__class__.__name__, phase=name)
+            metrics.JOB_PHASE_CPU_DURATION.observe(cpu, job=self.__class__.__name__, phase=name)
+            profiling.PROFILER.record_phase(name, elapsed, cpu)
+            log.info('Phase %r of %s for project %s took %.2fs (%.2fs of CPU)',
+                     name, self.__class__.__name__, self._project.id, elapsed, cpu)
+
+    @contextlib.contextmanager
+    def waiting(self, what):
+        """Mark the block as polling GitLab for `what`, e.g. a pipeline to finish."""
+        token = object()
+        self._in_progress[token] = ('wait', what, time.monotonic())
+        try:
+            yield
+        finally:
+            del self._in_progress[token]
+
+    def record_latency(self, merge_requests, outcome, started_at, phases=None):
+        """Store `phases`, by default the phase timeline of the job so far, as that of each of
+        `merge_requests`, worked on since `started_at`.
+        """
+        if self._services.latency_store is None:
+            return
+        phases = self._phase_log if phases is None else phases
+        finished_at = time.time()
+        for merge_request in merge_requests:
+            try:
+                self._services.latency_store.record(
+                    project_id=self._project.id,
+                    project=self._project.path_with_namespace,
+                    iid=merge_request.iid,
+                    job=self.__class__.__name__,
+                    outcome=outcome,
+                    started_at=started_at,
+                    finished_at=finished_at,
+                    phases=phases,
+                )
+            except sqlite3.Error:
+                log.exception('Failed to record the latency of MR !%s', merge_request.iid)
+
+    def record_time_to_merge(self, merge_request):
+        """Observe how long it took `merge_request` to get merged, since it was opened."""
+        created_at = gitlab.timestamp(merge_request.info.get('created_at'))
+        if created_at is not None:
+            metrics.TIME_TO_MERGE.observe(time.time() - created_at, project=self._project.path_with_namespace)
+
+    def ensure_mergeable_mr(self, merge_request, prefetched=None):
+        """Raise unless `merge_request` can be merged by us right now.
+
+        By default this refetches the MR and its approvals. Pass a `graphql.MergeRequestState`
+        as `prefetched` to check that instead.
+        """
+        if prefetched is None:
+            merge_request.refetch_info()
+            prefetched_approvals = None
+        else:
+            prefetched_approvals = prefetched.hydrate(merge_request)
         log.info('Ensuring MR !%s is mergeable', merge_request.iid)
         log.debug('Ensuring MR %r is mergeable', merge_request)
 
@@ -52,7 +160,7 @@ class MergeJob:
                 "Sorry, merging requests marked as auto-squash would ruin my commit tagging!"
             )
 
-        approvals = merge_request.fetch_approvals()
+        approvals = prefetched_approvals or merge_request.fetch_approvals()
         if not approvals.sufficient:
             raise CannotMerge(
                 'Insufficient approvals '
@@ -88,6 +196,7 @@ class MergeJob:
                 merge_request.fetch_commits(),
                 merge_request.fetch_approvals(),
                 self._api,
+                user_cache=self._services.user_cache,
             ) if should_add_reviewers
             else None
         )
@@ -155,15 +264,48 @@ class MergeJob:
                 merge_request.source_branch,
                 self._api,
             )
-        current_pipeline = next(iter(pipeline for pipeline in pipelines if pipeline.sha == commit_sha), None)
+        return pipeline_status(pipelines, merge_request, commit_sha)
 
-        if current_pipeline:
-            ci_status = current_pipeline.status
-        else:
-            log.warning('No pipeline listed for %s on branch %s', commit_sha, merge_request.source_branch)
-            ci_status = None
+    def find_reusable_pipeline(self, merge_request, target_project):
+        """Return `(target_sha, pipeline)` if a successful pipeline tested the MR on its target's head.
+
+        Updating the MR would then only cost another pipeline, for nothing. That is if the MR already
+        contains the head of its target branch, or, with the 'merge' merge method and
+        `reuse_merge_result_pipelines`, if a merged results pipeline tested it merged into that head.
+        """
+        if (
+                not self._options.reuse_pipelines or
+                # the trailers would have to be added, and then tested
+                self._options.requests_commit_tagging or
+                self._options.guarantee_final_pipeline or
+                self._api.version().release < (10, 5, 0)
+        ):
+            return None
+
+        target_sha = Commit.last_on_branch(target_project.id, merge_request.target_branch, self._api).id
+        pipelines = Pipeline.pipelines_by_merge_request(
+            merge_request.target_project_id,
+            merge_request.iid,
+            self._api,
+        )
+
+        # the refs of the MR's latest diff, if GitLab computed it yet: unless it is the diff of the MR
+        # as it is now, its base tells nothing of what the MR contains
+        diff_refs = merge_request.info.get('diff_refs') or {}
+        if diff_refs.get('base_sha') == target_sha and diff_refs.get('head_sha') == merge_request.sha:
+            pipeline = next(iter(p for p in pipelines if p.sha == merge_request.sha), None)
+            if pipeline is not None and pipeline.status == 'success':
+                return target_sha, pipeline
+
+        if self._options.reuse_merge_result_pipelines and target_project.merge_method == 'merge':
+            merge_ref = 'refs/merge-requests/{}/merge'.format(merge_request.iid)
+            pipeline = next(iter(p for p in pipelines if p.ref == merge_ref), None)
+            if pipeline is not None and pipeline.status == 'success':
+                merge_commit = Commit.fetch_by_id(merge_request.target_project_id, pipeline.sha, self._api)
+                if merge_commit.parent_ids == [target_sha, merge_request.sha]:
+                    return target_sha, pipeline
 
-        return ci_status
+        return None
 
     def wait_for_ci_to_pass(self, merge_request, commit_sha=None):
         time_0 = datetime.utcnow()
@@ -173,27 +315,22 @@ class MergeJob:
             commit_sha = merge_request.sha
 
         log.info('Waiting for CI to pass for MR !%s', merge_request.iid)
-        while datetime.utcnow() - time_0 < self._options.ci_timeout:
-            ci_status = self.get_mr_ci_status(merge_request, commit_sha=commit_sha)
-            if ci_status == 'success':
-                log.info('CI for MR !%s passed', merge_request.iid)
-                return
-
-            if ci_status == 'skipped':
-                log.info('CI for MR !%s skipped', merge_request.iid)
+        with self.waiting('CI of MR !{} at {}'.format(merge_request.iid, commit_sha)):
+            if self._services.runtime is not None:
+                self._services.runtime.wait_for_ci_to_pass(
+                    merge_request, commit_sha,
+                    timeout=self._options.ci_timeout, waiting_time_in_secs=waiting_time_in_secs,
+                )
                 return
-
-            if ci_status == 'failed':
-                raise CannotMerge('CI failed!')
-
-            if ci_status == 'canceled':
-                raise CannotMerge('Someone canceled the CI.')
-
-            if ci_status not in ('pending', 'running'):
-                log.warning('Suspicious CI status: %r', ci_status)
-
-            log.debug('Waiting for %s secs before polling CI status again', waiting_time_in_secs)
-            time.sleep(waiting_time_in_secs)
+            while datetime.utcnow() - time_0 < self._options.ci_timeout:
+                # we pushed already, so the next instance can pick up from here
+                lifecycle.check()
+                ci_status = self.get_mr_ci_status(merge_request, commit_sha=commit_sha)
+                if ci_passed(merge_request, ci_status):
+                    return
+
+                log.debug('Waiting for %s secs before polling CI status again', waiting_time_in_secs)
+                time.sleep(waiting_time_in_secs)
 
         raise CannotMerge('CI is taking too long.')
 
@@ -211,22 +348,19 @@ class MergeJob:
         waiting_time_in_secs = 5
 
         log.info('Waiting for MR !%s to have merge_status can_be_merged', merge_request.iid)
-        for attempt in range(attempts):
-            merge_request.refetch_info()
-            merge_status = merge_request.merge_status
-
-            if merge_status == 'can_be_merged':
-                log.info('MR !%s can be merged on attempt %d', merge_request.iid, attempt)
+        with self.waiting('merge_status of MR !{}'.format(merge_request.iid)):
+            if self._services.runtime is not None:
+                self._services.runtime.wait_for_merge_status_to_resolve(
+                    merge_request, attempts=attempts, waiting_time_in_secs=waiting_time_in_secs,
+                )
                 return
+            for attempt in range(attempts):
+                lifecycle.check()
+                merge_request.refetch_info()
+                if merge_status_resolved(merge_request, attempt):
+                    return
 
-            if merge_status == 'cannot_be_merged':
-                log.info('MR !%s cannot be merged on attempt %d', merge_request.iid, attempt)
-                raise CannotMerge('GitLab believes this MR cannot be merged.')
-
-            if merge_status == 'unchecked':
-                log.info('MR !%s merge status currently unchecked on attempt %d.', merge_request.iid, attempt)
-
-            time.sleep(waiting_time_in_secs)
+                time.sleep(waiting_time_in_secs)
 
     def unassign_from_mr(self, merge_request):
         log.info('Unassigning from MR !%s', merge_request.iid)
@@ -259,30 +393,47 @@ class MergeJob:
             if not sufficient_approvals():
                 approvals.reapprove()
 
-    def fetch_source_project(self, merge_request):
+    def fetch_source_project(self, merge_request, fetch=True):
         remote = 'origin'
         remote_url = None
         source_project = self.get_source_project(merge_request)
         if source_project is not self._project:
             remote = 'source'
             remote_url = source_project.ssh_url_to_repo
-            self._repo.fetch(
-                remote_name=remote,
-                remote_url=remote_url,
-            )
+            if fetch:
+                self._repo.fetch(
+                    remote_name=remote,
+                    remote_url=remote_url,
+                )
         return source_project, remote_url, remote
 
     def get_source_project(self, merge_request):
-        source_project = self._project
-        if merge_request.source_project_id != self._project.id:
-            source_project = Project.fetch_by_id(
-                merge_request.source_project_id,
-                api=self._api,
-            )
+        source_project = self._source_projects.get(merge_request.source_project_id)
+        if source_project is None:
+            source_project = self._fetch_project(merge_request.source_project_id)
+            self._source_projects[merge_request.source_project_id] = source_project
         return source_project
 
+    def resolve_source_projects(self, merge_requests):
+        """Fetch the (forked) source projects of `merge_requests` concurrently, caching them for the job."""
+        missing_ids = list(OrderedDict.fromkeys(
+            merge_request.source_project_id for merge_request in merge_requests
+            if merge_request.source_project_id not in self._source_projects
+        ))
+        projects = map_concurrently(
+            self._fetch_project,
+            missing_ids,
+            max_workers=self.MAX_CONCURRENT_REQUESTS,
+        )
+        self._source_projects.update(zip(missing_ids, projects))
+
     def get_target_project(self, merge_request):
-        return Project.fetch_by_id(merge_request.target_project_id, api=self._api)
+        return self._fetch_project(merge_request.target_project_id)
+
+    def _fetch_project(self, project_id):
+        if self._services.project_cache is not None:
+            return self._services.project_cache.fetch_by_id(project_id)
+        return Project.fetch_by_id(project_id, api=self._api)
 
     def fuse(self, source, target, source_repo_url=None, local=False):
         # NOTE: this leaves git switched to branch_a
@@ -324,27 +475,30 @@ class MergeJob:
         branch_update_done = commits_rewrite_done = False
         try:
             initial_mr_sha = merge_request.sha
-            updated_sha = self.fuse(
-                source_branch,
-                target_branch,
-                source_repo_url=source_repo_url,
-            )
+            with self.phase('rebase'):
+                updated_sha = self.fuse(
+                    source_branch,
+                    target_branch,
+                    source_repo_url=source_repo_url,
+                )
             branch_update_done = True
             # The fuse above fetches origin again, so we are now safe to fetch
             # the sha from the remote target branch.
             target_sha = repo.get_commit_hash('origin/' + target_branch)
             if updated_sha == target_sha:
                 raise CannotMerge('these changes already exist in branch `{}`'.format(target_branch))
-            final_sha = self.add_trailers(merge_request) if add_trailers else None
+            with self.phase('trailers'):
+                final_sha = self.add_trailers(merge_request) if add_trailers else None
             final_sha = final_sha or updated_sha
             commits_rewrite_done = True
             branch_was_modified = final_sha != initial_mr_sha
-            self.synchronize_mr_with_local_changes(
-                merge_request,
-                branch_was_modified,
-                source_repo_url,
-                skip_ci=skip_ci,
-            )
+            with self.phase('push'):
+                self.synchronize_mr_with_local_changes(
+                    merge_request,
+                    branch_was_modified,
+                    source_repo_url,
+                    skip_ci=skip_ci,
+                )
         except git.GitError as err:
             # A failure to clean up probably means something is fucked with the git repo
             # and likely explains any previous failure, so it will better to just
@@ -377,6 +531,15 @@ class MergeJob:
                 skip_ci=skip_ci,
             )
 
+    def ensure_lease(self):
+        """Stop before changing anything in GitLab if another process took the project over."""
+        if self._services.lease is None:
+            return
+        try:
+            self._services.lease.check()
+        except lease_module.LeaseLost as err:
+            raise SkipMerge(str(err)) from err
+
     def push_force_to_mr(
         self,
         merge_request,
@@ -384,6 +547,7 @@ class MergeJob:
         source_repo_url=None,
         skip_ci=False,
     ):
+        self.ensure_lease()
         try:
             self._repo.push(
                 merge_request.source_branch,
@@ -430,10 +594,71 @@ class MergeJob:
                 )
 
 
-def _get_reviewer_names_and_emails(commits, approvals, api):
+def pipeline_status(pipelines, merge_request, commit_sha):
+    """The status of the pipeline of `commit_sha` among `pipelines` of `merge_request`, if any."""
+    current_pipeline = next(iter(pipeline for pipeline in pipelines if pipeline.sha == commit_sha), None)
+
+    if current_pipeline:
+        return current_pipeline.status
+    log.warning('No pipeline listed for %s on branch %s', commit_sha, merge_request.source_branch)
+    return None
+
+
+def ci_passed(merge_request, ci_status):
+    """Whether the CI of `merge_request` passed; raise `CannotMerge` if it didn't, and won't."""
+    if ci_status == 'success':
+        log.info('CI for MR !%s passed', merge_request.iid)
+        return True
+
+    if ci_status == 'skipped':
+        log.info('CI for MR !%s skipped', merge_request.iid)
+        return True
+
+    if ci_status == 'failed':
+        raise CannotMerge('CI failed!')
+
+    if ci_status == 'canceled':
+        raise CannotMerge('Someone canceled the CI.')
+
+    if ci_status not in ('pending', 'running'):
+        log.warning('Suspicious CI status: %r', ci_status)
+    return False
+
+
+def merge_status_resolved(merge_request, attempt):
+    """Whether GitLab found that `merge_request` can be merged; raise `CannotMerge` if it can't."""
+    merge_status = merge_request.merge_status
+
+    if merge_status == 'can_be_merged':
+        log.info('MR !%s can be merged on attempt %d', merge_request.iid, attempt)
+        return True
+
+    if merge_status == 'cannot_be_merged':
+        log.info('MR !%s cannot be merged on attempt %d', merge_request.iid, attempt)
+        raise CannotMerge('GitLab believes this MR cannot be merged.')
+
+    if merge_status == 'unchecked':
+        log.info('MR !%s merge status currently unchecked on attempt %d.', merge_request.iid, attempt)
+    return False
+
+
+def merged(merge_request):
+    """Whether `merge_request` got merged; raise `CannotMerge` if it got closed instead."""
+    if merge_request.state == 'merged':
+        return True
+    if merge_request.state == 'closed':
+        raise CannotMerge('someone closed the merge request while merging!')
+    assert merge_request.state in ('opened', 'reopened', 'locked'), merge_request.state
+    return False
+
+
+def _get_reviewer_names_and_emails(commits, approvals, api, user_cache=None):
     """Return a list ['A. Prover <a.prover@example.com', ...]` for `merge_request.`"""
     uids = approvals.approver_ids
-    users = [User.fetch_by_id(uid, api) for uid in uids]
+    if user_cache is not None:
+        users = user_cache.fetch_by_ids(uids)
+    else:
+        users = [User.fetch_by_id(uid, api) for uid in uids]
     self_reviewed = {commit['author_email'] for commit in commits} & {user.email for user in users}
     if self_reviewed and len(users) <= 1:
         raise CannotMerge('Commits require at least one independent reviewer.')
@@ -461,6 +686,9 @@ JOB_OPTIONS = [
     'use_merge_commit_batches',
     'skip_ci_batches',
     'guarantee_final_pipeline',
+    'use_graphql',
+    'reuse_pipelines',
+    'reuse_merge_result_pipelines',
 ]
 
 
@@ -477,7 +705,8 @@ class MergeJobOptions(namedtuple('MergeJobOptions', JOB_OPTIONS)):
             add_tested=False, add_part_of=False, add_reviewers=False, reapprove=False,
             approval_timeout=None, embargo=None, ci_timeout=None, fusion=Fusion.rebase,
             use_no_ff_batches=False, use_merge_commit_batches=False, skip_ci_batches=False,
-            guarantee_final_pipeline=False,
+            guarantee_final_pipeline=False, use_graphql=False,
+            reuse_pipelines=False, reuse_merge_result_pipelines=False,
     ):
         approval_timeout = approval_timeout or timedelta(seconds=0)
         embargo = embargo or IntervalUnion.empty()
@@ -495,6 +724,26 @@ class MergeJobOptions(namedtuple('MergeJobOptions', JOB_OPTIONS)):
             use_merge_commit_batches=use_merge_commit_batches,
             skip_ci_batches=skip_ci_batches,
             guarantee_final_pipeline=guarantee_final_pipeline,
+            use_graphql=use_graphql,
+            reuse_pipelines=reuse_pipelines,
+            reuse_merge_result_pipelines=reuse_merge_result_pipelines,
+        )
+
+
+JOB_SERVICES = 'user_cache project_cache job_state latency_store lease runtime'
+
+
+class JobServices(namedtuple('JobServices', JOB_SERVICES)):
+    """The caches and stores the jobs share, the lease on their project, and the `aio.Runtime` to
+    poll GitLab on; any may be `None`.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def none(cls):
+        return cls(
+            user_cache=None, project_cache=None, job_state=None, latency_store=None, lease=None,
+            runtime=None,
         )
 
 
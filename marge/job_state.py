@@ -0,0 +1,149 @@
+"""
+Durable record of the merge work in flight, so a restarted marge-bot can pick it up.
+
+For an MR merged on its own we record the target branch sha it was rebased on and the sha
+we pushed; for a batch, its batch MR and the shas of the MRs in it. If on restart these still
+match what GitLab has, the push (and the CI pipeline it started) is still good to use.
+"""
+import logging as log
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+
+PUSHED = 'pushed'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS merge_requests (
+    project_id INTEGER NOT NULL,
+    iid INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    target_sha TEXT NOT NULL,
+    pushed_sha TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (project_id, iid)
+);
+CREATE TABLE IF NOT EXISTS batches (
+    project_id INTEGER NOT NULL,
+    target_branch TEXT NOT NULL,
+    batch_mr_iid INTEGER NOT NULL,
+    batch_sha TEXT NOT NULL,
+    target_sha TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (project_id, target_branch)
+);
+CREATE TABLE IF NOT EXISTS batch_members (
+    project_id INTEGER NOT NULL,
+    target_branch TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    iid INTEGER NOT NULL,
+    sha TEXT NOT NULL,
+    PRIMARY KEY (project_id, target_branch, position)
+);
+'''
+
+
+class MergeRequestState(namedtuple('MergeRequestState',
+                                   'project_id iid phase target_sha pushed_sha updated_at')):
+    __slots__ = ()
+
+
+class BatchState(namedtuple('BatchState',
+                            'project_id target_branch batch_mr_iid batch_sha target_sha members')):
+    """`members` are the `(iid, sha)` of the MRs in the batch, in the order they were added."""
+    __slots__ = ()
+
+
+class JobStateStore:
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        # Batch jobs wait on CI from several threads, so the connection is shared behind the lock
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def merge_request_state(self, project_id, iid):
+        row = self._fetch_one(
+            'SELECT project_id, iid, phase, target_sha, pushed_sha, updated_at FROM merge_requests '
+            'WHERE project_id = ? AND iid = ?',
+            (project_id, iid),
+        )
+        return MergeRequestState(*row) if row else None
+
+    def record_push(self, project_id, iid, target_sha, pushed_sha):
+        log.debug('Recording push of %s for MR !%s of project %s', pushed_sha, iid, project_id)
+        self._execute([(
+            'INSERT OR REPLACE INTO merge_requests VALUES (?, ?, ?, ?, ?, ?)',
+            (project_id, iid, PUSHED, target_sha, pushed_sha, time.time()),
+        )])
+
+    def forget_merge_request(self, project_id, iid):
+        self._execute([(
+            'DELETE FROM merge_requests WHERE project_id = ? AND iid = ?', (project_id, iid),
+        )])
+
+    def batch_state(self, project_id, target_branch):
+        row = self._fetch_one(
+            'SELECT batch_mr_iid, batch_sha, target_sha FROM batches '
+            'WHERE project_id = ? AND target_branch = ?',
+            (project_id, target_branch),
+        )
+        if not row:
+            return None
+        with self._lock:
+            members = self._connection.execute(
+                'SELECT iid, sha FROM batch_members WHERE project_id = ? AND target_branch = ? '
+                'ORDER BY position',
+                (project_id, target_branch),
+            ).fetchall()
+        return BatchState(project_id, target_branch, *row, members=[tuple(member) for member in members])
+
+    def record_batch(self, project_id, target_branch, batch_mr_iid, batch_sha, target_sha, members):
+        """Record a pushed batch; `members` are the `(iid, sha)` of its MRs."""
+        log.debug('Recording batch MR !%s of project %s for %s', batch_mr_iid, project_id, target_branch)
+        statements = self._forget_batch_statements(project_id, target_branch)
+        statements.append((
+            'INSERT INTO batches VALUES (?, ?, ?, ?, ?, ?)',
+            (project_id, target_branch, batch_mr_iid, batch_sha, target_sha, time.time()),
+        ))
+        statements.extend(
+            (
+                'INSERT INTO batch_members VALUES (?, ?, ?, ?, ?)',
+                (project_id, target_branch, position, iid, sha),
+            )
+            for position, (iid, sha) in enumerate(members)
+        )
+        self._execute(statements)
+
+    def forget_batch(self, project_id, target_branch):
+        self._execute(self._forget_batch_statements(project_id, target_branch))
+
+    @staticmethod
+    def _forget_batch_statements(project_id, target_branch):
+        return [
+            ('DELETE FROM %s WHERE project_id = ? AND target_branch = ?' % table, (project_id, target_branch))
+            for table in ('batches', 'batch_members')
+        ]
+
+    def _fetch_one(self, query, params):
+        with self._lock:
+            return self._connection.execute(query, params).fetchone()
+
+    def _execute(self, statements):
+        """Run `statements` in a single transaction."""
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                for query, params in statements:
+                    self._connection.execute(query, params)
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
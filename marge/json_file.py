@@ -0,0 +1,25 @@
+"""
+State kept in small JSON files, such as the user cache and the batch history.
+"""
+import json
+import logging as log
+import os
+import tempfile
+
+
+def load(path, what):
+    """Return what the JSON file at `path` holds, or `None` if it can't be read: `what` it is gets logged."""
+    try:
+        with open(path, encoding='utf-8') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError) as err:
+        log.warning('Ignoring unreadable %s %s: %s', what, path, err)
+        return None
+
+
+def save(path, content):
+    """Write `content` to the JSON file at `path`, replacing it at once so that it is never half-written."""
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, delete=False) as tmp_file:
+        json.dump(content, tmp_file)
+    os.replace(tmp_file.name, path)
@@ -0,0 +1,199 @@
+"""
+Where the time to merge an MR goes.
+
+For each MR a job works on, we store how long it had been queued since we first saw it
+assigned to us, and the timeline of the job's phases (rebase, push, CI, merge status,
+approvals, accept...). `report` turns that history into percentiles per project and phase.
+The history older than the store's `max_age` is dropped as new jobs are recorded.
+"""
+import logging as log
+import sqlite3
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+
+QUEUED = 'queued'
+TOTAL = 'total'
+MERGED = 'merged'
+
+PERCENTILES = (50, 90, 99)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS seen (
+    project_id INTEGER NOT NULL,
+    iid INTEGER NOT NULL,
+    seen_at REAL NOT NULL,
+    PRIMARY KEY (project_id, iid)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_id INTEGER NOT NULL,
+    project TEXT NOT NULL,
+    iid INTEGER NOT NULL,
+    job TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    queued_at REAL NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    job_id INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);
+CREATE INDEX IF NOT EXISTS phases_job_id ON phases (job_id);
+'''
+
+
+class PhaseStats(namedtuple('PhaseStats', 'project phase count percentiles')):
+    """`percentiles` maps each of `PERCENTILES` to seconds."""
+    __slots__ = ()
+
+
+class LatencyStore:
+
+    def __init__(self, path, max_age=None):
+        """Keep the jobs that finished, and the MRs we saw, less than `max_age` seconds ago, or all."""
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def mark_seen(self, project_id, iids, now=None):
+        """Note that the MRs `iids` are waiting for us, unless we already knew."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO seen VALUES (?, ?, ?)', [(project_id, iid, now) for iid in iids],
+            )
+
+    def record(self, *, project_id, project, iid, job, outcome, started_at, finished_at, phases):
+        """Record a job's work on an MR; `phases` are the `(name, started_at, seconds)` of its phases.
+
+        The MR counts as queued from when we first saw it (or since our previous job on it) until
+        `started_at`.
+        """
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                row = self._connection.execute(
+                    'SELECT seen_at FROM seen WHERE project_id = ? AND iid = ?', (project_id, iid),
+                ).fetchone()
+                queued_at = min(row[0], started_at) if row else started_at
+                job_id = self._connection.execute(
+                    'INSERT INTO jobs '
+                    '(project_id, project, iid, job, outcome, queued_at, started_at, finished_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (project_id, project, iid, job, outcome, queued_at, started_at, finished_at),
+                ).lastrowid
+                self._connection.executemany(
+                    'INSERT INTO phases VALUES (?, ?, ?, ?)',
+                    [(job_id, QUEUED, queued_at, started_at - queued_at)] +
+                    [(job_id, name, phase_started_at, seconds) for name, phase_started_at, seconds in phases],
+                )
+                # if the MR comes back to us, it queues anew
+                self._connection.execute(
+                    'DELETE FROM seen WHERE project_id = ? AND iid = ?', (project_id, iid),
+                )
+                if self._max_age is not None:
+                    self._prune(finished_at - self._max_age)
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+        log.debug('Recorded latency of MR !%s of %s: %s after %.0fs queued', iid, project, outcome,
+                  started_at - queued_at)
+
+    def _prune(self, before):
+        self._connection.execute(
+            'DELETE FROM phases WHERE job_id IN (SELECT id FROM jobs WHERE finished_at < ?)', (before,),
+        )
+        self._connection.execute('DELETE FROM jobs WHERE finished_at < ?', (before,))
+        # the MRs we saw but never worked on, e.g. as they were unassigned from us
+        self._connection.execute('DELETE FROM seen WHERE seen_at < ?', (before,))
+
+    def durations(self, *, since=None, outcome=MERGED):
+        """Return {(project, phase): [seconds per job]} of the jobs with `outcome` finished after `since`.
+
+        Besides the phases, there is the `QUEUED` time and the `TOTAL` time from queued to finished.
+        """
+        since = 0 if since is None else since
+        with self._lock:
+            jobs = self._connection.execute(
+                'SELECT id, project, finished_at - queued_at FROM jobs '
+                'WHERE finished_at >= ? AND outcome = ?',
+                (since, outcome),
+            ).fetchall()
+            phases = self._connection.execute(
+                'SELECT phases.job_id, phases.phase, SUM(phases.seconds) FROM phases '
+                'JOIN jobs ON jobs.id = phases.job_id WHERE jobs.finished_at >= ? AND jobs.outcome = ? '
+                'GROUP BY phases.job_id, phases.phase',
+                (since, outcome),
+            ).fetchall()
+
+        projects = {job_id: project for job_id, project, _ in jobs}
+        durations = defaultdict(list)
+        for _, project, total in jobs:
+            durations[(project, TOTAL)].append(total)
+        for job_id, phase, seconds in phases:
+            durations[(projects[job_id], phase)].append(seconds)
+        return dict(durations)
+
+
+def percentile(sorted_values, point):
+    """The nearest-rank `point`th percentile of the non-empty `sorted_values`."""
+    rank = max(1, -(-point * len(sorted_values) // 100))  # ceil without floats
+    return sorted_values[rank - 1]
+
+
+def stats(durations):
+    """Turn the output of `LatencyStore.durations` into `PhaseStats`, sorted by project."""
+    def sort_key(key):
+        project, phase = key
+        # the total last, after the phases
+        return project, phase == TOTAL, phase != QUEUED, phase
+
+    result = []
+    for project, phase in sorted(durations, key=sort_key):
+        values = sorted(durations[(project, phase)])
+        result.append(PhaseStats(
+            project=project,
+            phase=phase,
+            count=len(values),
+            percentiles={point: percentile(values, point) for point in PERCENTILES},
+        ))
+    return result
+
+
+def report(store, since=None, outcome=MERGED):
+    """A table of the percentiles of the time spent in each phase, per project."""
+    phase_stats = stats(store.durations(since=since, outcome=outcome))
+    if not phase_stats:
+        return 'No {} merge requests recorded.\n'.format(outcome)
+
+    project_width = max(len('project'), max(len(item.project) for item in phase_stats))
+    phase_width = max(len('phase'), max(len(item.phase) for item in phase_stats))
+    row_format = '{:<%d}  {:<%d}  {:>6}' % (project_width, phase_width) + '  {:>9}' * len(PERCENTILES)
+    lines = [row_format.format('project', 'phase', 'count', *('p%d' % point for point in PERCENTILES))]
+    for item in phase_stats:
+        lines.append(row_format.format(
+            item.project, item.phase, item.count,
+            *(_format_seconds(item.percentiles[point]) for point in PERCENTILES)
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+def _format_seconds(seconds):
+    if seconds < 60:
+        return '{:.1f}s'.format(seconds)
+    if seconds < 3600:
+        return '{:.1f}min'.format(seconds / 60)
+    return '{:.1f}h'.format(seconds / 3600)
@@ -0,0 +1,139 @@
+"""
+Leases on projects, so that several marge-bot processes can share them without racing.
+
+Jobs force-push MR branches and the shared batch branch, so only one process may work on a
+project at a time. A process takes a lease on a project, in a lock file of a directory shared
+by all of them, before starting a job on it, and renews it in the background while the job
+runs. A lease that is not renewed expires, so the projects of a process that died are taken
+over once their leases run out; the job of a process that lost its lease stops before its
+next push.
+"""
+import contextlib
+import fcntl
+import json
+import logging as log
+import os
+import threading
+import time
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Lease:
+
+    def __init__(self, manager, project_id, expires_at):
+        self.project_id = project_id
+        self.expires_at = expires_at
+        self.lost = False
+        self._manager = manager
+
+    def check(self):
+        """Raise `LeaseLost` if another process took the project over."""
+        if self.lost or time.time() >= self.expires_at:
+            raise LeaseLost('Lost the lease on project %s' % self.project_id)
+
+    def renew(self):
+        self._manager.renew(self)
+
+    def release(self):
+        self._manager.release(self)
+
+
+class LeaseManager:
+
+    def __init__(self, lock_dir, owner, ttl):
+        self.owner = owner
+        self._lock_dir = lock_dir
+        self._ttl = ttl
+        self._leases = {}  # project_id -> the Lease we hold on it
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._renewal_thread = None
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def start(self):
+        """Keep renewing our leases in the background until `stop()`."""
+        self._renewal_thread = threading.Thread(target=self._keep_renewing, name='lease-renewal')
+        self._renewal_thread.daemon = True
+        self._renewal_thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._renewal_thread is not None:
+            self._renewal_thread.join()
+        with self._lock:
+            leases = list(self._leases.values())
+        for lease in leases:
+            lease.release()
+
+    def acquire(self, project_id):
+        """Take the lease on `project_id`; return it, or `None` if another process holds it."""
+        now = time.time()
+        with self._locked_file(project_id) as lock_file:
+            holder = _read(lock_file)
+            if holder and holder['owner'] != self.owner and holder['expires_at'] > now:
+                log.info('Project %s is leased to %s for %.0fs more', project_id, holder['owner'],
+                         holder['expires_at'] - now)
+                return None
+            lease = Lease(self, project_id, now + self._ttl)
+            _write(lock_file, self.owner, lease.expires_at)
+        with self._lock:
+            self._leases[project_id] = lease
+        return lease
+
+    def renew(self, lease):
+        now = time.time()
+        with self._locked_file(lease.project_id) as lock_file:
+            holder = _read(lock_file)
+            if lease.lost or not holder or holder['owner'] != self.owner or holder['expires_at'] <= now:
+                log.error('Lost the lease on project %s to %s', lease.project_id, holder and holder['owner'])
+                lease.lost = True
+                return
+            lease.expires_at = now + self._ttl
+            _write(lock_file, self.owner, lease.expires_at)
+
+    def release(self, lease):
+        with self._lock:
+            self._leases.pop(lease.project_id, None)
+        if lease.lost:
+            return
+        with self._locked_file(lease.project_id) as lock_file:
+            holder = _read(lock_file)
+            if holder and holder['owner'] == self.owner:
+                _write(lock_file, self.owner, 0)
+        lease.lost = True
+
+    def _keep_renewing(self):
+        while not self._stopped.wait(self._ttl / 3):
+            with self._lock:
+                leases = list(self._leases.values())
+            for lease in leases:
+                try:
+                    lease.renew()
+                except OSError:
+                    log.exception('Failed to renew the lease on project %s', lease.project_id)
+
+    @contextlib.contextmanager
+    def _locked_file(self, project_id):
+        """Open the lock file of `project_id`, holding an exclusive `flock` on it."""
+        path = os.path.join(self._lock_dir, 'project-{}.lease'.format(project_id))
+        with open(path, 'a+', encoding='utf-8') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield lock_file  # closing it releases the flock
+
+
+def _read(lock_file):
+    lock_file.seek(0)
+    try:
+        return json.loads(lock_file.read())
+    except ValueError:  # a new file, or one a crashed process left half written
+        return None
+
+
+def _write(lock_file, owner, expires_at):
+    lock_file.seek(0)
+    lock_file.truncate()
+    json.dump({'owner': owner, 'expires_at': expires_at}, lock_file)
+    lock_file.flush()
@@ -0,0 +1,140 @@
+"""
+Graceful shutdown on SIGTERM, a dump of what marge-bot is up to on SIGUSR1, and profiling on SIGUSR2.
+
+On SIGTERM we don't stop wherever we are, which could be in the middle of a push: we only
+raise `ShutdownRequested` where it is safe to, i.e. when a job is about to start a new phase
+or is polling GitLab, and while the bot sleeps. What was pushed is in the job state file, if
+any, for the next instance to pick up. A second SIGTERM kills the bot straight away.
+"""
+import contextlib
+import logging as log
+import os
+import signal
+import sys
+import threading
+import traceback
+from datetime import datetime
+
+from . import profiling
+
+_stopping = threading.Event()
+_interruptible = threading.local()
+
+
+class ShutdownRequested(BaseException):
+    """Raised where a job can stop once we were asked to shut down.
+
+    It is a `BaseException`, like `SystemExit`, so that the handlers of job errors (which
+    comment on and unassign the merge requests) let it through.
+    """
+
+
+def stopping():
+    return _stopping.is_set()
+
+
+def request_stop():
+    """Ask the bot to shut down, as SIGTERM does, for when it runs off the main thread."""
+    _stopping.set()
+
+
+def check():
+    """Raise `ShutdownRequested` if we were asked to shut down."""
+    if _stopping.is_set():
+        raise ShutdownRequested()
+
+
+@contextlib.contextmanager
+def interruptible():
+    """Let SIGTERM interrupt the block (say, a sleep) of the main thread right away."""
+    check()
+    _interruptible.active = True
+    try:
+        yield
+    finally:
+        _interruptible.active = False
+
+
+class JobRegistry:
+    """The jobs running at the moment, to report on in state dumps."""
+
+    def __init__(self):
+        self._jobs = set()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def running(self, job):
+        with self._lock:
+            self._jobs.add(job)
+        try:
+            yield job
+        finally:
+            with self._lock:
+                self._jobs.discard(job)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+
+def dump_state(registry, out=None):
+    """Describe the running jobs and the stack of each thread; write it to `out` or log it."""
+    lines = ['State of marge-bot at {}:'.format(datetime.utcnow().isoformat())]
+    jobs = registry.jobs()
+    if not jobs:
+        lines.append('No jobs running.')
+    for job in jobs:
+        status = job.status()
+        lines.append('{job} on {project}, merge requests {iids}:'.format(
+            job=status['job'], project=status['project'],
+            iids=', '.join('!{}'.format(iid) for iid in status['merge_requests']),
+        ))
+        for name, seconds in status['phases']:
+            lines.append('  in phase {!r} for {:.0f}s'.format(name, seconds))
+        for what, seconds in status['waiting_on']:
+            lines.append('  waiting on {} for {:.0f}s'.format(what, seconds))
+    threads = {thread.ident: thread.name for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+        lines.append('Thread {} ({}):'.format(threads.get(ident, '?'), ident))
+        lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+    text = '\n'.join(lines)
+    if out is None:
+        log.info('%s', text)
+    else:
+        out.write(text + '\n')
+
+
+@contextlib.contextmanager
+def signal_handlers(registry):
+    """Handle SIGTERM, SIGUSR1 and SIGUSR2 in the block, if it runs on the main thread (only it can)."""
+    if threading.current_thread() is not threading.main_thread():
+        log.debug('Not on the main thread, leaving signals be')
+        yield
+        return
+
+    def on_sigterm(signum, _frame):
+        if _stopping.is_set():
+            log.warning('Got signal %s again, exiting now', signum)
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+        log.warning('Got signal %s, shutting down once the current phase is done...', signum)
+        _stopping.set()
+        if getattr(_interruptible, 'active', False):
+            raise ShutdownRequested()
+
+    def on_sigusr1(_signum, _frame):
+        dump_state(registry)
+
+    def on_sigusr2(_signum, _frame):
+        profiling.PROFILER.toggle()
+
+    previous = {
+        signal.SIGTERM: signal.signal(signal.SIGTERM, on_sigterm),
+        signal.SIGUSR1: signal.signal(signal.SIGUSR1, on_sigusr1),
+        signal.SIGUSR2: signal.signal(signal.SIGUSR2, on_sigusr2),
+    }
+    try:
+        yield
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
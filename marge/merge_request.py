@@ -238,3 +238,12 @@ class MergeRequest(gitlab.Resource):
 
 class MergeRequestRebaseFailed(Exception):
     pass
+
+
+def fetch_project_ids_assigned_to(user, api):
+    """Return the ids of the projects with open MRs assigned to `user`, in a single listing."""
+    merge_request_infos = api.collect_all_pages(GET(
+        '/merge_requests',
+        {'state': 'opened', 'scope': 'all', 'assignee_id': user.id},
+    ))
+    return {merge_request_info['project_id'] for merge_request_info in merge_request_infos}
@@ -0,0 +1,290 @@
+"""
+Metrics of the bot's work, served over HTTP in the Prometheus text format.
+
+The metrics are always collected (it is just a few dict updates), and only served if
+`start_http_server` is called, which `--metrics-port` does. The same server profiles the bot
+on `/debug/profile?seconds=N&format=collapsed|speedscope`.
+"""
+import logging as log
+import re
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+from . import profiling
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+MAX_PROFILE_SECONDS = 600
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # tuple of label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} needs labels {}, got {}'.format(self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def remove(self, **labels):
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, _escape_help(self.documentation)),
+            '# TYPE {} {}'.format(self.name, self.TYPE),
+        ]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(dict(zip(self.labelnames, key)), value))
+        return lines
+
+    def _samples(self, labels, value):
+        return [_sample(self.name, labels, value)]
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels)) or ([], 0)
+            return sum(counts)
+
+    def _samples(self, labels, value):
+        counts, total = value
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(_sample(self.name + '_bucket', dict(labels, le=_format_value(bound)), cumulative))
+        samples.append(_sample(self.name + '_sum', labels, total))
+        samples.append(_sample(self.name + '_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        assert all(other.name != metric.name for other in self._metrics), metric.name
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'marge_queue_depth', 'Merge requests assigned to the bot and waiting to be merged.', ['project'],
+))
+TIME_TO_MERGE = REGISTRY.register(Histogram(
+    'marge_time_to_merge_seconds', 'Time from opening a merge request to merging it.', ['project'],
+))
+JOB_PHASE_DURATION = REGISTRY.register(Histogram(
+    'marge_job_phase_duration_seconds', 'Time spent in each phase of the merge jobs.', ['job', 'phase'],
+))
+JOB_PHASE_CPU_DURATION = REGISTRY.register(Histogram(
+    'marge_job_phase_cpu_seconds', 'CPU time the thread of a job spent in each phase.', ['job', 'phase'],
+))
+API_REQUESTS = REGISTRY.register(Counter(
+    'marge_api_requests_total', 'GitLab API requests made.', ['method', 'endpoint', 'status'],
+))
+API_REQUEST_DURATION = REGISTRY.register(Histogram(
+    'marge_api_request_duration_seconds', 'Latency of the GitLab API requests.', ['method', 'endpoint'],
+))
+GIT_COMMAND_DURATION = REGISTRY.register(Histogram(
+    'marge_git_command_duration_seconds', 'Time taken by the git subprocesses.', ['command', 'status'],
+))
+GIT_OPERATIONS = REGISTRY.register(Gauge(
+    'marge_git_operations',
+    'git operations on the git pool, running (one per repo at most) or waiting for their repo.',
+    ['state'],
+))
+PREWARMED_REPOS_SIZE = REGISTRY.register(Gauge(
+    'marge_prewarmed_repos_bytes', 'Disk space taken by the repos cloned ahead of time, with --prewarm.',
+))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    'marge_batch_size', 'Merge requests in the batches tested.',
+    buckets=(2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50),
+))
+BATCHES = REGISTRY.register(Counter(
+    'marge_batches_total', 'Batches tested, by outcome.', ['outcome'],
+))
+BATCH_TARGET_SIZE = REGISTRY.register(Gauge(
+    'marge_batch_target_size', 'The size the batch sizer last picked for the batches of a target branch.',
+    ['project_id', 'target_branch'],
+))
+BATCH_MR_PASS_RATE = REGISTRY.register(Gauge(
+    'marge_batch_mr_pass_rate',
+    'The estimated probability that a single MR to a target branch passes CI, which batch sizes rest on.',
+    ['project_id', 'target_branch'],
+))
+SCHEDULER_QUEUED = REGISTRY.register(Gauge(
+    'marge_scheduler_queued', 'Merge requests queued by the priority scheduler, per priority class.',
+    ['priority_class'],
+))
+SCHEDULER_LONGEST_WAIT = REGISTRY.register(Gauge(
+    'marge_scheduler_longest_wait_seconds', 'How long the longest waiting queued merge request has waited.',
+    ['priority_class'],
+))
+SCHEDULER_DISPATCH_WAIT = REGISTRY.register(Histogram(
+    'marge_scheduler_dispatch_wait_seconds', 'How long merge requests waited before the bot got to them.',
+    ['priority_class'], buckets=(10, 60, 300, 900, 1800, 3600, 7200, 14400, 43200, 86400),
+))
+SCHEDULER_EXPECTED_JOB_DURATION = REGISTRY.register(Gauge(
+    'marge_scheduler_expected_job_seconds', 'How long the scheduler expects a job in a project to take.',
+    ['project_id'],
+))
+CYCLE_DURATION = REGISTRY.register(Histogram(
+    'marge_cycle_duration_seconds',
+    'Time taken by a cycle over all the projects, not counting the sleep after it.',
+))
+
+
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+# What follows these is a branch name, a sha or a file path
+_NAME_SEGMENT = re.compile(r'/repository/(branches|commits|files)/.*$')
+
+
+def endpoint_label(endpoint):
+    """`endpoint` with the ids and names in it replaced, to keep the number of label values small."""
+    endpoint = endpoint.split('?', 1)[0]
+    endpoint = _NAME_SEGMENT.sub(r'/repository/\1/:name', endpoint)
+    return _ID_SEGMENT.sub('/:id', endpoint)
+
+
+def start_http_server(port, addr='', registry=REGISTRY):
+    """Serve `registry` on `/metrics`, and profiles on `/debug/profile`, from a daemon thread.
+
+    Return the server.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            path, _, query = self.path.partition('?')
+            if path == '/metrics':
+                self._send(registry.render(), CONTENT_TYPE)
+            elif path == '/debug/profile':
+                self._profile(parse_qs(query))
+            else:
+                self.send_error(404)
+
+        def _profile(self, params):
+            try:
+                seconds = float(params.get('seconds', ['30'])[0])
+                output_format = params.get('format', [profiling.COLLAPSED])[0]
+            except ValueError:
+                self.send_error(400, 'seconds must be a number')
+                return
+            if not 0 < seconds <= MAX_PROFILE_SECONDS or output_format not in profiling.FORMATS:
+                self.send_error(400, 'Need 0 < seconds <= {} and format in {}'.format(
+                    MAX_PROFILE_SECONDS, ', '.join(profiling.FORMATS),
+                ))
+                return
+            profile = profiling.PROFILER.profile(seconds)
+            if profile is None:
+                self.send_error(409, 'Already profiling')
+                return
+            content_type = 'application/json' if output_format == profiling.SPEEDSCOPE else 'text/plain'
+            self._send(profile.render(output_format), content_type + '; charset=utf-8')
+
+        def _send(self, text, content_type):
+            body = text.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            log.debug('Metrics request: ' + format, *args)
+
+    server = _ThreadingHTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    log.info('Serving metrics on port %s', server.server_address[1])
+    return server
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join(
+            '{}="{}"'.format(label, _escape_label_value(label_value)) for label, label_value in labels.items()
+        )
+    return '{} {}'.format(name, _format_value(value))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape_help(text):
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _escape_label_value(text):
+    return _escape_help(text).replace('"', r'\"')
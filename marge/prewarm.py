@@ -0,0 +1,132 @@
+"""
+Clone the repos of the projects likely to get merge requests before they do.
+
+The first job in a project otherwise waits for the clone of its repo, which takes minutes for
+a big one. Between cycles, the prewarmer picks the projects that are likely to get work: those
+in its allowlist first, then those active lately (pushes, merge requests...), most recent first.
+It clones their repos on the git pool, and fetches them again every so often, so that the first
+job finds them warm. It runs a few clones and fetches at a time at most, so that the jobs get
+the pool first, and stops cloning once its repos take up its disk budget: then, it removes the
+repos of the projects it no longer picks, least recently fetched first.
+"""
+import logging as log
+import os
+import shutil
+import time
+from collections import namedtuple
+
+from . import gitlab
+from . import metrics
+
+
+class WarmRepo(namedtuple('WarmRepo', 'project repo fetched_at size')):
+    __slots__ = ()
+
+
+class Prewarmer:
+
+    def __init__(
+            self, repo_manager, git_pool, *,
+            allowlist=None, active_within=3600, concurrency=2, disk_budget=10 * 2 ** 30, refresh_interval=600,
+    ):
+        """`allowlist` is a regexp of the paths of the projects to keep warm regardless of their
+        activity; `disk_budget` is in bytes, other durations in seconds.
+        """
+        self._repo_manager = repo_manager
+        self._git_pool = git_pool
+        self._allowlist = allowlist
+        self._active_within = active_within
+        self._concurrency = concurrency
+        self._disk_budget = disk_budget
+        self._refresh_interval = refresh_interval
+        self._warm = {}  # project_id -> WarmRepo, for the repos we cloned
+        self._in_flight = {}  # project_id -> (project, Future of the clone or fetch we started)
+        self._failed = {}  # project_id -> when we last failed to clone or fetch its repo
+
+    def update(self, projects):
+        """Start warming up the repos of the likeliest of `projects` to get work, within our limits.
+
+        Call it between cycles, when no job is running: it may remove repos.
+        """
+        now = time.time()
+        self._collect(now)
+        candidates = self._candidates(projects, now)
+        self._evict({project.id for project in candidates})
+        for project in candidates:
+            if len(self._in_flight) >= self._concurrency:
+                break
+            recently_failed = now - self._failed.get(project.id, 0) < self._refresh_interval
+            if project.id in self._in_flight or recently_failed:
+                continue
+            warm = self._warm.get(project.id)
+            if warm is not None:
+                if now - warm.fetched_at >= self._refresh_interval:
+                    log.info('Prewarming: fetching %s', project.path_with_namespace)
+                    self._in_flight[project.id] = project, warm.repo.submit('fetch', 'origin')
+            elif self.disk_usage() < self._disk_budget:
+                future = self._repo_manager.repo_future(project)
+                if not future.done():  # else a job cloned it, and keeps it up to date
+                    log.info('Prewarming: cloning %s', project.path_with_namespace)
+                    self._in_flight[project.id] = project, future
+
+    def disk_usage(self):
+        return sum(warm.size for warm in self._warm.values())
+
+    def _collect(self, now):
+        """Take note of the clones and fetches that finished."""
+        for project_id, (project, future) in list(self._in_flight.items()):
+            if not future.done():
+                continue
+            del self._in_flight[project_id]
+            error = future.exception()
+            if error is not None:
+                log.warning('Prewarming: failed to update the repo of %s: %s',
+                            project.path_with_namespace, error)
+                self._failed[project_id] = now
+                if project_id not in self._warm:
+                    self._repo_manager.forget_repo(project)  # the next job clones it again
+                continue
+            repo = self._warm[project_id].repo if project_id in self._warm else future.result()
+            self._warm[project_id] = WarmRepo(project, repo, now, _disk_usage(repo.local_path))
+        metrics.PREWARMED_REPOS_SIZE.set(self.disk_usage())
+
+    def _candidates(self, projects, now):
+        allowed, active = [], []
+        for project in projects:
+            if self._allowlist is not None and self._allowlist.match(project.path_with_namespace):
+                allowed.append(project)
+                continue
+            active_at = gitlab.timestamp(project.info.get('last_activity_at'))
+            if active_at is not None and now - active_at <= self._active_within:
+                active.append((active_at, project))
+        active.sort(key=lambda item: -item[0])
+        return allowed + [project for _, project in active]
+
+    def _evict(self, candidate_ids):
+        evictable = sorted(
+            (warm for warm in self._warm.values()
+             if warm.project.id not in candidate_ids and warm.project.id not in self._in_flight),
+            key=lambda warm: warm.fetched_at,
+        )
+        while evictable and self.disk_usage() >= self._disk_budget:
+            warm = evictable.pop(0)
+            log.info('Prewarming: removing the repo of %s, to stay within the disk budget',
+                     warm.project.path_with_namespace)
+            del self._warm[warm.project.id]
+            self._repo_manager.forget_repo(warm.project)
+            # after whatever else is queued on the repo
+            local_path = warm.repo.local_path
+            self._git_pool.submit(local_path, shutil.rmtree, local_path, ignore_errors=True)
+
+
+def _disk_usage(path):
+    """The bytes the files under `path` take on disk."""
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                stat = os.lstat(os.path.join(dir_path, file_name))
+            except OSError:
+                continue
+            total += stat.st_blocks * 512
+    return total
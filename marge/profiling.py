@@ -0,0 +1,201 @@
+"""
+A sampling profiler, to find out live where the time of the bot goes.
+
+While it runs, a thread takes the stacks of all the other threads every `interval` seconds.
+The samples can be written in the collapsed stack format (one `thread;frame;...;frame count`
+line per stack, for flamegraph.pl and the like) or as a speedscope profile. Meanwhile, the
+phases of the jobs report their wall and CPU time, which tells Python overhead apart from
+waiting on GitLab or git.
+"""
+import collections
+import json
+import logging as log
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+COLLAPSED = 'collapsed'
+SPEEDSCOPE = 'speedscope'
+FORMATS = (COLLAPSED, SPEEDSCOPE)
+
+_EXTENSIONS = {COLLAPSED: 'folded', SPEEDSCOPE: 'speedscope.json'}
+
+
+class Profile:
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.started_at = time.time()
+        self.duration = None
+        self.samples = collections.Counter()  # (thread name, frame, ..., frame), root first -> count
+        # phase name -> [count, wall seconds, cpu seconds], for the phases that ended meanwhile
+        self.phases = collections.defaultdict(lambda: [0, 0.0, 0.0])
+
+    def collapsed(self):
+        return ''.join(
+            '{} {}\n'.format(';'.join(stack), count) for stack, count in sorted(self.samples.items())
+        )
+
+    def speedscope(self):
+        frames = {}
+        by_thread = collections.defaultdict(list)
+        for (thread, *stack), count in sorted(self.samples.items()):
+            indexes = [frames.setdefault(frame, len(frames)) for frame in stack]
+            by_thread[thread].append((indexes, count))
+        profiles = []
+        for thread, samples in sorted(by_thread.items()):
+            total = sum(count for _, count in samples) * self.interval
+            profiles.append({
+                'type': 'sampled',
+                'name': thread,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': total,
+                'samples': [indexes for indexes, _ in samples],
+                'weights': [count * self.interval for _, count in samples],
+            })
+        return json.dumps({
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': 'marge-bot {}'.format(datetime.utcfromtimestamp(self.started_at).isoformat()),
+            'exporter': 'marge-bot',
+            'shared': {'frames': [{'name': frame} for frame in frames]},
+            'profiles': profiles,
+        })
+
+    def render(self, output_format):
+        return self.speedscope() if output_format == SPEEDSCOPE else self.collapsed()
+
+    def phase_report(self):
+        lines = ['{:<20} {:>6} {:>10} {:>10} {:>6}'.format('phase', 'count', 'wall (s)', 'cpu (s)', 'cpu %')]
+        for name, (count, wall, cpu) in sorted(self.phases.items(), key=lambda item: -item[1][1]):
+            lines.append('{:<20} {:>6} {:>10.2f} {:>10.2f} {:>5.0f}%'.format(
+                name, count, wall, cpu, 100 * cpu / wall if wall else 0,
+            ))
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+    """Profile for `duration` seconds at most, or until stopped, one profile at a time."""
+
+    def __init__(self, interval=0.01, duration=60, output_dir=None, output_format=COLLAPSED):
+        self.interval = interval
+        self.duration = duration
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self._lock = threading.Lock()
+        self._profile = None
+        self._stopped = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self, duration=None):
+        """Start profiling in the background; return False if we already are."""
+        return self._start(duration) is not None
+
+    def _start(self, duration):
+        duration = duration or self.duration
+        with self._lock:
+            if self._profile is not None:
+                return None
+            self._profile = Profile(self.interval)
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(
+                target=self._sample, args=(self._profile, self._stopped, duration),
+                name='profiler', daemon=True,
+            )
+            self._thread.start()
+            started = self._profile, self._thread
+        log.info('Profiling for up to %ss...', duration)
+        return started
+
+    def stop(self):
+        """Stop profiling and return the profile (`None` if we weren't), after writing it out."""
+        return self._stop()
+
+    def _stop(self, own_profile=None):
+        """Stop the running profile, only if it is `own_profile` when given."""
+        with self._lock:
+            profile, stopped, thread = self._profile, self._stopped, self._thread
+            if profile is None or own_profile not in (None, profile):
+                return None
+            stopped.set()
+            self._profile = None
+        if thread is not threading.current_thread():
+            thread.join()
+        self._write(profile)
+        return profile
+
+    def toggle(self):
+        if not self.start():
+            self.stop()
+
+    def profile(self, duration):
+        """Profile for `duration` seconds and return the profile; `None` if a profile is running."""
+        started = self._start(duration)
+        if started is None:
+            return None
+        profile, thread = started
+        thread.join()  # it stops on its own after `duration`
+        return profile
+
+    def record_phase(self, name, wall, cpu):
+        with self._lock:
+            if self._profile is not None:
+                totals = self._profile.phases[name]
+                totals[0] += 1
+                totals[1] += wall
+                totals[2] += cpu
+
+    def _sample(self, profile, stopped, duration):
+        own_ident = threading.get_ident()
+        time_0 = time.monotonic()
+        while not stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident != own_ident:
+                    profile.samples[(names.get(ident, str(ident)),) + _stack(frame)] += 1
+            if time.monotonic() - time_0 >= duration:
+                break
+        profile.duration = time.monotonic() - time_0
+        if not stopped.is_set():
+            self._stop(profile)  # unless it was stopped meanwhile, and maybe another one started
+
+    def _write(self, profile):
+        log.info('Profiled %s samples over %.1fs; time in job phases:\n%s',
+                 sum(profile.samples.values()), profile.duration or 0, profile.phase_report())
+        if self.output_dir is None:
+            return
+        started_at = datetime.utcfromtimestamp(profile.started_at)
+        stem = os.path.join(self.output_dir, 'marge-profile-{:%Y%m%dT%H%M%S}'.format(started_at))
+        path = '{}.{}'.format(stem, _EXTENSIONS[self.output_format])
+        with open(path, 'w', encoding='utf-8') as out:
+            out.write(profile.render(self.output_format))
+        with open(stem + '.phases.txt', 'w', encoding='utf-8') as out:
+            out.write(profile.phase_report())
+        log.info('Wrote profile to %s', path)
+
+
+def _stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{} ({}:{})'.format(
+            code.co_name, os.path.basename(code.co_filename), code.co_firstlineno,
+        ))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+PROFILER = Profiler()
+
+
+def configure(duration, output_dir, output_format):
+    """Set how long the profiles toggled on last at most, and where and how to write them."""
+    PROFILER.duration = duration
+    PROFILER.output_dir = output_dir
+    PROFILER.output_format = output_format
@@ -1,4 +1,8 @@
 import logging as log
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from enum import IntEnum, unique
 from functools import partial
 
@@ -9,12 +13,19 @@ GET = gitlab.GET
 
 
 class Project(gitlab.Resource):
+    # What the bot looks at in project listings; the jobs get the full projects from `fetch_by_id`
+    COMPACT_FIELDS = (
+        'id', 'path_with_namespace', 'permissions', 'last_activity_at', 'ssh_url_to_repo', 'http_url_to_repo',
+    )
 
     @classmethod
     def fetch_by_id(cls, project_id, api):
         info = api.call(GET('/projects/%s' % project_id))
         return cls(api, info)
 
+    def fetch_info(self):
+        return self.api.call(GET('/projects/%s' % self.id))
+
     @classmethod
     def fetch_by_path(cls, project_path, api):
         def filter_by_path_with_namespace(projects):
@@ -26,7 +37,14 @@ class Project(gitlab.Resource):
         return gitlab.from_singleton_list(make_project)(filter_by_path_with_namespace(all_projects))
 
     @classmethod
-    def fetch_all_mine(cls, api):
+    def fetch_all_mine(cls, api, simple=False, last_activity_after=None, compact=False):
+        """Return the projects we can merge in.
+
+        With `simple`, GitLab leaves out most fields; use `fetch_by_id` for the full details.
+        With `last_activity_after` (a `datetime`), only the projects active since then are returned.
+        Both need GitLab 11.2+ and are ignored on older versions.
+        With `compact`, the projects only keep their `COMPACT_FIELDS` (see `Resource.compact`).
+        """
         projects_kwargs = {'membership': True,
                            'with_merge_requests_enabled': True,
                            'archived': False,
@@ -38,6 +56,11 @@ class Project(gitlab.Resource):
         use_min_access_level = api.version().release >= (11, 2)
         if use_min_access_level:
             projects_kwargs["min_access_level"] = int(AccessLevel.developer)
+            # simple listings don't include permissions, so we rely on `min_access_level` for those
+            if simple:
+                projects_kwargs['simple'] = True
+            if last_activity_after is not None:
+                projects_kwargs['last_activity_after'] = last_activity_after.isoformat()
 
         projects_info = api.collect_all_pages(GET(
             '/projects',
@@ -61,11 +84,14 @@ class Project(gitlab.Resource):
             if use_min_access_level:
                 # We know we fetched projects with at least developer access, so we'll use that as
                 # a fallback if GitLab doesn't correctly report permissions as described above.
-                project_info["permissions"]["marge"] = {"access_level": AccessLevel.developer}
+                permissions = project_info.setdefault(
+                    'permissions', {'project_access': None, 'group_access': None},
+                )
+                permissions["marge"] = {"access_level": AccessLevel.developer}
             elif not project_seems_ok(projects_info):
                 continue
 
-            projects.append(cls(api, project_info))
+            projects.append(cls.compact(api, project_info) if compact else cls(api, project_info))
 
         return projects
 
@@ -101,6 +127,11 @@ class Project(gitlab.Resource):
     def approvals_required(self):
         return self.info['approvals_before_merge']
 
+    @property
+    def merge_method(self):
+        """One of 'merge', 'rebase_merge' or 'ff'."""
+        return self.info.get('merge_method', 'merge')
+
     @property
     def access_level(self):
         permissions = self.info['permissions']
@@ -113,6 +144,76 @@ class Project(gitlab.Resource):
         return AccessLevel(effective_access['access_level'])
 
 
+class ProjectCache:
+    """The projects we can merge in, shared by the bot and its jobs.
+
+    After a first full listing, we only ask GitLab for the projects active since the previous
+    refresh, using `simple` listings that skip the heavy fields. Projects we are added to or
+    removed from don't necessarily show up as active, so every `full_refresh_interval` seconds
+    we list them all again. Full project details are only fetched, by `fetch_by_id`, for the
+    projects we actually work on, and are kept for `details_ttl` seconds. Listed projects are
+    compact (see `Resource.compact`) unless `compact` is False.
+    """
+
+    # Allowance for the clocks of GitLab and the bot disagreeing
+    CLOCK_SKEW = timedelta(minutes=5)
+
+    def __init__(self, api, *, full_refresh_interval=600, details_ttl=600, compact=True):
+        self._api = api
+        self._full_refresh_interval = full_refresh_interval
+        self._details_ttl = details_ttl
+        self._compact = compact
+        self._listed = OrderedDict()  # project_id -> Project from the listings
+        self._details = {}  # project_id -> (fetched_at, Project)
+        self._last_full_refresh = None
+        self._last_refresh = None
+        self._lock = threading.Lock()
+
+    def fetch_all_mine(self):
+        now = time.time()
+        full_refresh = (
+            self._last_full_refresh is None or
+            now - self._last_full_refresh >= self._full_refresh_interval
+        )
+        if full_refresh:
+            log.info('Listing all my projects...')
+            projects = Project.fetch_all_mine(self._api, simple=True, compact=self._compact)
+        else:
+            since = datetime.fromtimestamp(self._last_refresh, timezone.utc) - self.CLOCK_SKEW
+            projects = Project.fetch_all_mine(
+                self._api, simple=True, last_activity_after=since, compact=self._compact,
+            )
+            log.info('%s of my projects were active since %s', len(projects), since.isoformat())
+
+        with self._lock:
+            if full_refresh:
+                self._listed = OrderedDict()
+                self._last_full_refresh = now
+                for project_id in set(self._details) - {project.id for project in projects}:
+                    del self._details[project_id]
+            for project in projects:
+                self._listed[project.id] = project
+            self._last_refresh = now
+            return list(self._listed.values())
+
+    def fetch_by_id(self, project_id):
+        """Return the project with all its fields, only asking GitLab if we haven't recently."""
+        now = time.time()
+        with self._lock:
+            fetched_at, project = self._details.get(project_id, (None, None))
+        if project is not None and now - fetched_at < self._details_ttl:
+            return project
+
+        project = Project.fetch_by_id(project_id, api=self._api)
+        with self._lock:
+            self._details[project_id] = (now, project)
+        return project
+
+    def invalidate(self, project_id):
+        with self._lock:
+            self._details.pop(project_id, None)
+
+
 # pylint: disable=invalid-name
 @unique
 class AccessLevel(IntEnum):
@@ -0,0 +1,156 @@
+import logging as log
+import threading
+import time
+from collections import deque, namedtuple
+
+from . import gitlab
+from . import metrics
+
+
+# Priority classes, from most to least urgent, and how many aging intervals of waiting they are worth
+LABEL, BRANCH, NORMAL = 'label', 'branch', 'normal'
+CLASS_RANKS = {LABEL: 2, BRANCH: 1, NORMAL: 0}
+
+
+class QueuedMergeRequest(namedtuple('QueuedMergeRequest', 'merge_request priority_class waiting_since')):
+    __slots__ = ()
+
+
+class Scheduler:
+    """Decides in which order to work on the projects, and on the MRs within them.
+
+    Each MR falls in a priority class: MRs with one of the priority `labels`, MRs targeting a
+    branch matching `branch_regexp`, and the others. An MR's priority is its class rank plus
+    how long it has been waiting, minus how long a job in its project is expected to take,
+    both counted in `aging` seconds. So urgent MRs go first, short jobs go before long ones,
+    and nothing starves: after waiting long enough, any MR beats a fresh urgent one.
+
+    An MR waits from when it was assigned to us, as told by `assigned_at(merge_request)` (in
+    seconds since the epoch, or `None` if unknown), which is asked once per MR. Failing that,
+    it waits from when it was last updated.
+    """
+
+    # Weight of the last job when updating the expected job duration of a project
+    DURATION_SMOOTHING = 0.3
+
+    def __init__(self, *, labels=(), branch_regexp=None, aging=3600, history_size=100, assigned_at=None):
+        self._labels = set(labels)
+        self._branch_regexp = branch_regexp
+        self._aging = aging
+        self._assigned_at = assigned_at
+        self._queues = {}  # project_id -> (project, [QueuedMergeRequest])
+        self._waiting_since = {}  # (project_id, iid) -> time the MR started waiting
+        self._expected_durations = {}  # project_id -> seconds
+        self._dispatch_waits = {priority_class: deque(maxlen=history_size) for priority_class in CLASS_RANKS}
+        self._lock = threading.Lock()
+
+    def priority_class(self, merge_request):
+        if self._labels.intersection(merge_request.info.get('labels') or []):
+            return LABEL
+        if self._branch_regexp is not None and self._branch_regexp.match(merge_request.target_branch):
+            return BRANCH
+        return NORMAL
+
+    def enqueue(self, project, merge_requests):
+        """Replace the queued MRs of `project` with `merge_requests`."""
+        now = time.time()
+        with self._lock:
+            new_merge_requests = [
+                merge_request for merge_request in merge_requests
+                if (project.id, merge_request.iid) not in self._waiting_since
+            ]
+        # this may ask GitLab, so we don't hold the lock meanwhile
+        waiting_since = {
+            merge_request.iid: self._started_waiting(merge_request, now)
+            for merge_request in new_merge_requests
+        }
+        with self._lock:
+            iids = {merge_request.iid for merge_request in merge_requests}
+            for key in [key for key in self._waiting_since if key[0] == project.id and key[1] not in iids]:
+                del self._waiting_since[key]
+            if not merge_requests:
+                self._queues.pop(project.id, None)
+                return
+            queued = [
+                QueuedMergeRequest(
+                    merge_request=merge_request,
+                    priority_class=self.priority_class(merge_request),
+                    waiting_since=self._waiting_since.setdefault(
+                        (project.id, merge_request.iid), waiting_since.get(merge_request.iid, now),
+                    ),
+                )
+                for merge_request in merge_requests
+            ]
+            self._queues[project.id] = (project, queued)
+
+    def pop(self):
+        """Return the most urgent `(project, merge_requests)`, the MRs most urgent first, or `None`."""
+        now = time.time()
+        with self._lock:
+            if not self._queues:
+                return None
+
+            def project_priority(project_id):
+                _, queued = self._queues[project_id]
+                return max(self._priority(project_id, item, now) for item in queued)
+
+            project_id = max(self._queues, key=project_priority)
+            project, queued = self._queues.pop(project_id)
+            queued = sorted(queued, key=lambda item: -self._priority(project_id, item, now))
+            head = queued[0]
+            self._dispatch_waits[head.priority_class].append(now - head.waiting_since)
+        metrics.SCHEDULER_DISPATCH_WAIT.observe(now - head.waiting_since, priority_class=head.priority_class)
+        log.info(
+            'Next up: project %s, MR !%s (%s priority, waiting for %.0fs)',
+            project_id, head.merge_request.iid, head.priority_class, now - head.waiting_since,
+        )
+        return project, [item.merge_request for item in queued]
+
+    def record_duration(self, project_id, seconds):
+        with self._lock:
+            previous = self._expected_durations.get(project_id)
+            self._expected_durations[project_id] = seconds if previous is None else (
+                self.DURATION_SMOOTHING * seconds + (1 - self.DURATION_SMOOTHING) * previous
+            )
+            metrics.SCHEDULER_EXPECTED_JOB_DURATION.set(
+                self._expected_durations[project_id], project_id=project_id,
+            )
+
+    def expected_duration(self, project_id):
+        with self._lock:
+            return self._expected_durations.get(project_id, 0)
+
+    def stats(self):
+        """Per priority class: MRs queued, the longest current wait, and the mean wait before dispatch."""
+        now = time.time()
+        with self._lock:
+            stats = {
+                priority_class: {'queued': 0, 'max_wait': 0, 'mean_dispatch_wait': None}
+                for priority_class in CLASS_RANKS
+            }
+            for _, queued in self._queues.values():
+                for item in queued:
+                    class_stats = stats[item.priority_class]
+                    class_stats['queued'] += 1
+                    class_stats['max_wait'] = max(class_stats['max_wait'], now - item.waiting_since)
+            for priority_class, waits in self._dispatch_waits.items():
+                if waits:
+                    stats[priority_class]['mean_dispatch_wait'] = sum(waits) / len(waits)
+        for priority_class, class_stats in stats.items():
+            metrics.SCHEDULER_QUEUED.set(class_stats['queued'], priority_class=priority_class)
+            metrics.SCHEDULER_LONGEST_WAIT.set(class_stats['max_wait'], priority_class=priority_class)
+        return stats
+
+    def _started_waiting(self, merge_request, now):
+        assigned_at = None
+        if self._assigned_at is not None:
+            try:
+                assigned_at = self._assigned_at(merge_request)
+            except gitlab.ApiError as err:
+                log.warning('Failed to find when MR !%s was assigned to us: %s', merge_request.iid, err)
+        return assigned_at or gitlab.timestamp(merge_request.info.get('updated_at')) or now
+
+    def _priority(self, project_id, item, now):
+        waited = now - item.waiting_since
+        expected_duration = self._expected_durations.get(project_id, 0)
+        return CLASS_RANKS[item.priority_class] + (waited - expected_duration) / self._aging
@@ -0,0 +1,146 @@
+"""
+Split the projects between several marge-bot instances, running as the same GitLab user.
+
+The instances share a SQLite database, in which each keeps a heartbeat. The live instances form
+a consistent hash ring over the project ids, so when one joins or leaves only its share of the
+projects moves. Each instance also claims the projects it works on in the database, and only
+gives them up between cycles: a project that moves is taken over once its previous owner has
+released it (or has died and stopped heartbeating), never while it is working on it.
+"""
+import bisect
+import contextlib
+import hashlib
+import logging as log
+import sqlite3
+import threading
+import time
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS members (
+    instance_id TEXT PRIMARY KEY,
+    heartbeat_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS owners (
+    project_id INTEGER PRIMARY KEY,
+    instance_id TEXT NOT NULL,
+    claimed_at REAL NOT NULL
+);
+'''
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:  # pylint: disable=too-few-public-methods
+    """A consistent hash ring, with `replicas` points per member to even out their shares."""
+
+    def __init__(self, members, replicas=64):
+        self.members = sorted(members)
+        points = sorted(
+            (_hash('{}#{}'.format(member, replica)), member)
+            for member in self.members
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, project_id):
+        if not self._owners:
+            return None
+        index = bisect.bisect(self._hashes, _hash(str(project_id))) % len(self._hashes)
+        return self._owners[index]
+
+
+class ShardCoordinator:
+
+    def __init__(self, path, instance_id, ttl):
+        self.instance_id = instance_id
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._members = None
+        self._stopped = threading.Event()
+        self._heartbeat_thread = None
+        with self._lock:
+            self._connection.executescript(_SCHEMA)
+
+    def start(self):
+        """Join the shard, and keep heartbeating in the background until `stop()`."""
+        self.heartbeat()
+        self._heartbeat_thread = threading.Thread(target=self._keep_heartbeating, name='shard-heartbeat')
+        self._heartbeat_thread.daemon = True
+        self._heartbeat_thread.start()
+
+    def stop(self):
+        """Leave the shard, releasing our projects to the other instances straight away."""
+        self._stopped.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM owners WHERE instance_id = ?', (self.instance_id,))
+            connection.execute('DELETE FROM members WHERE instance_id = ?', (self.instance_id,))
+        with self._lock:
+            self._connection.close()
+
+    def heartbeat(self):
+        """Record we are alive, forget the instances that are not, and return the live ones."""
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO members VALUES (?, ?)', (self.instance_id, now))
+            connection.execute('DELETE FROM members WHERE heartbeat_at < ?', (now - self._ttl,))
+            connection.execute(
+                'DELETE FROM owners WHERE instance_id NOT IN (SELECT instance_id FROM members)',
+            )
+            members = [row[0] for row in connection.execute('SELECT instance_id FROM members')]
+        if members != self._members:
+            log.info('Shard members are now: %s', sorted(members))
+            self._members = members
+        return members
+
+    def select(self, projects):
+        """Return the projects that are ours to work on until the next call.
+
+        Call it between cycles only: it releases the projects that moved to another instance.
+        """
+        ring = HashRing(self.heartbeat())
+        mine = {project.id for project in projects if ring.owner(project.id) == self.instance_id}
+        now = time.time()
+        with self._transaction() as connection:
+            owners = dict(connection.execute('SELECT project_id, instance_id FROM owners'))
+            for project_id, owner in owners.items():
+                if owner == self.instance_id and project_id not in mine:
+                    log.info('Releasing project %s', project_id)
+                    connection.execute('DELETE FROM owners WHERE project_id = ?', (project_id,))
+            for project_id in mine:
+                if project_id not in owners:
+                    connection.execute(
+                        'INSERT INTO owners VALUES (?, ?, ?)', (project_id, self.instance_id, now),
+                    )
+        waiting = {
+            project_id for project_id in mine
+            if owners.get(project_id, self.instance_id) != self.instance_id
+        }
+        if waiting:
+            log.info('Waiting for other instances to release projects %s', sorted(waiting))
+        log.info('%s of %s projects are in my shard', len(mine) - len(waiting), len(projects))
+        return [project for project in projects if project.id in mine and project.id not in waiting]
+
+    def _keep_heartbeating(self):
+        while not self._stopped.wait(self._ttl / 3):
+            try:
+                self.heartbeat()
+            except sqlite3.Error:
+                log.exception('Failed to heartbeat')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Hold the lock and an immediate transaction, so instances claim projects one at a time."""
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._connection
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
@@ -3,20 +3,43 @@ import logging as log
 import time
 from datetime import datetime
 
-from . import git, gitlab
+from . import git, gitlab, lifecycle, tracing
 from .commit import Commit
-from .job import CannotMerge, GitLabRebaseResultMismatch, MergeJob, SkipMerge
+from .job import CannotMerge, GitLabRebaseResultMismatch, MergeJob, SkipMerge, merged
 
 
 class SingleMergeJob(MergeJob):
 
-    def __init__(self, *, api, user, project, repo, options, merge_request):
-        super().__init__(api=api, user=user, project=project, repo=repo, options=options)
+    def __init__(
+            self, *, api, user, project, repo, options, merge_request, services=None,
+    ):
+        super().__init__(api=api, user=user, project=project, repo=repo, options=options, services=services)
         self._merge_request = merge_request
         self._options = options
 
+    def status(self):
+        return dict(super().status(), merge_requests=[self._merge_request.iid])
+
     def execute(self):
         merge_request = self._merge_request
+        started_at = time.time()
+        outcome = 'error'
+        with tracing.span(
+                'SingleMergeJob.execute',
+                project=self._project.path_with_namespace, iid=merge_request.iid, sha=merge_request.sha,
+        ) as span:
+            try:
+                outcome = self._execute()
+            except lifecycle.ShutdownRequested:
+                outcome = 'interrupted'
+                raise
+            finally:
+                span.set_attribute('outcome', outcome)
+                self.record_latency([merge_request], outcome, started_at)
+
+    def _execute(self):
+        """Try to merge the MR; return 'merged', 'skipped' or 'cannot merge'."""
+        merge_request = self._merge_request
 
         log.info('Processing !%s - %r', merge_request.iid, merge_request.title)
 
@@ -24,23 +47,57 @@ class SingleMergeJob(MergeJob):
             approvals = merge_request.fetch_approvals()
             self.update_merge_request_and_accept(approvals)
             log.info('Successfully merged !%s.', merge_request.info['iid'])
+            self.record_time_to_merge(merge_request)
+            self.forget_push()
+            return 'merged'
         except SkipMerge as err:
             log.warning("Skipping MR !%s: %s", merge_request.info['iid'], err.reason)
+            self.forget_push()
+            return 'skipped'
         except CannotMerge as err:
             message = "I couldn't merge this branch: %s" % err.reason
             log.warning(message)
+            self.forget_push()
             self.unassign_from_mr(merge_request)
             merge_request.comment(message)
+            return 'cannot merge'
         except git.GitError:
             log.exception('Unexpected Git error')
+            self.forget_push()
             merge_request.comment('Something seems broken on my local git repo; check my logs!')
             raise
         except Exception:
             log.exception('Unexpected Exception')
+            self.forget_push()
             merge_request.comment("I'm broken on the inside, please somebody fix me... :cry:")
             self.unassign_from_mr(merge_request)
             raise
 
+    def resumable_push(self):
+        """Return our recorded push of the MR if it is still its head and its target hasn't moved since."""
+        if self._services.job_state is None:
+            return None
+        merge_request = self._merge_request
+        state = self._services.job_state.merge_request_state(self._project.id, merge_request.iid)
+        if state is None:
+            return None
+        if state.pushed_sha == merge_request.sha:
+            target_sha = Commit.last_on_branch(self._project.id, merge_request.target_branch, self._api).id
+            if target_sha == state.target_sha:
+                return state
+        log.info('MR !%s changed since our previous push of %s', merge_request.iid, state.pushed_sha)
+        self.forget_push()
+        return None
+
+    def record_push(self, target_sha, pushed_sha):
+        job_state = self._services.job_state
+        if job_state is not None:
+            job_state.record_push(self._project.id, self._merge_request.iid, target_sha, pushed_sha)
+
+    def forget_push(self):
+        if self._services.job_state is not None:
+            self._services.job_state.forget_merge_request(self._project.id, self._merge_request.iid)
+
     def update_merge_request_and_accept(self, approvals):
         api = self._api
         merge_request = self._merge_request
@@ -48,19 +105,39 @@ class SingleMergeJob(MergeJob):
 
         while not updated_into_up_to_date_target_branch:
             self.ensure_mergeable_mr(merge_request)
-            source_project, source_repo_url, _ = self.fetch_source_project(merge_request)
-            target_project = self.get_target_project(merge_request)
-            try:
-                # NB. this will be a no-op if there is nothing to update/rewrite
-
-                target_sha, _updated_sha, actual_sha = self.update_from_target_branch_and_push(
-                    merge_request,
-                    source_repo_url=source_repo_url,
+            with self.phase('fetch'):
+                source_project, source_repo_url, _ = self.fetch_source_project(merge_request)
+                target_project = self.get_target_project(merge_request)
+            resumed_push = self.resumable_push()
+            reusable_pipeline = (
+                self.find_reusable_pipeline(merge_request, target_project) if resumed_push is None else None
+            )
+            if resumed_push is not None:
+                log.info(
+                    'Resuming MR !%s from our previous push of %s',
+                    merge_request.iid, resumed_push.pushed_sha,
+                )
+                target_sha, _updated_sha, actual_sha = resumed_push.target_sha, None, resumed_push.pushed_sha
+            elif reusable_pipeline is not None:
+                target_sha, pipeline = reusable_pipeline
+                log.info(
+                    'Pipeline %s already tested MR !%s on top of %s, accepting it as it is',
+                    pipeline.id, merge_request.iid, target_sha,
                 )
-            except GitLabRebaseResultMismatch:
-                log.info("Gitlab rebase didn't give expected result")
-                merge_request.comment("Someone skipped the queue! Will have to try again...")
-                continue
+                _updated_sha = actual_sha = merge_request.sha
+            else:
+                try:
+                    # NB. this will be a no-op if there is nothing to update/rewrite
+
+                    target_sha, _updated_sha, actual_sha = self.update_from_target_branch_and_push(
+                        merge_request,
+                        source_repo_url=source_repo_url,
+                    )
+                except GitLabRebaseResultMismatch:
+                    log.info("Gitlab rebase didn't give expected result")
+                    merge_request.comment("Someone skipped the queue! Will have to try again...")
+                    continue
+                self.record_push(target_sha, actual_sha)
 
             if _updated_sha == actual_sha and self._options.guarantee_final_pipeline:
                 log.info('No commits on target branch to fuse, triggering pipeline...')
@@ -73,6 +150,7 @@ class SingleMergeJob(MergeJob):
                 target_sha,
                 _updated_sha
             )
+            tracing.set_attribute('pushed_sha', actual_sha)
             time.sleep(5)
 
             sha_now = Commit.last_on_branch(source_project.id, merge_request.source_branch, api).id
@@ -82,22 +160,29 @@ class SingleMergeJob(MergeJob):
             if sha_now != actual_sha:
                 raise CannotMerge('Someone pushed to branch while we were trying to merge')
 
-            self.maybe_reapprove(merge_request, approvals)
+            with self.phase('approvals'):
+                self.maybe_reapprove(merge_request, approvals)
 
-            if target_project.only_allow_merge_if_pipeline_succeeds:
-                self.wait_for_ci_to_pass(merge_request, actual_sha)
+            if target_project.only_allow_merge_if_pipeline_succeeds and reusable_pipeline is None:
+                with self.phase('ci'):
+                    self.wait_for_ci_to_pass(merge_request, actual_sha)
                 time.sleep(2)
 
-            self.wait_for_merge_status_to_resolve(merge_request)
+            with self.phase('merge status'):
+                self.wait_for_merge_status_to_resolve(merge_request)
 
             self.ensure_mergeable_mr(merge_request)
 
+            self.ensure_lease()
             try:
-                ret = merge_request.accept(
-                    remove_branch=merge_request.force_remove_source_branch,
-                    sha=actual_sha,
-                    merge_when_pipeline_succeeds=bool(target_project.only_allow_merge_if_pipeline_succeeds),
-                )
+                with self.phase('accept'):
+                    ret = merge_request.accept(
+                        remove_branch=merge_request.force_remove_source_branch,
+                        sha=actual_sha,
+                        merge_when_pipeline_succeeds=bool(
+                            target_project.only_allow_merge_if_pipeline_succeeds
+                        ),
+                    )
                 log.info('merge_request.accept result: %s', ret)
             except gitlab.NotAcceptable as err:
                 new_target_sha = Commit.last_on_branch(self._project.id, merge_request.target_branch, api).id
@@ -167,14 +252,16 @@ class SingleMergeJob(MergeJob):
         time_0 = datetime.utcnow()
         waiting_time_in_secs = 10
 
+        if self._services.runtime is not None:
+            self._services.runtime.wait_for_branch_to_be_merged(
+                merge_request, timeout=self._merge_timeout, waiting_time_in_secs=waiting_time_in_secs,
+            )
+            return
         while datetime.utcnow() - time_0 < self._merge_timeout:
             merge_request.refetch_info()
 
-            if merge_request.state == 'merged':
+            if merged(merge_request):
                 return  # success!
-            if merge_request.state == 'closed':
-                raise CannotMerge('someone closed the merge request while merging!')
-            assert merge_request.state in ('opened', 'reopened', 'locked'), merge_request.state
 
             log.info('Giving %s more secs for !%s to be merged...', waiting_time_in_secs, merge_request.iid)
             time.sleep(waiting_time_in_secs)
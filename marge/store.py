@@ -1,20 +1,48 @@
 import re
 import tempfile
+import threading
+from concurrent.futures import Future
 
 from . import git
+from . import git_pool as git_pool_module
 
 
 class RepoManager:
 
-    def __init__(self, user, root_dir, timeout=None, reference=None):
+    def __init__(self, user, root_dir, timeout=None, reference=None, git_pool=None):
         self._root_dir = root_dir
         self._user = user
-        self._repos = {}
+        self._repos = {}  # project_id -> Future of its repo, which is done once it is cloned
         self._timeout = timeout
         self._reference = reference
+        self._git_pool = git_pool
+        self._lock = threading.Lock()
+
+    def repo_for_project(self, project):
+        """Return the repo of `project`, cloning it first if need be.
+
+        With a git pool, the clone and the operations on the repo run on the pool.
+        """
+        future = self.repo_future(project)
+        try:
+            return future.result()
+        except Exception:
+            with self._lock:
+                if self._repos.get(project.id) is future:
+                    del self._repos[project.id]  # try again next time
+            raise
+
+    def clone_in_background(self, project):
+        """Start cloning the repo of `project` on the git pool, unless it is cloned or being cloned.
+
+        Return whether `repo_for_project` has it ready (or the error cloning it) for us. Without
+        a git pool, the repo is cloned right away.
+        """
+        return self.repo_future(project).done()
 
     def forget_repo(self, project):
-        self._repos.pop(project.id, None)
+        with self._lock:
+            self._repos.pop(project.id, None)
 
     @property
     def user(self):
@@ -24,30 +52,65 @@ class RepoManager:
     def root_dir(self):
         return self._root_dir
 
+    def _remote_url(self, project):
+        raise NotImplementedError
 
-class SshRepoManager(RepoManager):
+    def _ssh_key_file_for_git(self):
+        return None
 
-    def __init__(self, user, root_dir, ssh_key_file=None, timeout=None, reference=None):
-        super().__init__(user, root_dir, timeout, reference)
-        self._ssh_key_file = ssh_key_file
+    def repo_future(self, project):
+        """Return a `Future` of the repo of `project`, starting to clone it if need be.
 
-    def repo_for_project(self, project):
-        repo = self._repos.get(project.id)
-        if not repo or repo.remote_url != project.ssh_url_to_repo:
-            repo_url = project.ssh_url_to_repo
+        Only with a git pool does the clone run in the background.
+        """
+        remote_url = self._remote_url(project)
+        with self._lock:
+            future = self._repos.get(project.id)
+            if future is not None and _is_for(future, remote_url):
+                return future
             local_repo_dir = tempfile.mkdtemp(dir=self._root_dir)
+            if self._git_pool is not None:
+                future = self._git_pool.submit(local_repo_dir, self._clone, remote_url, local_repo_dir)
+                self._repos[project.id] = future
+                return future
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self._repos[project.id] = future
+        try:
+            future.set_result(self._clone(remote_url, local_repo_dir))
+        except Exception as err:  # pylint: disable=broad-except
+            future.set_exception(err)
+        return future
+
+    def _clone(self, remote_url, local_repo_dir):
+        repo = git.Repo(remote_url, local_repo_dir, ssh_key_file=self._ssh_key_file_for_git(),
+                        timeout=self._timeout, reference=self._reference)
+        repo.clone()
+        repo.config_user_info(
+            user_email=self._user.email,
+            user_name=self._user.name,
+        )
+        if self._git_pool is not None:
+            return git_pool_module.PooledRepo(repo, self._git_pool)
+        return repo
 
-            repo = git.Repo(repo_url, local_repo_dir, ssh_key_file=self._ssh_key_file,
-                            timeout=self._timeout, reference=self._reference)
-            repo.clone()
-            repo.config_user_info(
-                user_email=self._user.email,
-                user_name=self._user.name,
-            )
 
-            self._repos[project.id] = repo
+def _is_for(future, remote_url):
+    """Whether the repo of `future` is a clone of `remote_url`, assuming so while it is cloned."""
+    return not future.done() or future.exception() is not None or future.result().remote_url == remote_url
 
-        return repo
+
+class SshRepoManager(RepoManager):
+
+    def __init__(self, user, root_dir, ssh_key_file=None, timeout=None, reference=None, git_pool=None):
+        super().__init__(user, root_dir, timeout, reference, git_pool)
+        self._ssh_key_file = ssh_key_file
+
+    def _remote_url(self, project):
+        return project.ssh_url_to_repo
+
+    def _ssh_key_file_for_git(self):
+        return self._ssh_key_file
 
     @property
     def ssh_key_file(self):
@@ -56,31 +119,16 @@ class SshRepoManager(RepoManager):
 
 class HttpsRepoManager(RepoManager):
 
-    def __init__(self, user, root_dir, auth_token=None, timeout=None, reference=None):
-        super().__init__(user, root_dir, timeout, reference)
+    def __init__(self, user, root_dir, auth_token=None, timeout=None, reference=None, git_pool=None):
+        super().__init__(user, root_dir, timeout, reference, git_pool)
         self._auth_token = auth_token
 
-    def repo_for_project(self, project):
-        repo = self._repos.get(project.id)
-        if not repo or repo.remote_url != project.http_url_to_repo:
-            credentials = "oauth2:" + self._auth_token
-            # insert token auth "oauth2:<auth_token>@"
-            pattern = "(http(s)?://)"
-            replacement = r"\1" + credentials + "@"
-            repo_url = re.sub(pattern, replacement, project.http_url_to_repo, 1)
-            local_repo_dir = tempfile.mkdtemp(dir=self._root_dir)
-
-            repo = git.Repo(repo_url, local_repo_dir, ssh_key_file=None,
-                            timeout=self._timeout, reference=self._reference)
-            repo.clone()
-            repo.config_user_info(
-                user_email=self._user.email,
-                user_name=self._user.name,
-            )
-
-            self._repos[project.id] = repo
-
-        return repo
+    def _remote_url(self, project):
+        credentials = "oauth2:" + self._auth_token
+        # insert token auth "oauth2:<auth_token>@"
+        pattern = "(http(s)?://)"
+        replacement = r"\1" + credentials + "@"
+        return re.sub(pattern, replacement, project.http_url_to_repo, 1)
 
     @property
     def auth_token(self):
@@ -0,0 +1,169 @@
+"""
+Tracing of the bot's work, in the spirit of OpenTelemetry.
+
+A span times one piece of work: a job, a phase of it, a GitLab API call, a git command...
+Spans started while another one is open in the same thread are its children, so a trace
+shows where the time of a job went. Finished spans are handed to the configured exporter;
+with none configured (the default) spans cost next to nothing and go nowhere.
+"""
+import contextlib
+import json
+import logging as log
+import os
+import threading
+import time
+
+
+class Span:
+    __slots__ = (
+        'name', 'trace_id', 'span_id', 'parent_id', 'attributes',
+        'start_time', 'end_time', 'status', 'error', '_time_0',
+    )
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self.end_time = None
+        self.status = 'ok'
+        self.error = None
+        self._time_0 = time.monotonic()
+
+    @property
+    def duration(self):
+        return None if self.end_time is None else self.end_time - self.start_time
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        self.end_time = self.start_time + (time.monotonic() - self._time_0)
+        if error is not None:
+            self.status = 'error'
+            self.error = '{}: {}'.format(error.__class__.__name__, error)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_span_id': self.parent_id,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'status': self.status,
+            'error': self.error,
+        }
+
+
+class _NoSpan:  # pylint: disable=too-few-public-methods
+    """What `span` yields when tracing is off."""
+
+    def set_attribute(self, key, value):
+        pass
+
+
+class JsonLinesExporter:
+    """Append each finished span to `path` as a line of JSON."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+
+    def export(self, finished_span):
+        line = json.dumps(finished_span.to_dict(), sort_keys=True, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Tracer:
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self._local = threading.local()
+
+    @property
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def current_span(self):
+        stack = self._stack
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        exporter = self.exporter
+        if exporter is None:
+            yield _NO_SPAN
+            return
+
+        stack = self._stack
+        new_span = Span(name, parent=stack[-1] if stack else None, attributes=attributes)
+        stack.append(new_span)
+        error = None
+        try:
+            yield new_span
+        except BaseException as err:
+            error = err
+            raise
+        finally:
+            stack.pop()
+            new_span.end(error)
+            try:
+                exporter.export(new_span)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Failed to export span %s', new_span.name)
+
+    @contextlib.contextmanager
+    def attach(self, parent):
+        """Make `parent` (from another thread) the parent of the spans started in this block."""
+        if parent is None:
+            yield
+            return
+        stack = self._stack
+        stack.append(parent)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+
+_NO_SPAN = _NoSpan()
+
+TRACER = Tracer()
+
+
+def configure(exporter):
+    """Send the spans to `exporter`, any object with an `export(span)` method; `None` turns tracing off."""
+    TRACER.exporter = exporter
+
+
+def span(name, **attributes):
+    return TRACER.span(name, **attributes)
+
+
+def current_span():
+    return TRACER.current_span()
+
+
+def attach(parent):
+    return TRACER.attach(parent)
+
+
+def set_attribute(key, value):
+    """Set an attribute on the innermost open span of this thread, if any."""
+    current = TRACER.current_span()
+    if current is not None:
+        current.set_attribute(key, value)
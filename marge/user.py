@@ -1,4 +1,12 @@
+import logging as log
+import os
+import threading
+import time
+from collections import OrderedDict
+
 from . import gitlab
+from . import json_file
+from .concurrency import map_concurrently
 
 
 GET = gitlab.GET
@@ -54,3 +62,77 @@ class User(gitlab.Resource):
     @property
     def state(self):
         return self.info['state']
+
+
+class UserCache:
+    """A bounded LRU cache of users by id, whose entries expire after `ttl` seconds.
+
+    Missing users are fetched concurrently. A user GitLab no longer knows about (404) is dropped
+    from the cache. If `cache_file` is given, the cache is saved there and restored on start.
+    """
+
+    def __init__(self, api, *, max_size=1000, ttl=3600, cache_file=None, max_workers=8):
+        self._api = api
+        self._max_size = max_size
+        self._ttl = ttl
+        self._cache_file = cache_file
+        self._max_workers = max_workers
+        self._entries = OrderedDict()  # user_id -> (fetched_at, info)
+        self._lock = threading.Lock()
+        if cache_file is not None and os.path.exists(cache_file):
+            self._load()
+
+    def fetch_by_id(self, user_id):
+        return self.fetch_by_ids([user_id])[0]
+
+    def fetch_by_ids(self, user_ids):
+        """Return the users with the given ids, in order, only asking GitLab for those not cached."""
+        user_ids = list(user_ids)
+        infos = {}
+        now = time.time()
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is not None and now - entry[0] < self._ttl:
+                    self._entries.move_to_end(user_id)
+                    infos[user_id] = entry[1]
+
+        missing_ids = [user_id for user_id in OrderedDict.fromkeys(user_ids) if user_id not in infos]
+        if missing_ids:
+            log.debug('User cache misses: %s', missing_ids)
+            fetched = map_concurrently(self._fetch, missing_ids, max_workers=self._max_workers)
+            with self._lock:
+                for user_id, user in zip(missing_ids, fetched):
+                    if isinstance(user, gitlab.NotFound):
+                        self._entries.pop(user_id, None)  # it may have expired, but it is gone for good
+                        continue
+                    self._entries[user_id] = (now, user.info)
+                    self._entries.move_to_end(user_id)
+                    infos[user_id] = user.info
+                while len(self._entries) > self._max_size:
+                    self._entries.popitem(last=False)
+                if self._cache_file is not None:
+                    json_file.save(self._cache_file, list(self._entries.values()))
+            for user in fetched:
+                if isinstance(user, gitlab.NotFound):
+                    raise user
+
+        return [User(self._api, infos[user_id]) for user_id in user_ids]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def _fetch(self, user_id):
+        """Fetch the user, or return the `NotFound` error if GitLab no longer knows about them."""
+        try:
+            return User.fetch_by_id(user_id, self._api)
+        except gitlab.NotFound as err:
+            return err
+
+    def _load(self):
+        entries = json_file.load(self._cache_file, 'user cache')
+        if entries is None:
+            return
+        for fetched_at, info in entries[-self._max_size:]:
+            self._entries[info['id']] = (fetched_at, info)
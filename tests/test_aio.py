@@ -0,0 +1,144 @@
+import asyncio
+import threading
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+
+import marge.gitlab
+from marge import aio
+from marge.gitlab import GET, Version
+from marge.job import CannotMerge
+from marge.merge_request import MergeRequest
+from tests.test_merge_request import INFO as MR_INFO
+
+VERSION = Version.parse('14.0.0-ee')
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def _pipeline(status, sha=MR_INFO['sha']):
+    return {'id': 1, 'sha': sha, 'ref': MR_INFO['source_branch'], 'status': status}
+
+
+@pytest.fixture(name='api')
+def async_api_fixture():
+    sync_api = marge.gitlab.Api('http://git.example.com', 'TOKEN', session=marge.gitlab.pooled_session(2))
+    async_api = aio.AsyncApi(sync_api, max_concurrent_requests=2)
+    with patch.object(sync_api, 'version', return_value=VERSION):
+        yield async_api
+    async_api.close()
+
+
+def test_call_runs_the_sync_api_off_the_loop(api):
+    threads = []
+
+    def call(command, sudo=None):
+        threads.append(threading.current_thread())
+        return {'command': command, 'sudo': sudo}
+
+    with patch.object(api.sync, 'call', side_effect=call):
+        result = _run(api.call(GET('/projects/1'), sudo=2))
+    assert result == {'command': GET('/projects/1'), 'sudo': 2}
+    assert threads[0] is not threading.current_thread()
+
+
+def test_version_is_fetched_once(api):
+    assert _run(api.version()) == VERSION
+    assert _run(api.version()) == VERSION
+    api.sync.version.assert_called_once_with()
+
+
+def test_fetch_merge_request(api):
+    with patch.object(api.sync, 'call', return_value=MR_INFO) as call:
+        merge_request = _run(aio.fetch_merge_request(api, 1234, 54))
+    call.assert_called_once_with(GET('/projects/1234/merge_requests/54'))
+    assert merge_request.info == MR_INFO
+    assert merge_request.api is api.sync
+
+
+def test_wait_for_ci_to_pass(api):
+    merge_request = MergeRequest(api.sync, MR_INFO)
+    responses = [[_pipeline('running')], [_pipeline('success', sha='other'), _pipeline('success')]]
+    with patch.object(api.sync, 'call', side_effect=responses) as call:
+        _run(aio.wait_for_ci_to_pass(
+            api, merge_request, timeout=timedelta(minutes=1), waiting_time_in_secs=0,
+        ))
+    assert call.call_count == 2
+
+
+def test_wait_for_ci_to_pass_fails(api):
+    merge_request = MergeRequest(api.sync, MR_INFO)
+    with patch.object(api.sync, 'call', return_value=[_pipeline('failed')]):
+        with pytest.raises(CannotMerge, match='CI failed!'):
+            _run(aio.wait_for_ci_to_pass(api, merge_request, timeout=timedelta(minutes=1)))
+    with patch.object(api.sync, 'call', return_value=[_pipeline('running')]):
+        with pytest.raises(CannotMerge, match='CI is taking too long.'):
+            _run(aio.wait_for_ci_to_pass(api, merge_request, timeout=timedelta(0)))
+
+
+def test_wait_for_merge_status_to_resolve(api):
+    merge_request = MergeRequest(api.sync, dict(MR_INFO, merge_status='unchecked'))
+    responses = [dict(MR_INFO, merge_status='unchecked'), dict(MR_INFO, merge_status='can_be_merged')]
+    with patch.object(api.sync, 'call', side_effect=responses):
+        _run(aio.wait_for_merge_status_to_resolve(api, merge_request, waiting_time_in_secs=0))
+    assert merge_request.merge_status == 'can_be_merged'
+
+    with patch.object(api.sync, 'call', return_value=dict(MR_INFO, merge_status='cannot_be_merged')):
+        with pytest.raises(CannotMerge):
+            _run(aio.wait_for_merge_status_to_resolve(api, merge_request))
+
+
+def test_wait_for_branch_to_be_merged(api):
+    merge_request = MergeRequest(api.sync, MR_INFO)
+    with patch.object(api.sync, 'call', side_effect=[MR_INFO, dict(MR_INFO, state='merged')]):
+        _run(aio.wait_for_branch_to_be_merged(
+            api, merge_request, timeout=timedelta(minutes=1), waiting_time_in_secs=0,
+        ))
+    assert merge_request.state == 'merged'
+
+    with patch.object(api.sync, 'call', return_value=dict(MR_INFO, state='closed')):
+        with pytest.raises(CannotMerge, match='someone closed the merge request'):
+            _run(aio.wait_for_branch_to_be_merged(api, merge_request, timeout=timedelta(minutes=1)))
+
+
+def test_runtime_polls_for_the_jobs_on_its_loop():
+    sync_api = marge.gitlab.Api('http://git.example.com', 'TOKEN', session=marge.gitlab.pooled_session(4))
+    runtime = aio.Runtime(sync_api, max_concurrent_requests=4)
+    release = threading.Event()
+    polls = []
+
+    def call(_command, sudo=None):
+        assert sudo is None
+        polls.append(threading.current_thread().name)
+        return [_pipeline('success')] if release.is_set() else [_pipeline('running')]
+
+    def wait(merge_request):
+        runtime.wait_for_ci_to_pass(
+            merge_request, None, timeout=timedelta(minutes=1), waiting_time_in_secs=0.01,
+        )
+
+    runtime.start()
+    try:
+        with patch.object(sync_api, 'version', return_value=VERSION), \
+                patch.object(sync_api, 'call', side_effect=call):
+            jobs = [
+                threading.Thread(target=wait, args=(MergeRequest(sync_api, dict(MR_INFO, iid=iid)),))
+                for iid in (1, 2, 3)
+            ]
+            for job in jobs:
+                job.start()
+            threading.Timer(0.05, release.set).start()
+            for job in jobs:
+                job.join(5)
+            assert not any(job.is_alive() for job in jobs)
+    finally:
+        runtime.stop()
+    assert len(polls) > 3
+    assert all(name.startswith('gitlab') for name in polls)
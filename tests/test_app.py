@@ -1,17 +1,22 @@
 import contextlib
 import datetime
+import io
 import os
 import re
 import shlex
+import socket
 import tempfile
 import unittest.mock as mock
 
+import configargparse
 import pytest
+import requests
 
 import marge.app as app
 import marge.bot as bot_module
 import marge.interval as interval
 import marge.job as job
+import marge.tracing as tracing
 
 import tests.gitlab_api_mock as gitlab_mock
 from tests.test_user import INFO as user_info
@@ -58,10 +63,11 @@ def env(**kwargs):
 
 @contextlib.contextmanager
 def main(cmdline=''):
-    def api_mock(gitlab_url, auth_token):
+    def api_mock(gitlab_url, auth_token, session=None):
         assert gitlab_url == 'http://foo.com'
         assert auth_token in ('NON-ADMIN-TOKEN', 'ADMIN-TOKEN')
         api = gitlab_mock.Api(gitlab_url=gitlab_url, auth_token=auth_token, initial_state='initial')
+        api.session = session
         user_info_for_token = dict(user_info, is_admin=auth_token == 'ADMIN-TOKEN')
         api.add_user(user_info_for_token, is_current=True)
         api.add_transition(gitlab_mock.GET('/version'), gitlab_mock.Ok({'version': '11.6.0-ce'}))
@@ -93,6 +99,9 @@ def test_default_values():
             assert bot.config.git_timeout == datetime.timedelta(seconds=120)
             assert bot.config.merge_opts == job.MergeJobOptions.default()
             assert bot.config.merge_order == 'created_at'
+            assert bot.config.project_refresh_interval == datetime.timedelta(minutes=10)
+            assert not bot.config.skip_idle_projects
+            assert bot.config.job_state_file is None
 
 
 def test_embargo():
@@ -131,6 +140,151 @@ def test_use_merge_strategy_and_add_tested_are_mutualy_exclusive():
                 pass
 
 
+def test_metrics_port():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with mock.patch('marge.metrics.start_http_server') as start_http_server:
+            with main():
+                start_http_server.assert_not_called()
+            with main('--metrics-port=9090'):
+                start_http_server.assert_called_once_with(9090)
+
+
+def test_trace_file():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with mock.patch('marge.tracing.configure') as configure:
+            with main('--trace-file=/dev/null'):
+                [(exporter,), _] = configure.call_args
+                assert isinstance(exporter, tracing.JsonLinesExporter)
+                exporter.close()
+
+
+def test_profile_flags(tmpdir):
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with mock.patch('marge.profiling.configure') as configure:
+            with main('--profile-dir={} --profile-format=speedscope --profile-duration=30s'.format(tmpdir)):
+                configure.assert_called_once_with(
+                    duration=30, output_dir=str(tmpdir), output_format='speedscope',
+                )
+
+
+def test_debug_http_flags():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with mock.patch('marge.http_log.configure') as configure:
+            with main('--debug --debug-http-body-size=100 --debug-http-sample=/projects=0.1,*=0.5'):
+                configure.assert_called_once_with(
+                    max_body_size=100, sample_rates={'/projects': 0.1, '*': 0.5},
+                )
+        with pytest.raises(SystemExit):
+            with main('--debug-http-sample=/projects'):
+                pass
+
+
+def test_latency_report(tmpdir):
+    latency_file = str(tmpdir.join('latency.db'))
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--latency-file={}'.format(latency_file)) as bot:
+            assert bot.config.latency_file == latency_file
+            assert bot.config.latency_max_age == datetime.timedelta(days=90)
+
+    out = io.StringIO()
+    app.latency_report(['--latency-file', latency_file, '--since', '24h'], out=out)
+    assert out.getvalue() == 'No merged merge requests recorded.\n'
+
+
+def test_concurrent_projects():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.concurrent_projects == 1
+            assert bot.api.session is None
+        with main('--concurrent-projects=4') as bot:
+            assert bot.config.concurrent_projects == 4
+            assert isinstance(bot.api.session, requests.Session)
+        with pytest.raises(app.MargeBotCliArgError):
+            with main('--concurrent-projects=0'):
+                pass
+
+
+def test_git_workers():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.git_workers == 0
+        with main('--git-workers=4') as bot:
+            assert bot.config.git_workers == 4
+        with pytest.raises(app.MargeBotCliArgError):
+            with main('--git-workers=-1'):
+                pass
+
+
+def test_prewarm():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert not bot.config.prewarm
+            assert bot.config.prewarm_projects is None
+            assert bot.config.prewarm_active_within == datetime.timedelta(hours=1)
+            assert bot.config.prewarm_concurrency == 2
+            assert bot.config.prewarm_disk_budget == 10 * 2 ** 30
+            assert bot.config.prewarm_refresh_interval == datetime.timedelta(minutes=10)
+        with main(
+                '--git-workers=4 --prewarm --prewarm-projects=big/.* --prewarm-active-within=30min '
+                '--prewarm-concurrency=1 --prewarm-disk-budget=500M --prewarm-refresh-interval=1h'
+        ) as bot:
+            assert bot.config.prewarm
+            assert bot.config.prewarm_projects.pattern == 'big/.*'
+            assert bot.config.prewarm_active_within == datetime.timedelta(minutes=30)
+            assert bot.config.prewarm_concurrency == 1
+            assert bot.config.prewarm_disk_budget == 500 * 2 ** 20
+            assert bot.config.prewarm_refresh_interval == datetime.timedelta(hours=1)
+        with pytest.raises(app.MargeBotCliArgError):
+            with main('--prewarm'):
+                pass
+
+
+def test_shard(tmpdir):
+    shard_file = str(tmpdir.join('shard.db'))
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.shard_file is None
+            assert bot.config.shard_id == '{}:{}'.format(socket.gethostname(), os.getpid())
+        with main('--shard-file={} --shard-id=marge-1 --shard-ttl=30s'.format(shard_file)) as bot:
+            assert bot.config.shard_file == shard_file
+            assert bot.config.shard_id == 'marge-1'
+            assert bot.config.shard_ttl == datetime.timedelta(seconds=30)
+
+
+def test_lock_dir(tmpdir):
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert bot.config.lock_dir is None
+            assert bot.config.lease_ttl == datetime.timedelta(minutes=5)
+        with main('--lock-dir={} --lease-ttl=1min'.format(tmpdir)) as bot:
+            assert bot.config.lock_dir == str(tmpdir)
+            assert bot.config.lease_ttl == datetime.timedelta(minutes=1)
+
+
+def test_reuse_pipelines():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--reuse-pipelines --reuse-merge-result-pipelines') as bot:
+            assert bot.config.merge_opts == job.MergeJobOptions.default(
+                reuse_pipelines=True, reuse_merge_result_pipelines=True,
+            )
+
+
+def test_reuse_merge_result_pipelines_needs_reuse_pipelines():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with pytest.raises(app.MargeBotCliArgError):
+            with main('--reuse-merge-result-pipelines'):
+                pass
+
+
+def test_reuse_pipelines_option_conflicts():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        conflicting_flags = ['--add-tested', '--add-reviewers', '--add-part-of', '--guarantee-final-pipeline']
+        for conflicting_flag in conflicting_flags:
+            with pytest.raises(app.MargeBotCliArgError):
+                with main('--reuse-pipelines %s' % conflicting_flag):
+                    pass
+
+
 def test_add_part_of():
     with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
         with main('--add-part-of') as bot:
@@ -148,6 +302,12 @@ def test_add_reviewers():
         with main('--add-reviewers') as bot:
             assert bot.config.merge_opts != job.MergeJobOptions.default()
             assert bot.config.merge_opts == job.MergeJobOptions.default(add_reviewers=True)
+            assert bot.config.user_cache_ttl == datetime.timedelta(hours=1)
+            assert bot.config.user_cache_file is None
+
+    with env(MARGE_AUTH_TOKEN="ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--add-reviewers --user-cache-ttl=10min') as bot:
+            assert bot.config.user_cache_ttl == datetime.timedelta(minutes=10)
 
 
 def test_rebase_remotely_option_conflicts():
@@ -239,6 +399,51 @@ def test_merge_order_assigned():
             assert bot.config.merge_order == 'assigned_at'
 
 
+def test_batch_sizing():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--batch --batch-adaptive-size --batch-max-size=5') as bot:
+            assert bot.config.batch_adaptive_size
+            assert bot.config.batch_max_size == 5
+            assert bot.config.batch_history_file is None
+
+
+def test_job_state_file(tmpdir):
+    job_state_file = str(tmpdir.join('state.sqlite'))
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--job-state-file=%s' % job_state_file) as bot:
+            assert bot.config.job_state_file == job_state_file
+
+
+def test_skip_idle_projects():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main('--skip-idle-projects --full-sweep-interval=1h') as bot:
+            assert bot.config.skip_idle_projects
+            assert bot.config.full_sweep_interval == datetime.timedelta(hours=1)
+
+
+def test_priority_scheduling():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with main() as bot:
+            assert not bot.config.priority_scheduling
+            assert bot.config.priority_labels == []
+            assert bot.config.priority_branch_regexp is None
+            assert bot.config.priority_aging == datetime.timedelta(hours=1)
+
+        with main('--priority-scheduling --priority-labels="hotfix, security" '
+                  '--priority-branch-regexp="release/.*" --priority-aging=30min') as bot:
+            assert bot.config.priority_scheduling
+            assert bot.config.priority_labels == ['hotfix', 'security']
+            assert bot.config.priority_branch_regexp == re.compile('release/.*')
+            assert bot.config.priority_aging == datetime.timedelta(minutes=30)
+
+
+def test_batch_max_size_too_small():
+    with env(MARGE_AUTH_TOKEN="NON-ADMIN-TOKEN", MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
+        with pytest.raises(app.MargeBotCliArgError):
+            with main('--batch --batch-max-size=1'):
+                pass
+
+
 # FIXME: I'd reallly prefer this to be a doctest, but adding --doctest-modules
 # seems to seriously mess up the test run
 def test_time_interval():
@@ -246,6 +451,12 @@ def test_time_interval():
     assert [app.time_interval(x) for x in ['15min', '15m', '.25h', '900s']] == [_900s] * 4
 
 
+def test_disk_size():
+    assert [app.disk_size(x) for x in ['100', '2K', '1.5m', '10GB']] == [100, 2048, 1572864, 10 * 2 ** 30]
+    with pytest.raises(configargparse.ArgumentTypeError):
+        app.disk_size('10 furlongs')
+
+
 def test_disabled_auth_token_cli_arg():
     with env(MARGE_SSH_KEY="KEY", MARGE_GITLAB_URL='http://foo.com'):
         with pytest.raises(app.MargeBotCliArgError):
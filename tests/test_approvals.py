@@ -121,6 +121,19 @@ class TestApprovals:
             'Roger Ebert <ebert@example.com>'
         ]
 
+    @patch('marge.user.User.fetch_by_id')
+    def test_get_reviewer_names_and_emails_with_cache(self, user_fetch_by_id):
+        user_fetch_by_id.side_effect = lambda id, _: marge.user.User(self.api, USERS[id])
+        user_cache = marge.user.UserCache(self.api)
+        for _ in range(2):
+            assert _get_reviewer_names_and_emails(
+                commits=[], approvals=self.approvals, api=self.api, user_cache=user_cache,
+            ) == [
+                'Administrator <root@localhost>',
+                'Roger Ebert <ebert@example.com>'
+            ]
+        assert user_fetch_by_id.call_count == 2
+
     @patch('marge.user.User.fetch_by_id')
     def test_approvals_fails_when_same_author(self, user_fetch_by_id):
         info = dict(INFO, approved_by=list(INFO['approved_by']))
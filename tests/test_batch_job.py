@@ -6,9 +6,12 @@ import pytest
 import marge.git
 import marge.project
 import marge.user
-from marge.batch_job import BatchMergeJob, CannotBatch
+from marge.batch_job import Batch, BatchMergeJob, CannotBatch
+import marge.gitlab
 from marge.gitlab import GET
-from marge.job import CannotMerge, MergeJobOptions
+from marge.graphql import MergeRequestState
+from marge.job import CannotMerge, JobServices, MergeJobOptions, SkipMerge
+from marge.job_state import JobStateStore
 from marge.merge_request import MergeRequest
 from tests.gitlab_api_mock import MockLab, Ok, commit
 
@@ -49,11 +52,21 @@ class TestBatchJob:
     def test_remove_batch_branch(self, api, mocklab):
         repo = create_autospec(marge.git.Repo, spec_set=True)
         batch_merge_job = self.get_batch_merge_job(api, mocklab, repo=repo)
-        batch_merge_job.remove_batch_branch()
+        batch_merge_job.remove_batch_branch('master')
         repo.remove_branch.assert_called_once_with(
-            BatchMergeJob.BATCH_BRANCH_NAME,
+            'marge_bot_batch_merge_job_master',
         )
 
+    def test_batch_branch_name_per_target_branch(self):
+        assert BatchMergeJob.batch_branch_name('master') == 'marge_bot_batch_merge_job_master'
+        release_1_0 = BatchMergeJob.batch_branch_name('release/1.0')
+        assert release_1_0 == 'marge_bot_batch_merge_job_release-1.0_d29eb386'
+        targets = ['release', 'release/1.0', 'release-1.0']
+        names = [BatchMergeJob.batch_branch_name(target) for target in targets]
+        assert len(set(names)) == 3
+        # none is a directory of another's ref
+        assert not any('/' in name for name in names)
+
     def test_close_batch_mr(self, api, mocklab):
         with patch('marge.batch_job.MergeRequest') as mr_class:
             batch_mr = self._mock_merge_request()
@@ -76,6 +89,71 @@ class TestBatchJob:
             )
             batch_mr.close.assert_called_once()
 
+    def test_close_batch_mr_keeps_resumed_batches(self, api, mocklab):
+        with patch('marge.batch_job.MergeRequest') as mr_class:
+            batch_mrs = [self._mock_merge_request(iid=iid) for iid in (1, 2)]
+            mr_class.search.return_value = batch_mrs
+
+            batch_merge_job = self.get_batch_merge_job(api, mocklab)
+            batch_merge_job.close_batch_mr(keep_iids={2})
+
+            batch_mrs[0].close.assert_called_once()
+            batch_mrs[1].close.assert_not_called()
+
+    def _job_with_recorded_batch(self, api, mocklab):
+        merge_requests = [
+            self._mock_merge_request(iid=iid, sha='sha-%s' % iid, target_branch='master') for iid in (3, 4)
+        ]
+        job_state = JobStateStore(':memory:')
+        batch_merge_job = self.get_batch_merge_job(
+            api, mocklab, merge_requests=merge_requests,
+            services=JobServices.none()._replace(job_state=job_state),
+        )
+        batch_merge_job.record_batch(Batch(
+            target_branch='master',
+            batch_mr=self._mock_merge_request(iid=9),
+            batch_mr_sha='batch-sha',
+            merge_requests=merge_requests,
+            remote_target_branch_sha='target-sha',
+        ))
+        return batch_merge_job, job_state, merge_requests
+
+    def test_resume_batch(self, api, mocklab):
+        batch_merge_job, job_state, merge_requests = self._job_with_recorded_batch(api, mocklab)
+        batch_mr = self._mock_merge_request(iid=9, state='opened', sha='batch-sha')
+        with patch('marge.batch_job.MergeRequest') as mr_class, \
+                patch('marge.batch_job.Commit.last_on_branch') as last_on_branch:
+            mr_class.fetch_by_iid.return_value = batch_mr
+            last_on_branch.return_value.id = 'target-sha'
+
+            assert batch_merge_job.resume_batch('master') == Batch(
+                target_branch='master',
+                batch_mr=batch_mr,
+                batch_mr_sha='batch-sha',
+                merge_requests=merge_requests,
+                remote_target_branch_sha='target-sha',
+            )
+            mr_class.fetch_by_iid.assert_called_once_with(batch_merge_job._project.id, 9, api)
+            batch_merge_job._repo.checkout_branch.assert_called_once_with('master', 'origin/master')
+        assert batch_merge_job.resume_batch('release') is None
+        assert job_state.batch_state(batch_merge_job._project.id, 'master') is not None
+
+    @pytest.mark.parametrize('change', ['member', 'batch_mr', 'target'])
+    def test_resume_batch_after_changes(self, api, mocklab, change):
+        batch_merge_job, job_state, merge_requests = self._job_with_recorded_batch(api, mocklab)
+        batch_mr = self._mock_merge_request(iid=9, state='opened', sha='batch-sha')
+        if change == 'member':
+            merge_requests[1].sha = 'pushed-since'
+        elif change == 'batch_mr':
+            batch_mr.state = 'closed'
+        with patch('marge.batch_job.MergeRequest') as mr_class, \
+                patch('marge.batch_job.Commit.last_on_branch') as last_on_branch:
+            mr_class.fetch_by_iid.return_value = batch_mr
+            last_on_branch.return_value.id = 'moved-sha' if change == 'target' else 'target-sha'
+
+            assert batch_merge_job.resume_batch('master') is None
+        assert job_state.batch_state(batch_merge_job._project.id, 'master') is None
+
     def test_create_batch_mr(self, api, mocklab):
         with patch('marge.batch_job.MergeRequest') as mr_class:
             batch_mr = self._mock_merge_request()
@@ -86,7 +164,7 @@ class TestBatchJob:
             r_batch_mr = batch_merge_job.create_batch_mr(target_branch)
 
             params = {
-                'source_branch': BatchMergeJob.BATCH_BRANCH_NAME,
+                'source_branch': 'marge_bot_batch_merge_job_master',
                 'target_branch': target_branch,
                 'title': 'Marge Bot Batch MR - DO NOT TOUCH',
                 'labels': BatchMergeJob.BATCH_BRANCH_NAME,
@@ -114,6 +192,109 @@ class TestBatchJob:
         r_maser_mrs = batch_merge_job.get_mrs_with_common_target_branch('master')
         assert r_maser_mrs == master_mrs
 
+    def test_get_target_branches(self, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(
+            api, mocklab,
+            merge_requests=[
+                self._mock_merge_request(target_branch='release'),
+                self._mock_merge_request(target_branch='master'),
+                self._mock_merge_request(target_branch='release'),
+            ],
+        )
+        assert batch_merge_job.get_target_branches() == ['release', 'master']
+
+    @patch.object(BatchMergeJob, 'wait_for_ci_to_pass')
+    def test_wait_for_batches_ci(self, bmj_wait_for_ci_to_pass, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        batches = [
+            Batch(
+                target_branch=target_branch,
+                batch_mr=self._mock_merge_request(iid=iid),
+                batch_mr_sha=sha,
+                merge_requests=[],
+                remote_target_branch_sha='abc',
+            )
+            for target_branch, iid, sha in [('master', 1, 'good'), ('release', 2, 'bad')]
+        ]
+        error = CannotMerge('CI failed!')
+
+        def wait_for_ci_to_pass(_batch_mr, commit_sha):
+            if commit_sha == 'bad':
+                raise error
+
+        bmj_wait_for_ci_to_pass.side_effect = wait_for_ci_to_pass
+        assert batch_merge_job.wait_for_batches_ci(batches) == [None, error]
+        assert bmj_wait_for_ci_to_pass.call_count == 2
+
+    @pytest.mark.parametrize('release_ci_fails', [False, True])
+    def test_execute_leaves_unbatched_branches_to_the_caller(self, release_ci_fails, api, mocklab):
+        merge_requests = [
+            self._mock_merge_request(iid=iid, target_branch=target_branch)
+            for iid, target_branch in [(1, 'master'), (2, 'release'), (3, 'master'), (4, 'release')]
+        ]
+        batch_merge_job = self.get_batch_merge_job(api, mocklab, merge_requests=merge_requests)
+
+        def prepare_batch(target_branch):
+            if target_branch == 'release' and not release_ci_fails:
+                raise CannotBatch('not enough ready merge requests')
+            return Batch(
+                target_branch=target_branch,
+                batch_mr=self._mock_merge_request(iid=10, web_url='batch-url'),
+                batch_mr_sha='sha-%s' % target_branch,
+                merge_requests=[mr for mr in merge_requests if mr.target_branch == target_branch],
+                remote_target_branch_sha='abc',
+            )
+
+        def wait_for_batches_ci(batches):
+            return [
+                CannotMerge('CI failed!') if batch.target_branch == 'release' else None for batch in batches
+            ]
+
+        with patch.object(batch_merge_job, 'close_batch_mr'), \
+                patch.object(batch_merge_job, 'remove_batch_branch'), \
+                patch.object(batch_merge_job, 'prepare_batch', side_effect=prepare_batch), \
+                patch.object(batch_merge_job, 'wait_for_batches_ci', side_effect=wait_for_batches_ci), \
+                patch.object(batch_merge_job, 'accept_batch') as accept_batch:
+            with pytest.raises(CannotBatch):
+                batch_merge_job.execute()
+
+        assert [call[0][0].target_branch for call in accept_batch.call_args_list] == ['master']
+        # the caller merges the release MRs on their own, and leaves the merged master ones be
+        assert [mr.iid for mr in batch_merge_job.unbatched_merge_requests] == [2, 4]
+
+    @patch.object(BatchMergeJob, 'wait_for_ci_to_pass')
+    def test_execute_records_the_phases_of_each_batch(self, _wait_for_ci_to_pass, api, mocklab):
+        merge_requests = [
+            self._mock_merge_request(iid=iid, target_branch=target_branch)
+            for iid, target_branch in [(1, 'master'), (2, 'release'), (3, 'master'), (4, 'release')]
+        ]
+        batch_merge_job = self.get_batch_merge_job(api, mocklab, merge_requests=merge_requests)
+
+        def prepare_batch(target_branch):
+            with batch_merge_job.phase('assembly'):
+                return Batch(
+                    target_branch=target_branch,
+                    batch_mr=self._mock_merge_request(iid=10, web_url='batch-url'),
+                    batch_mr_sha='sha-%s' % target_branch,
+                    merge_requests=[mr for mr in merge_requests if mr.target_branch == target_branch],
+                    remote_target_branch_sha='abc',
+                )
+
+        with patch.object(batch_merge_job, 'close_batch_mr'), \
+                patch.object(batch_merge_job, 'remove_batch_branch'), \
+                patch.object(batch_merge_job, 'prepare_batch', side_effect=prepare_batch), \
+                patch.object(batch_merge_job, 'accept_batch'), \
+                patch.object(batch_merge_job, 'record_latency') as record_latency:
+            batch_merge_job.execute()
+
+        phases = [phase for phase, _, _ in batch_merge_job.phase_log]
+        assert phases == ['assembly', 'assembly', 'ci', 'accept', 'accept']
+        recorded = {
+            tuple(mr.iid for mr in call[0][0]): [phase for phase, _, _ in call[0][3]]
+            for call in record_latency.call_args_list
+        }
+        assert recorded == {(1, 3): ['assembly', 'ci', 'accept'], (2, 4): ['assembly', 'ci', 'accept']}
+
     @patch.object(BatchMergeJob, 'get_mr_ci_status')
     def test_ensure_mergeable_mr_ci_not_ok(self, bmj_get_mr_ci_status, api, mocklab):
         batch_merge_job = self.get_batch_merge_job(api, mocklab)
@@ -130,11 +311,86 @@ class TestBatchJob:
 
         assert str(exc_info.value) == 'This MR has not passed CI.'
 
+    @patch.object(BatchMergeJob, 'unassign_from_mr')
+    @patch.object(BatchMergeJob, 'ensure_mergeable_mr')
+    def test_get_mergeable_mrs(self, bmj_ensure_mergeable_mr, bmj_unassign_from_mr, api, mocklab):
+        merge_requests = [self._mock_merge_request(iid=iid) for iid in range(1, 7)]
+        errors = {
+            2: CannotBatch('This MR has not passed CI.'),
+            3: SkipMerge('Merge embargo!'),
+            5: CannotMerge('Insufficient approvals'),
+        }
+
+        def ensure_mergeable_mr(merge_request, prefetched):
+            assert prefetched is None
+            if merge_request.iid in errors:
+                raise errors[merge_request.iid]
+
+        bmj_ensure_mergeable_mr.side_effect = ensure_mergeable_mr
+        batch_merge_job = self.get_batch_merge_job(api, mocklab, merge_requests=merge_requests)
+
+        mergeable_mrs = batch_merge_job.get_mergeable_mrs(merge_requests)
+
+        assert [merge_request.iid for merge_request in mergeable_mrs] == [1, 4, 6]
+        assert bmj_ensure_mergeable_mr.call_count == 6
+        bmj_unassign_from_mr.assert_called_once_with(merge_requests[4])
+        merge_requests[4].comment.assert_called_once_with(
+            "I couldn't merge this branch: Insufficient approvals",
+        )
+        for merge_request in merge_requests[:4] + merge_requests[5:]:
+            merge_request.comment.assert_not_called()
+
+    @patch.object(BatchMergeJob, 'get_mr_ci_status')
+    def test_ensure_mergeable_mr_prefetched(self, bmj_get_mr_ci_status, api, mocklab):
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        merge_request = MergeRequest.fetch_by_iid(
+            mocklab.project_info['id'], mocklab.merge_request_info['iid'], api,
+        )
+        prefetched = MergeRequestState(
+            iid=merge_request.iid,
+            state='opened',
+            draft=False,
+            squash=False,
+            sha=merge_request.sha,
+            merge_status='can_be_merged',
+            blocking_discussions_resolved=True,
+            assignee_ids=[batch_merge_job._user.id],
+            approvals_left=0,
+            approved_by=[],
+            head_pipeline={'id': 1, 'status': 'failed', 'sha': merge_request.sha},
+        )
+        with pytest.raises(CannotBatch):
+            batch_merge_job.ensure_mergeable_mr(merge_request, prefetched=prefetched)
+        bmj_get_mr_ci_status.assert_not_called()
+
+        bmj_get_mr_ci_status.return_value = 'success'
+        stale_pipeline = dict(prefetched.head_pipeline, sha='0ld')
+        batch_merge_job.ensure_mergeable_mr(merge_request, prefetched=prefetched._replace(
+            head_pipeline=stale_pipeline,
+        ))
+        bmj_get_mr_ci_status.assert_called_once_with(merge_request)
+
+    def test_prefetch_merge_request_states(self, api, mocklab):
+        merge_request = self._mock_merge_request(iid=54)
+        batch_merge_job = self.get_batch_merge_job(api, mocklab)
+        assert batch_merge_job.prefetch_merge_request_states([merge_request]) == {}
+
+        batch_merge_job = self.get_batch_merge_job(
+            api, mocklab, options=MergeJobOptions.default(use_graphql=True),
+        )
+        with patch('marge.batch_job.graphql.fetch_merge_request_states') as fetch_states:
+            fetch_states.return_value = {54: 'state'}
+            assert batch_merge_job.prefetch_merge_request_states([merge_request]) == {54: 'state'}
+            fetch_states.assert_called_once_with(api, batch_merge_job._project, [54])
+
+            fetch_states.side_effect = marge.gitlab.GraphQLError(200, {'message': 'nope'})
+            assert batch_merge_job.prefetch_merge_request_states([merge_request]) == {}
+
     def test_push_batch(self, api, mocklab):
         batch_merge_job = self.get_batch_merge_job(api, mocklab)
-        batch_merge_job.push_batch()
+        batch_merge_job.push_batch('release')
         batch_merge_job._repo.push.assert_called_once_with(
-            BatchMergeJob.BATCH_BRANCH_NAME,
+            'marge_bot_batch_merge_job_release',
             force=True,
         )
 
@@ -0,0 +1,123 @@
+import logging
+import os.path
+import tempfile
+from unittest.mock import patch
+
+import pytest
+
+import marge.batch_sizer
+from marge import metrics
+from marge.batch_sizer import BatchSizer
+
+
+PROJECT_ID = 1234
+
+
+class TestBatchSizer:
+    def test_no_history_batches_everything(self):
+        sizer = BatchSizer()
+        assert sizer.batch_size(PROJECT_ID, 'master', 7) == 7
+
+    def test_max_size(self):
+        sizer = BatchSizer(max_size=4)
+        assert sizer.batch_size(PROJECT_ID, 'master', 7) == 4
+        assert sizer.batch_size(PROJECT_ID, 'master', 3) == 3
+
+    def test_only_successes_keeps_batching_everything(self):
+        sizer = BatchSizer()
+        for _ in range(5):
+            sizer.record(PROJECT_ID, 'master', size=5, success=True, ci_seconds=600)
+        assert sizer.batch_size(PROJECT_ID, 'master', 10) == 10
+
+    def test_failures_shrink_batches(self):
+        sizer = BatchSizer()
+        for _ in range(3):
+            sizer.record(PROJECT_ID, 'master', size=8, success=False)
+            sizer.record(PROJECT_ID, 'master', size=2, success=True)
+        size = sizer.batch_size(PROJECT_ID, 'master', 10)
+        assert 2 <= size < 8
+
+    def test_slower_ci_for_bigger_batches_shrinks_them(self):
+        flat_ci, slower_ci = BatchSizer(), BatchSizer()
+        for size, success in [(4, True), (8, True), (4, True), (8, False), (4, True), (8, True)] * 2:
+            flat_ci.record(PROJECT_ID, 'master', size=size, success=success, ci_seconds=600)
+            slower_ci.record(PROJECT_ID, 'master', size=size, success=success, ci_seconds=300 + 60 * size)
+        assert flat_ci.batch_size(PROJECT_ID, 'master', 20) > slower_ci.batch_size(PROJECT_ID, 'master', 20)
+        stats = slower_ci.stats(PROJECT_ID, 'master')
+        expected = stats['optimal_size'] * stats['mr_pass_rate'] ** stats['optimal_size'] * 3600
+        assert stats['merged_per_ci_hour'] == pytest.approx(expected / (300 + 60 * stats['optimal_size']))
+
+    def test_never_below_min_size(self):
+        sizer = BatchSizer()
+        for _ in range(10):
+            sizer.record(PROJECT_ID, 'master', size=2, success=False)
+        assert sizer.batch_size(PROJECT_ID, 'master', 10) == 2
+
+    def test_target_branches_are_independent(self):
+        sizer = BatchSizer()
+        for _ in range(10):
+            sizer.record(PROJECT_ID, 'master', size=5, success=False)
+        assert sizer.batch_size(PROJECT_ID, 'release', 5) == 5
+        assert sizer.batch_size(PROJECT_ID + 1, 'master', 5) == 5
+
+    def test_not_adaptive(self):
+        sizer = BatchSizer(adaptive=False, max_size=6)
+        for _ in range(10):
+            sizer.record(PROJECT_ID, 'master', size=5, success=False)
+        assert sizer.batch_size(PROJECT_ID, 'master', 10) == 6
+
+    def test_exports_its_decisions(self):
+        sizer = BatchSizer()
+        for _ in range(3):
+            sizer.record(PROJECT_ID, 'master', size=8, success=False)
+            sizer.record(PROJECT_ID, 'master', size=2, success=True)
+        size = sizer.batch_size(PROJECT_ID, 'master', 10)
+        assert metrics.BATCH_TARGET_SIZE.value(project_id=PROJECT_ID, target_branch='master') == size
+        pass_rate = metrics.BATCH_MR_PASS_RATE.value(project_id=PROJECT_ID, target_branch='master')
+        assert pass_rate == sizer.stats(PROJECT_ID, 'master')['mr_pass_rate']
+
+    def test_estimates_once_per_decision(self, caplog):
+        sizer = BatchSizer()
+        sizer.record(PROJECT_ID, 'master', size=4, success=False)
+        estimate = marge.batch_sizer._estimate_pass_rate  # pylint: disable=protected-access
+        with patch('marge.batch_sizer._estimate_pass_rate', side_effect=estimate) as estimate_pass_rate:
+            with caplog.at_level(logging.INFO):
+                sizer.batch_size(PROJECT_ID, 'master', 10)
+            assert 'mr_pass_rate=' in caplog.text
+            assert estimate_pass_rate.call_count == 1
+
+    def test_stats(self):
+        sizer = BatchSizer()
+        assert sizer.stats(PROJECT_ID, 'master')['batches'] == 0
+        sizer.record(PROJECT_ID, 'master', size=4, success=True, ci_seconds=1200)
+        sizer.record(PROJECT_ID, 'master', size=4, success=False, ci_seconds=600)
+        stats = sizer.stats(PROJECT_ID, 'master')
+        assert stats['batches'] == 2
+        assert stats['failed_batches'] == 1
+        assert stats['mean_size'] == 4
+        assert stats['mean_ci_seconds'] == 900
+        assert 0.7 < stats['mr_pass_rate'] < 0.9
+        assert stats['merged_per_ci_hour'] > 0
+
+    def test_history_is_bounded(self):
+        sizer = BatchSizer(history_size=3)
+        for _ in range(5):
+            sizer.record(PROJECT_ID, 'master', size=2, success=True)
+        assert sizer.stats(PROJECT_ID, 'master')['batches'] == 3
+
+    def test_history_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            history_file = os.path.join(tmp_dir, 'history.json')
+            sizer = BatchSizer(history_file=history_file)
+            for _ in range(3):
+                sizer.record(PROJECT_ID, 'master', size=8, success=False)
+            restored = BatchSizer(history_file=history_file)
+            assert restored.stats(PROJECT_ID, 'master') == sizer.stats(PROJECT_ID, 'master')
+            assert restored.batch_size(PROJECT_ID, 'master', 10) == sizer.batch_size(PROJECT_ID, 'master', 10)
+
+    def test_unreadable_history_file_is_ignored(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as history_file:
+            history_file.write('{not json')
+            history_file.flush()
+            sizer = BatchSizer(history_file=history_file.name)
+            assert sizer.stats(PROJECT_ID, 'master')['batches'] == 0
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+from marge.concurrency import drain, map_concurrently
+
+
+def test_map_concurrently():
+    assert map_concurrently(lambda x: x * 2, range(20), max_workers=4) == [x * 2 for x in range(20)]
+    assert map_concurrently(lambda x: x * 2, [3], max_workers=4) == [6]
+    assert map_concurrently(lambda x: x * 2, [], max_workers=4) == []
+
+
+def test_drain_runs_up_to_max_workers_at_once():
+    items = iter(range(10))
+    lock = threading.Lock()
+    running, max_running, done = [0], [0], []
+
+    def handle(item):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        threading.Event().wait(0.01)
+        with lock:
+            running[0] -= 1
+            done.append(item)
+
+    drain(lambda: next(items, None), handle, max_workers=3)
+    assert sorted(done) == list(range(10))
+    assert 1 < max_running[0] <= 3
+
+
+def test_drain_raises_errors_after_handling_everything():
+    items = iter(range(5))
+    done = []
+
+    def handle(item):
+        if item == 1:
+            raise ValueError(item)
+        done.append(item)
+
+    with pytest.raises(ValueError):
+        drain(lambda: next(items, None), handle, max_workers=2)
+    assert sorted(done) == [0, 2, 3, 4]
@@ -0,0 +1,91 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from marge import metrics
+from marge.git import Repo
+from marge.git_pool import GitPool, PooledRepo
+
+
+@pytest.fixture
+def pool():
+    git_pool = GitPool(max_workers=2)
+    yield git_pool
+    git_pool.close()
+
+
+def test_runs_operations_and_returns_their_results(pool):
+    assert pool.run('/repo', lambda a, b=0: a + b, 1, b=2) == 3
+    with pytest.raises(ZeroDivisionError):
+        pool.run('/repo', lambda: 1 / 0)
+    assert pool.pending() == 0
+    assert metrics.GIT_OPERATIONS.value(state='running') == 0
+
+
+def test_operations_on_the_same_repo_go_one_at_a_time(pool):
+    release = threading.Event()
+    order = []
+
+    def first():
+        release.wait(5)
+        order.append('first')
+
+    slow = pool.submit('/repo', first)
+    second = pool.submit('/repo', order.append, 'second')
+    other = pool.submit('/other', order.append, 'other')
+
+    other.result(timeout=5)  # while /repo is busy
+    assert order == ['other']
+    assert not second.done()
+    assert metrics.GIT_OPERATIONS.value(state='waiting') == 1
+
+    release.set()
+    second.result(timeout=5)
+    assert slow.done()
+    assert order == ['other', 'first', 'second']
+
+
+def test_caps_the_operations_running_at_once():
+    pool = GitPool(max_workers=1)
+    release = threading.Event()
+    try:
+        slow = pool.submit('/repo', release.wait, 5)
+        other = pool.submit('/other', lambda: 'done')
+        assert not other.done()
+        release.set()
+        assert other.result(timeout=5) == 'done'
+        assert slow.result() is True
+    finally:
+        pool.close()
+
+
+def test_close_cancels_the_waiting_operations():
+    pool = GitPool(max_workers=1)
+    release = threading.Event()
+    running = pool.submit('/repo', release.wait, 5)
+    waiting = pool.submit('/repo', lambda: 'never')
+    threading.Timer(0.1, release.set).start()
+    pool.close()
+    assert running.result() is True
+    assert waiting.cancelled()
+    with pytest.raises(RuntimeError):
+        pool.submit('/repo', lambda: None)
+
+
+def test_pooled_repo_runs_operations_on_the_pool(pool):
+    repo = Repo(remote_url='ssh://git@host/x.git', local_path='/tmp/x', ssh_key_file=None, timeout=None,
+                reference=None)
+    pooled_repo = PooledRepo(repo, pool)
+    assert pooled_repo.remote_url == repo.remote_url
+    assert pooled_repo.local_path == '/tmp/x'
+
+    threads = []
+
+    def fake_git(*_args, **_kwargs):
+        threads.append(threading.current_thread().name)
+        return mock.Mock(stdout=b'deadbeef\n')
+
+    with mock.patch.object(Repo, 'git', side_effect=fake_git):
+        assert pooled_repo.get_commit_hash() == 'deadbeef'
+    assert len(threads) == 1 and threads[0].startswith('git')
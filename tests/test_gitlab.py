@@ -1,4 +1,9 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
 import marge.gitlab as gitlab
+import marge.metrics as metrics
 
 
 class TestVersion:
@@ -11,3 +16,109 @@ class TestVersion:
     def test_is_ee(self):
         assert gitlab.Version.parse('9.4.0-ee').is_ee
         assert not gitlab.Version.parse('9.4.0').is_ee
+
+
+class TestGraphQL:
+    def _post(self, json):
+        post = Mock(return_value=Mock(status_code=200, content=b'', json=Mock(return_value=json)))
+        post.__name__ = 'post'
+        return post
+
+    def test_returns_data(self):
+        api = gitlab.Api('http://git.example.com/', 'TOKEN')
+        with patch('requests.post', new=self._post({'data': {'x': 1}})) as post:
+            assert api.graphql('query { x }', {'a': 1}) == {'x': 1}
+        post.assert_called_once_with(
+            'http://git.example.com/api/graphql',
+            headers={'PRIVATE-TOKEN': 'TOKEN'},
+            timeout=60,
+            json={'query': 'query { x }', 'variables': {'a': 1}},
+        )
+
+    def test_raises_errors(self):
+        api = gitlab.Api('http://git.example.com/', 'TOKEN')
+        post = self._post({'errors': [{'message': 'no'}, {'message': 'way'}], 'data': None})
+        with patch('requests.post', new=post):
+            with pytest.raises(gitlab.GraphQLError) as exc_info:
+                api.graphql('query { x }')
+        assert exc_info.value.error_message == 'no; way'
+
+
+def test_counts_requests():
+    api = gitlab.Api('http://git.example.com/', 'TOKEN')
+    get = Mock(return_value=Mock(status_code=404, content=b'', json=Mock(return_value={'message': 'nope'})))
+    get.__name__ = 'get'
+    labels = dict(method='GET', endpoint='/projects/:id/merge_requests/:id', status='404')
+    requests_before = metrics.API_REQUESTS.value(**labels)
+    with patch('requests.get', new=get):
+        with pytest.raises(gitlab.NotFound):
+            api.call(gitlab.GET('/projects/12/merge_requests/3'))
+    assert metrics.API_REQUESTS.value(**labels) == requests_before + 1
+
+
+def test_uses_session():
+    session = gitlab.pooled_session(4)
+    api = gitlab.Api('http://git.example.com/', 'TOKEN', session=session)
+    response = Mock(status_code=200, content=b'', json=Mock(return_value={'version': '14.0.0-ee'}))
+    module_get = Mock()
+    module_get.__name__ = 'get'
+    with patch.object(session, 'get', return_value=response) as get, patch('requests.get', new=module_get):
+        assert api.version() == gitlab.Version.parse('14.0.0-ee')
+    get.assert_called_once_with(
+        'http://git.example.com/api/v4/version', headers={'PRIVATE-TOKEN': 'TOKEN'}, timeout=60, params={},
+    )
+    module_get.assert_not_called()
+
+
+def test_version_is_cached():
+    api = gitlab.Api('http://git.example.com/', 'TOKEN')
+    with patch.object(api, 'call', return_value={'version': '14.0.0-ee'}) as call, \
+            patch('time.monotonic', side_effect=[100, 100 + api.VERSION_TTL - 1, 100 + api.VERSION_TTL]):
+        for _ in range(3):
+            assert api.version() == gitlab.Version.parse('14.0.0-ee')
+    assert call.call_count == 2
+
+
+def test_timestamp():
+    assert gitlab.timestamp('2021-06-01T12:00:00.000Z') == 1622548800
+    assert gitlab.timestamp('2021-06-01T14:00:00+02:00') == 1622548800
+    assert gitlab.timestamp('yesterday') is None
+    assert gitlab.timestamp(None) is None
+
+
+class Thing(gitlab.Resource):
+    COMPACT_FIELDS = ('id', 'name')
+
+    def fetch_info(self):
+        return self.api.call(gitlab.GET('/things/%s' % self.id))
+
+
+class TestCompactResource:
+
+    def test_keeps_only_compact_fields(self):
+        thing = Thing.compact(Mock(), {'id': 1, 'name': 'one', 'links': {'self': 'http://...'}})
+        assert thing.id == 1
+        assert thing.info['name'] == 'one'
+        assert thing.info.to_dict() == {'id': 1, 'name': 'one'}
+        assert thing.info == {'id': 1, 'name': 'one'}
+        assert repr(thing.info) == "ThingInfo({'id': 1, 'name': 'one'})"
+        assert not hasattr(thing.info, '__dict__')
+
+    def test_missing_compact_fields_are_missing(self):
+        api = Mock()
+        thing = Thing.compact(api, {'id': 1})
+        with pytest.raises(KeyError):
+            thing.info['name']  # pylint: disable=pointless-statement
+        assert thing.info.get('name', 'default') == 'default'
+        assert 'name' not in thing.info
+        api.call.assert_not_called()
+
+    def test_fetches_other_fields_once(self):
+        api = Mock()
+        api.call = Mock(return_value={'id': 1, 'name': 'one', 'size': 3})
+        thing = Thing.compact(api, {'id': 1, 'name': 'one', 'size': 3})
+        info = thing.info
+        assert info['size'] == 3
+        assert thing.info == {'id': 1, 'name': 'one', 'size': 3}
+        assert info['size'] == 3
+        api.call.assert_called_once_with(gitlab.GET('/things/1'))
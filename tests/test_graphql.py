@@ -0,0 +1,120 @@
+from unittest.mock import Mock
+
+import marge.graphql as graphql
+from marge.gitlab import Api
+from marge.merge_request import MergeRequest
+from marge.project import Project
+from tests.test_merge_request import INFO as MR_INFO
+from tests.test_project import INFO as PROJECT_INFO
+
+
+NODE = {
+    'iid': '54',
+    'state': 'opened',
+    'draft': False,
+    'squash': False,
+    'diffHeadSha': 'beef',
+    'mergeStatusEnum': 'CAN_BE_MERGED',
+    'mergeableDiscussionsState': True,
+    'assignees': {'nodes': [{'id': 'gid://gitlab/User/77'}]},
+    'approvalsLeft': 0,
+    'approvedBy': {'nodes': [{'id': 'gid://gitlab/User/1', 'username': 'root'}]},
+    'headPipeline': {'id': 'gid://gitlab/Ci::Pipeline/47', 'status': 'SUCCESS', 'sha': 'beef'},
+}
+
+
+def _data(*nodes_per_project):
+    return {
+        'p%d' % index: {'mergeRequests': {'nodes': list(nodes)}}
+        for index, nodes in enumerate(nodes_per_project)
+    }
+
+
+class TestMergeRequestState:
+    def test_from_node(self):
+        state = graphql.MergeRequestState.from_node(NODE)
+        assert state == graphql.MergeRequestState(
+            iid=54,
+            state='opened',
+            draft=False,
+            squash=False,
+            sha='beef',
+            merge_status='can_be_merged',
+            blocking_discussions_resolved=True,
+            assignee_ids=[77],
+            approvals_left=0,
+            approved_by=[{'user': {'id': 1, 'username': 'root'}}],
+            head_pipeline={'id': 47, 'status': 'success', 'sha': 'beef'},
+        )
+
+    def test_from_node_without_pipeline(self):
+        state = graphql.MergeRequestState.from_node(dict(NODE, headPipeline=None, approvalsLeft=None))
+        assert state.head_pipeline is None
+        assert state.approvals_left == 0
+
+    def test_hydrate(self):
+        api = Mock(Api)
+        merge_request = MergeRequest(api, dict(MR_INFO, work_in_progress=True))
+        state = graphql.MergeRequestState.from_node(NODE)
+
+        approvals = state.hydrate(merge_request)
+
+        assert merge_request.sha == 'beef'
+        assert not merge_request.work_in_progress
+        assert merge_request.merge_status == 'can_be_merged'
+        assert merge_request.blocking_discussions_resolved
+        assert merge_request.assignee_ids == [77]
+        assert approvals.sufficient
+        assert approvals.approver_ids == [1]
+        assert approvals.iid == merge_request.iid
+        api.call.assert_not_called()
+
+
+class TestFetch:
+    def test_fetch_merge_request_states(self):
+        api = Mock(Api)
+        api.graphql.return_value = _data([NODE, dict(NODE, iid='55', state='merged')])
+        project = Project(api, PROJECT_INFO)
+
+        states = graphql.fetch_merge_request_states(api, project, [54, 55])
+
+        assert sorted(states) == [54, 55]
+        assert states[55].state == 'merged'
+        api.graphql.assert_called_once()
+        query, variables = api.graphql.call_args[0]
+        assert 'p0: project(fullPath: $path0)' in query
+        assert variables == {'path0': 'cool/project', 'iids0': ['54', '55']}
+
+    def test_across_projects(self):
+        api = Mock(Api)
+        api.graphql.return_value = _data([NODE], [dict(NODE, iid='3')])
+
+        states = graphql.fetch_merge_request_states_across_projects(api, {'a/b': [54], 'c/d': [3]})
+
+        assert sorted(states) == [('a/b', 54), ('c/d', 3)]
+        _, variables = api.graphql.call_args[0]
+        assert variables == {'path0': 'a/b', 'iids0': ['54'], 'path1': 'c/d', 'iids1': ['3']}
+
+    def test_missing_project_is_skipped(self):
+        api = Mock(Api)
+        api.graphql.return_value = {'p0': None}
+        assert graphql.fetch_merge_request_states_across_projects(api, {'gone/project': [1]}) == {}
+
+    def test_queries_are_chunked(self):
+        api = Mock(Api)
+        api.graphql.return_value = {}
+        graphql.fetch_merge_request_states_across_projects(api, {
+            'a/b': range(150),
+            'c/d': range(60),
+        })
+
+        chunks = [call[0][1] for call in api.graphql.call_args_list]
+        chunk_sizes = [
+            sum(len(iids) for name, iids in chunk.items() if name.startswith('iids'))
+            for chunk in chunks
+        ]
+        assert chunk_sizes == [100, 100, 10]
+        assert chunks[1] == {
+            'path0': 'a/b', 'iids0': [str(iid) for iid in range(100, 150)],
+            'path1': 'c/d', 'iids1': [str(iid) for iid in range(50)],
+        }
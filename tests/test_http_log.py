@@ -0,0 +1,87 @@
+import logging
+from unittest.mock import Mock, patch
+
+import pytest
+
+from marge.http_log import HttpLog, parse_sample_rates, redact
+
+
+def response(status_code=200, content=b'{"id": 1}'):
+    return Mock(status_code=status_code, content=content)
+
+
+@pytest.fixture
+def debug_logs(caplog):
+    with caplog.at_level(logging.DEBUG):
+        yield caplog
+
+
+def test_redact():
+    assert redact('{"runners_token": "abc\\"d", "id": 1, "password":"p"}') == (
+        '{"runners_token": "[REDACTED]", "id": 1, "password":"[REDACTED]"}'
+    )
+    assert redact(repr({'json': {'token': 'abc', 'title': 'token'}})) == (
+        "{'json': {'token': '[REDACTED]', 'title': 'token'}}"
+    )
+    assert redact('{"token": "cut sh') == '{"token": "[REDACTED]"'
+    assert redact('http://gitlab/api/v4/user?private_token=abc&sudo=1') == (
+        'http://gitlab/api/v4/user?private_token=[REDACTED]&sudo=1'
+    )
+
+
+def test_parse_sample_rates():
+    assert parse_sample_rates('') == {}
+    assert parse_sample_rates('/projects/:id/merge_requests=0.1, *=0.5') == {
+        '/projects/:id/merge_requests': 0.1, '*': 0.5,
+    }
+    for bad in ('/projects', '=0.5', '/projects=2', '/projects=often'):
+        with pytest.raises(ValueError):
+            parse_sample_rates(bad)
+
+
+def test_nothing_is_formatted_without_debug(caplog):
+    content = Mock()
+    with caplog.at_level(logging.INFO):
+        HttpLog().request('GET', 'http://gitlab/api/v4/projects', '/projects', {}, {})
+        HttpLog().response('GET', '/projects', Mock(status_code=200, content=content), 0.1)
+    assert not caplog.records
+    assert not content.mock_calls
+
+
+def test_request(debug_logs):
+    HttpLog().request(
+        'PUT', 'http://gitlab/api/v4/projects/1', '/projects/:id',
+        {'PRIVATE-TOKEN': 'secret', 'SUDO': '2'}, {'json': {'description': 'x' * 5000}},
+    )
+    [record] = debug_logs.records
+    message = record.getMessage()
+    assert message.startswith(
+        "REQUEST: method=PUT endpoint=/projects/:id url=http://gitlab/api/v4/projects/1 "
+        "headers={'PRIVATE-TOKEN': '[REDACTED]', 'SUDO': '2'} args={'json': {'description': 'xxx"
+    )
+    assert message.endswith('... (5029 chars)')
+    assert 'secret' not in message
+
+
+def test_response_bodies_are_capped(debug_logs):
+    HttpLog(max_body_size=14).response('GET', '/projects', response(content=b'{"token": "abcdefgh"}'), 0.25)
+    [line, body] = [record.getMessage() for record in debug_logs.records]
+    assert line == 'RESPONSE: method=GET endpoint=/projects status=200 duration=0.250s size=21'
+    assert body == 'RESPONSE BODY: method=GET endpoint=/projects body={"token": "[REDACTED]" ... (21 bytes)'
+
+
+def test_response_bodies_are_sampled(debug_logs):
+    http_log = HttpLog(sample_rates={'/projects': 0, '*': 0.5})
+    http_log.response('GET', '/projects', response(), 0.1)
+    http_log.response('GET', '/projects', response(status_code=404, content=b'{"message": "404"}'), 0.1)
+    with patch('marge.http_log.random.random', side_effect=[0.4, 0.6]):
+        http_log.response('GET', '/user', response(), 0.1)
+        http_log.response('GET', '/user', response(), 0.1)
+    bodies = [record.getMessage() for record in debug_logs.records if 'BODY' in record.getMessage()]
+    assert bodies == [
+        'RESPONSE BODY: method=GET endpoint=/projects body={"message": "404"}',
+        'RESPONSE BODY: method=GET endpoint=/user body={"id": 1}',
+    ]
+
+    HttpLog(max_body_size=0).response('GET', '/user', response(), 0.1)
+    assert 'BODY' not in debug_logs.records[-1].getMessage()
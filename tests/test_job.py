@@ -4,10 +4,14 @@ from unittest.mock import ANY, MagicMock, patch, create_autospec
 
 import pytest
 
-from marge.job import CannotMerge, Fusion, MergeJob, MergeJobOptions, SkipMerge
+from marge.job import CannotMerge, Fusion, JobServices, MergeJob, MergeJobOptions, SkipMerge
+import marge.aio
 import marge.interval
 import marge.git
 import marge.gitlab
+import marge.lease
+import marge.lifecycle
+import marge.metrics
 import marge.merge_request
 import marge.project
 import marge.user
@@ -48,6 +52,89 @@ class TestJob:
             assert r_source_project is not merge_job._project
             assert r_source_project is project_class.fetch_by_id.return_value
 
+    def test_get_source_project_is_cached(self):
+        with patch('marge.job.Project') as project_class:
+            merge_job = self.get_merge_job()
+            merge_request = self._mock_merge_request()
+            first = merge_job.get_source_project(merge_request)
+            second = merge_job.get_source_project(merge_request)
+
+            project_class.fetch_by_id.assert_called_once()
+            assert first is second
+
+    def test_resolve_source_projects(self):
+        with patch('marge.job.Project') as project_class:
+            project_class.fetch_by_id.side_effect = lambda project_id, api: 'project-%s' % project_id
+            merge_job = self.get_merge_job()
+            merge_requests = [
+                self._mock_merge_request(source_project_id=project_id)
+                for project_id in [merge_job._project.id, 1, 2, 1]
+            ]
+            merge_job.resolve_source_projects(merge_requests)
+
+            assert sorted(call[0][0] for call in project_class.fetch_by_id.call_args_list) == [1, 2]
+            assert merge_job.get_source_project(merge_requests[1]) == 'project-1'
+            assert merge_job.get_source_project(merge_requests[2]) == 'project-2'
+            assert merge_job.get_source_project(merge_requests[0]) is merge_job._project
+            assert project_class.fetch_by_id.call_count == 2
+
+    def test_projects_come_from_project_cache(self):
+        project_cache = create_autospec(marge.project.ProjectCache, spec_set=True)
+        with patch('marge.job.Project') as project_class:
+            merge_job = self.get_merge_job(services=JobServices.none()._replace(project_cache=project_cache))
+            merge_request = self._mock_merge_request()
+            assert merge_job.get_source_project(merge_request) is project_cache.fetch_by_id.return_value
+            assert merge_job.get_target_project(merge_request) is project_cache.fetch_by_id.return_value
+            project_class.fetch_by_id.assert_not_called()
+
+    def test_fetch_source_project_without_fetching(self):
+        with patch('marge.job.Project'):
+            merge_job = self.get_merge_job()
+            merge_request = self._mock_merge_request()
+            _, remote_url, remote = merge_job.fetch_source_project(merge_request, fetch=False)
+            assert remote == 'source'
+            assert remote_url is not None
+            merge_job._repo.fetch.assert_not_called()
+
+    def test_phase_timings(self):
+        merge_job = self.get_merge_job()
+        with merge_job.phase('fetch'):
+            pass
+        with merge_job.phase('push'):
+            pass
+        with merge_job.phase('fetch'):
+            pass
+        assert list(merge_job.phase_timings) == ['fetch', 'push']
+        assert all(seconds >= 0 for seconds in merge_job.phase_timings.values())
+
+    def test_status(self):
+        merge_job = self.get_merge_job()
+        with merge_job.phase('ci'), merge_job.waiting('CI of MR !54'):
+            status = merge_job.status()
+        assert [name for name, _ in status['phases']] == ['ci']
+        assert [what for what, _ in status['waiting_on']] == ['CI of MR !54']
+        assert merge_job.status()['phases'] == merge_job.status()['waiting_on'] == []
+
+    def test_phases_stop_on_shutdown(self, monkeypatch):
+        monkeypatch.setattr('marge.lifecycle._stopping', MagicMock(is_set=lambda: True))
+        merge_job = self.get_merge_job()
+        with pytest.raises(marge.lifecycle.ShutdownRequested):
+            with merge_job.phase('ci'):
+                pass
+
+    def test_push_force_to_mr_needs_the_lease(self, tmpdir):
+        leases = marge.lease.LeaseManager(str(tmpdir), owner='me', ttl=60)
+        lease = leases.acquire(1234)
+        merge_job = self.get_merge_job(services=JobServices.none()._replace(lease=lease))
+        merge_request = self._mock_merge_request(source_branch='feature')
+        merge_job.push_force_to_mr(merge_request, branch_was_modified=True)
+        assert merge_job.repo.push.call_count == 1
+
+        lease.lost = True
+        with pytest.raises(SkipMerge, match='Lost the lease on project 1234'):
+            merge_job.push_force_to_mr(merge_request, branch_was_modified=True)
+        assert merge_job.repo.push.call_count == 1
+
     @pytest.mark.parametrize(
         'version,use_merge_request_pipelines',
         [('9.4.0-ee', False), ('10.5.0-ee', True)],
@@ -79,6 +166,112 @@ class TestJob:
                 )
             assert r_ci_status == 'success'
 
+    def test_waits_poll_on_the_runtime(self):
+        runtime = create_autospec(marge.aio.Runtime, spec_set=True)
+        merge_job = self.get_merge_job(services=JobServices.none()._replace(runtime=runtime))
+        merge_request = self._mock_merge_request(iid=54, sha='abc')
+        merge_job.wait_for_ci_to_pass(merge_request)
+        merge_job.wait_for_merge_status_to_resolve(merge_request)
+        runtime.wait_for_ci_to_pass.assert_called_once_with(
+            merge_request, 'abc', timeout=merge_job.opts.ci_timeout, waiting_time_in_secs=10,
+        )
+        runtime.wait_for_merge_status_to_resolve.assert_called_once_with(
+            merge_request, attempts=3, waiting_time_in_secs=5,
+        )
+        merge_request.refetch_info.assert_not_called()
+        merge_job._api.version.assert_not_called()
+
+    def test_record_time_to_merge(self):
+        project = create_autospec(marge.project.Project, spec_set=True, path_with_namespace='time/to-merge')
+        merge_job = self.get_merge_job(project=project)
+        created_at = '2021-06-01T12:00:00.000Z'
+        merge_job.record_time_to_merge(self._mock_merge_request(info={'created_at': created_at}))
+        merge_job.record_time_to_merge(self._mock_merge_request(info={}))
+        assert marge.metrics.TIME_TO_MERGE.count(project='time/to-merge') == 1
+
+    def _find_reusable_pipeline(self, pipelines, merge_method='merge', parent_ids=None, **options):
+        options.setdefault('reuse_pipelines', True)
+        merge_job = self.get_merge_job(options=MergeJobOptions.default(**options))
+        merge_job._api.version.return_value = marge.gitlab.Version.parse('13.0.0-ee')
+        merge_request = self._mock_merge_request(
+            iid=5, sha='mr-sha', target_branch='master', info={'diff_refs': {'base_sha': 'old-target-sha'}},
+        )
+        target_project = create_autospec(marge.project.Project, spec_set=True, merge_method=merge_method)
+        with patch('marge.job.Pipeline', autospec=True) as pipeline_class, \
+                patch('marge.job.Commit', autospec=True) as commit_class:
+            pipeline_class.pipelines_by_merge_request.return_value = pipelines
+            commit_class.last_on_branch.return_value.id = 'target-sha'
+            commit_class.fetch_by_id.return_value.parent_ids = parent_ids or []
+            result = merge_job.find_reusable_pipeline(merge_request, target_project)
+            if result is not None and result[1].ref.endswith('/merge'):
+                commit_class.fetch_by_id.assert_called_once_with(
+                    merge_request.target_project_id, result[1].sha, merge_job._api,
+                )
+        return merge_request, result
+
+    def test_find_reusable_pipeline_on_up_to_date_mr(self):
+        pipelines = [
+            MagicMock(sha='other-sha', status='failed', ref='feature'),
+            MagicMock(sha='mr-sha', status='success', ref='feature'),
+        ]
+        merge_request, result = self._find_reusable_pipeline(pipelines)
+        assert result is None
+
+        merge_job = self.get_merge_job(options=MergeJobOptions.default(reuse_pipelines=True))
+        merge_job._api.version.return_value = marge.gitlab.Version.parse('13.0.0-ee')
+        merge_request.info = {'diff_refs': {'base_sha': 'target-sha', 'head_sha': 'mr-sha'}}
+        with patch('marge.job.Pipeline', autospec=True) as pipeline_class, \
+                patch('marge.job.Commit', autospec=True) as commit_class:
+            pipeline_class.pipelines_by_merge_request.return_value = pipelines
+            commit_class.last_on_branch.return_value.id = 'target-sha'
+            target_project = create_autospec(marge.project.Project, spec_set=True, merge_method='ff')
+            result = merge_job.find_reusable_pipeline(merge_request, target_project)
+            assert result == ('target-sha', pipelines[1])
+
+            # the diff refs of an older version of the MR, which may not have been up to date
+            merge_request.info = {'diff_refs': {'base_sha': 'target-sha', 'head_sha': 'older-mr-sha'}}
+            assert merge_job.find_reusable_pipeline(merge_request, target_project) is None
+
+            merge_request.info = {'diff_refs': {'base_sha': 'target-sha', 'head_sha': 'mr-sha'}}
+            pipelines[1].status = 'running'
+            assert merge_job.find_reusable_pipeline(merge_request, target_project) is None
+
+    @pytest.mark.parametrize('options', [
+        {'reuse_pipelines': False},
+        {'add_part_of': True},
+        {'guarantee_final_pipeline': True},
+    ])
+    def test_find_reusable_pipeline_disabled(self, options):
+        options = dict({'reuse_pipelines': True}, **options)
+        merge_job = self.get_merge_job(options=MergeJobOptions.default(**options))
+        with patch('marge.job.Pipeline', autospec=True) as pipeline_class:
+            assert merge_job.find_reusable_pipeline(self._mock_merge_request(), None) is None
+            pipeline_class.pipelines_by_merge_request.assert_not_called()
+
+    def test_find_reusable_merge_result_pipeline(self):
+        merge_ref = 'refs/merge-requests/5/merge'
+        pipelines = [MagicMock(sha='merge-sha', status='success', ref=merge_ref)]
+
+        _, result = self._find_reusable_pipeline(
+            pipelines, parent_ids=['target-sha', 'mr-sha'], reuse_merge_result_pipelines=True,
+        )
+        assert result == ('target-sha', pipelines[0])
+
+        # it tested the MR on an older head of the target branch
+        _, result = self._find_reusable_pipeline(
+            pipelines, parent_ids=['old-target-sha', 'mr-sha'], reuse_merge_result_pipelines=True,
+        )
+        assert result is None
+
+        _, result = self._find_reusable_pipeline(pipelines, parent_ids=['target-sha', 'mr-sha'])
+        assert result is None
+
+        _, result = self._find_reusable_pipeline(
+            pipelines, merge_method='ff', parent_ids=['target-sha', 'mr-sha'],
+            reuse_merge_result_pipelines=True,
+        )
+        assert result is None
+
     def test_ensure_mergeable_mr_not_assigned(self):
         merge_job = self.get_merge_job()
         merge_request = self._mock_merge_request(
@@ -218,6 +411,9 @@ class TestMergeJobOptions:
             use_merge_commit_batches=False,
             skip_ci_batches=False,
             guarantee_final_pipeline=False,
+            use_graphql=False,
+            reuse_pipelines=False,
+            reuse_merge_result_pipelines=False,
         )
 
     def test_default_ci_time(self):
@@ -0,0 +1,53 @@
+from marge.job_state import BatchState, JobStateStore, PUSHED
+
+
+def test_record_push():
+    store = JobStateStore(':memory:')
+    assert store.merge_request_state(1, 2) is None
+
+    store.record_push(1, 2, 'target', 'pushed')
+    state = store.merge_request_state(1, 2)
+    assert (state.project_id, state.iid, state.phase) == (1, 2, PUSHED)
+    assert (state.target_sha, state.pushed_sha) == ('target', 'pushed')
+    assert store.merge_request_state(1, 3) is None
+
+    store.record_push(1, 2, 'new-target', 'new-pushed')
+    assert store.merge_request_state(1, 2).pushed_sha == 'new-pushed'
+
+    store.forget_merge_request(1, 2)
+    assert store.merge_request_state(1, 2) is None
+
+
+def test_record_batch():
+    store = JobStateStore(':memory:')
+    assert store.batch_state(1, 'master') is None
+
+    store.record_batch(1, 'master', batch_mr_iid=7, batch_sha='batch', target_sha='target',
+                       members=[(3, 'c'), (2, 'b'), (4, 'd')])
+    store.record_batch(1, 'release', batch_mr_iid=8, batch_sha='batch2', target_sha='target2',
+                       members=[(5, 'e')])
+    assert store.batch_state(1, 'master') == BatchState(
+        project_id=1, target_branch='master', batch_mr_iid=7, batch_sha='batch', target_sha='target',
+        members=[(3, 'c'), (2, 'b'), (4, 'd')],
+    )
+
+    store.record_batch(1, 'master', batch_mr_iid=9, batch_sha='batch3', target_sha='target',
+                       members=[(2, 'b')])
+    assert store.batch_state(1, 'master').members == [(2, 'b')]
+
+    store.forget_batch(1, 'master')
+    assert store.batch_state(1, 'master') is None
+    assert store.batch_state(1, 'release').members == [(5, 'e')]
+
+
+def test_survives_restarts(tmpdir):
+    path = str(tmpdir.join('state.sqlite'))
+    store = JobStateStore(path)
+    store.record_push(1, 2, 'target', 'pushed')
+    store.record_batch(1, 'master', batch_mr_iid=7, batch_sha='batch', target_sha='target',
+                       members=[(3, 'c')])
+    store.close()
+
+    store = JobStateStore(path)
+    assert store.merge_request_state(1, 2).pushed_sha == 'pushed'
+    assert store.batch_state(1, 'master').members == [(3, 'c')]
@@ -0,0 +1,84 @@
+from marge import latency
+from marge.latency import LatencyStore
+
+
+def record(store, iid, outcome='merged', project='cool/project', started_at=1000, phases=None):
+    store.record(
+        project_id=1234 if project == 'cool/project' else 5678, project=project, iid=iid,
+        job='SingleMergeJob', outcome=outcome, started_at=started_at, finished_at=started_at + 100,
+        phases=[('rebase', started_at, 10), ('ci', started_at + 10, 80)] if phases is None else phases,
+    )
+
+
+class TestLatencyStore:
+
+    def test_queued_since_first_seen(self):
+        store = LatencyStore(':memory:')
+        store.mark_seen(1234, [1, 2], now=900)
+        store.mark_seen(1234, [1, 3], now=950)  # MR 1 is still the one seen at 900
+        record(store, 1)
+        record(store, 3, outcome='cannot merge')
+        record(store, 4)  # never seen: not queued
+
+        durations = store.durations()
+        assert durations[('cool/project', 'queued')] == [100, 0]
+        assert durations[('cool/project', 'total')] == [200, 100]
+        assert durations[('cool/project', 'ci')] == [80, 80]
+        assert store.durations(outcome='cannot merge')[('cool/project', 'queued')] == [50]
+
+    def test_queues_anew_after_a_job(self):
+        store = LatencyStore(':memory:')
+        store.mark_seen(1234, [1], now=900)
+        record(store, 1, outcome='skipped')
+        store.mark_seen(1234, [1], now=1500)
+        record(store, 1, started_at=1600)
+
+        assert store.durations()[('cool/project', 'queued')] == [100]
+
+    def test_repeated_phases_add_up(self):
+        store = LatencyStore(':memory:')
+        record(store, 1, phases=[('ci', 1000, 30), ('ci', 1050, 20)])
+        assert store.durations()[('cool/project', 'ci')] == [50]
+
+    def test_drops_the_history_past_max_age(self):
+        store = LatencyStore(':memory:', max_age=500)
+        store.mark_seen(1234, [1], now=900)
+        store.mark_seen(1234, [2], now=950)  # never worked on
+        record(store, 1, started_at=1000)
+        record(store, 3, started_at=1600)  # finished at 1700: what finished before 1200 goes
+        assert store.durations()[('cool/project', 'total')] == [100]
+        store.mark_seen(1234, [2], now=2000)
+        record(store, 2, started_at=2000)
+        assert store.durations()[('cool/project', 'queued')] == [0, 0]
+
+    def test_since(self):
+        store = LatencyStore(':memory:')
+        record(store, 1, started_at=1000)
+        record(store, 2, started_at=2000)
+        assert store.durations(since=1500)[('cool/project', 'total')] == [100]
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert [latency.percentile(values, point) for point in (50, 90, 99, 100)] == [50, 90, 99, 100]
+    assert latency.percentile([7], 50) == 7
+    assert latency.percentile([1, 2, 3], 50) == 2
+
+
+def test_report():
+    store = LatencyStore(':memory:')
+    assert latency.report(store) == 'No merged merge requests recorded.\n'
+
+    store.mark_seen(1234, [1], now=990)
+    record(store, 1)
+    record(store, 2, project='cool/other', phases=[('ci', 1000, 4000)])
+    assert latency.report(store).splitlines() == [
+        'project       phase    count        p50        p90        p99',
+        'cool/other    queued       1       0.0s       0.0s       0.0s',
+        'cool/other    ci           1       1.1h       1.1h       1.1h',
+        'cool/other    total        1     1.7min     1.7min     1.7min',
+        'cool/project  queued       1      10.0s      10.0s      10.0s',
+        'cool/project  ci           1     1.3min     1.3min     1.3min',
+        'cool/project  rebase       1      10.0s      10.0s      10.0s',
+        'cool/project  total        1     1.8min     1.8min     1.8min',
+    ]
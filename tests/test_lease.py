@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from marge.lease import LeaseLost, LeaseManager
+
+
+def test_acquire_and_release(tmpdir):
+    first = LeaseManager(str(tmpdir), owner='first', ttl=60)
+    second = LeaseManager(str(tmpdir), owner='second', ttl=60)
+
+    lease = first.acquire(1)
+    assert lease is not None
+    lease.check()
+    assert second.acquire(1) is None
+    assert second.acquire(2) is not None
+
+    lease.release()
+    with pytest.raises(LeaseLost):
+        lease.check()
+    assert second.acquire(1) is not None
+    assert first.acquire(1) is None
+
+
+def test_expired_leases_are_taken_over(tmpdir, monkeypatch):
+    first = LeaseManager(str(tmpdir), owner='first', ttl=60)
+    second = LeaseManager(str(tmpdir), owner='second', ttl=60)
+    lease = first.acquire(1)
+
+    now = time.time()
+    monkeypatch.setattr('marge.lease.time.time', lambda: now + 61)
+    with pytest.raises(LeaseLost):
+        lease.check()
+    taken_over = second.acquire(1)
+    assert taken_over is not None
+
+    lease.renew()
+    assert lease.lost
+    taken_over.check()
+
+
+def test_renewal(tmpdir, monkeypatch):
+    first = LeaseManager(str(tmpdir), owner='first', ttl=60)
+    second = LeaseManager(str(tmpdir), owner='second', ttl=60)
+    lease = first.acquire(1)
+
+    now = time.time()
+    monkeypatch.setattr('marge.lease.time.time', lambda: now + 50)
+    lease.renew()
+    monkeypatch.setattr('marge.lease.time.time', lambda: now + 100)
+    lease.check()
+    assert second.acquire(1) is None
+
+
+def test_stop_releases_leases(tmpdir):
+    first = LeaseManager(str(tmpdir), owner='first', ttl=0.03)
+    first.start()
+    lease = first.acquire(1)
+    time.sleep(0.1)  # outlives the ttl, thanks to renewals
+    lease.check()
+    first.stop()
+    assert LeaseManager(str(tmpdir), owner='second', ttl=60).acquire(1) is not None
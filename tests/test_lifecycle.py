@@ -0,0 +1,101 @@
+import io
+import logging
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import marge.lifecycle as lifecycle
+import marge.profiling as profiling
+
+
+@pytest.fixture(autouse=True)
+def not_stopping(monkeypatch):
+    monkeypatch.setattr(lifecycle, '_stopping', threading.Event())
+
+
+class FakeJob:
+
+    def status(self):
+        return {
+            'job': 'SingleMergeJob',
+            'project': 'some/project',
+            'merge_requests': [54],
+            'phases': [('ci', 120.4)],
+            'waiting_on': [('CI of MR !54 at abc', 100)],
+        }
+
+
+def test_check():
+    lifecycle.check()
+    lifecycle._stopping.set()  # pylint: disable=protected-access
+    assert lifecycle.stopping()
+    with pytest.raises(lifecycle.ShutdownRequested):
+        lifecycle.check()
+
+
+def test_request_stop():
+    assert not lifecycle.stopping()
+    lifecycle.request_stop()
+    with pytest.raises(lifecycle.ShutdownRequested):
+        lifecycle.check()
+
+
+def test_job_registry():
+    registry = lifecycle.JobRegistry()
+    job = FakeJob()
+    with registry.running(job):
+        assert registry.jobs() == [job]
+    assert registry.jobs() == []
+
+
+def test_dump_state():
+    registry = lifecycle.JobRegistry()
+    out = io.StringIO()
+    with registry.running(FakeJob()):
+        lifecycle.dump_state(registry, out=out)
+    lines = out.getvalue().splitlines()
+    assert lines[1:4] == [
+        'SingleMergeJob on some/project, merge requests !54:',
+        "  in phase 'ci' for 120s",
+        '  waiting on CI of MR !54 at abc for 100s',
+    ]
+    assert 'Thread MainThread ({}):'.format(threading.main_thread().ident) in lines
+    assert any('test_dump_state' in line for line in lines)
+
+
+def test_sigterm_interrupts_sleeps_only():
+    with lifecycle.signal_handlers(lifecycle.JobRegistry()):
+        with pytest.raises(lifecycle.ShutdownRequested):
+            with lifecycle.interruptible():
+                os.kill(os.getpid(), signal.SIGTERM)
+                time.sleep(10)
+    assert lifecycle.stopping()
+    assert signal.getsignal(signal.SIGTERM) is signal.SIG_DFL
+
+
+def test_sigterm_lets_the_current_work_finish():
+    with lifecycle.signal_handlers(lifecycle.JobRegistry()):
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert lifecycle.stopping()
+        with pytest.raises(lifecycle.ShutdownRequested):
+            lifecycle.check()
+
+
+def test_sigusr2_toggles_profiling(monkeypatch):
+    profiler = profiling.Profiler(interval=0.005)
+    monkeypatch.setattr(profiling, 'PROFILER', profiler)
+    with lifecycle.signal_handlers(lifecycle.JobRegistry()):
+        os.kill(os.getpid(), signal.SIGUSR2)
+        assert profiler.running
+        os.kill(os.getpid(), signal.SIGUSR2)
+        assert not profiler.running
+
+
+def test_sigusr1_dumps_state(caplog):
+    registry = lifecycle.JobRegistry()
+    with caplog.at_level(logging.INFO), lifecycle.signal_handlers(registry), registry.running(FakeJob()):
+        os.kill(os.getpid(), signal.SIGUSR1)
+    assert 'SingleMergeJob on some/project, merge requests !54:' in caplog.text
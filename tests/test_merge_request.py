@@ -3,7 +3,7 @@ from unittest.mock import call, Mock
 import pytest
 
 from marge.gitlab import Api, GET, POST, PUT, Version
-from marge.merge_request import MergeRequest, MergeRequestRebaseFailed
+from marge.merge_request import MergeRequest, MergeRequestRebaseFailed, fetch_project_ids_assigned_to
 import marge.user
 
 from tests.test_user import INFO as USER_INFO
@@ -214,6 +214,18 @@ class TestMergeRequest:
         ))
         assert [mr.info for mr in result] == [mr1, mr2]
 
+    def test_fetch_project_ids_assigned_to(self):
+        api = self.api
+        user = marge.user.User(api=None, info=dict(USER_INFO, id=_MARGE_ID))
+        mr1, mr2, mr_elsewhere = INFO, dict(INFO, id=679), dict(INFO, id=680, project_id=99)
+        api.collect_all_pages = Mock(return_value=[mr1, mr2, mr_elsewhere])
+        result = fetch_project_ids_assigned_to(user=user, api=api)
+        api.collect_all_pages.assert_called_once_with(GET(
+            '/merge_requests',
+            {'state': 'opened', 'scope': 'all', 'assignee_id': _MARGE_ID},
+        ))
+        assert result == {1234, 99}
+
     def test_fetch_assigned_at(self):
         api = self.api
         dis1, dis2 = DISCUSSION, dict(DISCUSSION, id=679)
@@ -0,0 +1,94 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from marge import metrics, profiling
+
+
+def test_counter_and_gauge():
+    registry = metrics.Registry()
+    requests = registry.register(metrics.Counter('requests_total', 'Requests.', ['status']))
+    depth = registry.register(metrics.Gauge('queue_depth', 'Queued "things".\nMany.', ['project']))
+
+    requests.inc(status=200)
+    requests.inc(2, status=200)
+    requests.inc(status=404)
+    depth.set(3, project='cool/"project"')
+
+    assert requests.value(status=200) == 3
+    assert registry.render() == '\n'.join([
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{status="200"} 3',
+        'requests_total{status="404"} 1',
+        '# HELP queue_depth Queued "things".\\nMany.',
+        '# TYPE queue_depth gauge',
+        'queue_depth{project="cool/\\"project\\""} 3',
+    ]) + '\n'
+
+    depth.remove(project='cool/"project"')
+    assert depth.value(project='cool/"project"') is None
+
+
+def test_histogram():
+    histogram = metrics.Histogram('duration_seconds', 'Durations.', buckets=(1, 2.5))
+    for value in (0.5, 1, 2, 10):
+        histogram.observe(value)
+
+    assert histogram.count() == 4
+    assert histogram.render()[2:] == [
+        'duration_seconds_bucket{le="1"} 2',
+        'duration_seconds_bucket{le="2.5"} 3',
+        'duration_seconds_bucket{le="+Inf"} 4',
+        'duration_seconds_sum 13.5',
+        'duration_seconds_count 4',
+    ]
+
+
+def test_labels_are_checked():
+    counter = metrics.Counter('requests_total', 'Requests.', ['status'])
+    with pytest.raises(ValueError):
+        counter.inc(code=200)
+
+
+@pytest.mark.parametrize('endpoint,label', [
+    ('/projects/1234/merge_requests/5/notes', '/projects/:id/merge_requests/:id/notes'),
+    ('/projects/1234/repository/branches/feature/x', '/projects/:id/repository/branches/:name'),
+    ('/projects/1234/repository/commits/0123abcd', '/projects/:id/repository/commits/:name'),
+    ('/users/7?sudo=1', '/users/:id'),
+    ('/version', '/version'),
+])
+def test_endpoint_label(endpoint, label):
+    assert metrics.endpoint_label(endpoint) == label
+
+
+def test_http_server():
+    registry = metrics.Registry()
+    registry.register(metrics.Gauge('up', 'Whether the bot is up.')).set(1)
+    server = metrics.start_http_server(0, addr='127.0.0.1', registry=registry)
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+            assert response.read().decode('utf-8').endswith('up 1\n')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_server_profiles(monkeypatch):
+    monkeypatch.setattr('marge.profiling.PROFILER', profiling.Profiler(interval=0.001))
+    server = metrics.start_http_server(0, addr='127.0.0.1', registry=metrics.Registry())
+    try:
+        url = 'http://127.0.0.1:{}/debug/profile'.format(server.server_address[1])
+        with urllib.request.urlopen(url + '?seconds=0.05&format=speedscope') as response:
+            assert response.headers['Content-Type'] == 'application/json; charset=utf-8'
+            assert json.loads(response.read().decode('utf-8'))['exporter'] == 'marge-bot'
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + '?seconds=0')  # pylint: disable=consider-using-with
+        assert error.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
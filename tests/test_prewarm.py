@@ -0,0 +1,159 @@
+import re
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import marge.git
+import marge.git_pool
+import marge.project
+import marge.store
+import marge.user
+from marge.prewarm import Prewarmer
+from tests.test_project import INFO as PRJ_INFO
+from tests.test_user import INFO as USER_INFO
+
+NOW = datetime(2021, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def new_project(project_id, path, active_ago=None):
+    last_activity_at = None
+    if active_ago is not None:
+        last_activity_at = (NOW - active_ago).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    info = dict(
+        PRJ_INFO, id=project_id, path_with_namespace=path, ssh_url_to_repo='ssh://buh.com/%s.git' % path,
+        last_activity_at=last_activity_at,
+    )
+    return marge.project.Project(api=None, info=info)
+
+
+def wait_for(git_pool):
+    deadline = time.monotonic() + 5
+    while git_pool.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+# pylint: disable=attribute-defined-outside-init
+class TestPrewarmer:
+
+    def setup_method(self, _method):
+        self.git_run = mock.patch('marge.git._run').start()
+        self.now = NOW.timestamp()
+        mock.patch('marge.prewarm.time.time', lambda: self.now).start()
+        self.disk_usage = mock.patch('marge.prewarm._disk_usage', return_value=100).start()
+        self.root_dir = tempfile.TemporaryDirectory()
+        self.git_pool = marge.git_pool.GitPool(max_workers=4)
+        user = marge.user.User(api=None, info=dict(USER_INFO, name='Peter Parker', email='pparker@bugle.com'))
+        self.repo_manager = marge.store.SshRepoManager(
+            user=user, root_dir=self.root_dir.name, git_pool=self.git_pool,
+        )
+
+    def teardown_method(self, _method):
+        self.git_pool.close()
+        mock.patch.stopall()
+        self.root_dir.cleanup()
+
+    def prewarmer(self, **kwargs):
+        options = {'active_within': 3600, 'concurrency': 2, 'disk_budget': 1000, 'refresh_interval': 600}
+        options.update(kwargs)
+        return Prewarmer(self.repo_manager, self.git_pool, **options)
+
+    def git_commands(self):
+        return [args[3] if args[1] == '-C' else args[1] for args, _ in self.git_run.call_args_list]
+
+    def cloned(self):
+        return sorted(args[-2] for args, _ in self.git_run.call_args_list if args[1] == 'clone')
+
+    def test_warms_up_allowed_then_recently_active_projects(self):
+        projects = [
+            new_project(1, 'some/idle'),
+            new_project(2, 'some/stale', active_ago=timedelta(hours=2)),
+            new_project(3, 'some/active', active_ago=timedelta(minutes=30)),
+            new_project(4, 'some/busy', active_ago=timedelta(minutes=1)),
+            new_project(5, 'monorepo/main'),
+        ]
+        prewarmer = self.prewarmer(allowlist=re.compile('monorepo/'))
+
+        prewarmer.update(projects)
+        wait_for(self.git_pool)
+        assert self.cloned() == ['ssh://buh.com/monorepo/main.git', 'ssh://buh.com/some/busy.git']
+
+        prewarmer.update(projects)
+        wait_for(self.git_pool)
+        assert len(self.cloned()) == 3
+        assert self.cloned()[1] == 'ssh://buh.com/some/active.git'
+        assert prewarmer.disk_usage() == 200  # the last clone is counted on the next update
+
+        # the jobs find the repos warm
+        assert self.repo_manager.clone_in_background(projects[3])
+
+    def test_refreshes_warm_repos(self):
+        project = new_project(1, 'some/busy', active_ago=timedelta(minutes=1))
+        prewarmer = self.prewarmer()
+        prewarmer.update([project])
+        wait_for(self.git_pool)
+        prewarmer.update([project])
+        assert self.git_commands().count('fetch') == 0
+
+        self.now += 601
+        prewarmer.update([project])
+        wait_for(self.git_pool)
+        assert self.git_commands().count('fetch') == 1
+
+    def test_stays_within_the_disk_budget(self):
+        busy = new_project(1, 'some/busy', active_ago=timedelta(minutes=1))
+        active = new_project(2, 'some/active', active_ago=timedelta(minutes=2))
+        prewarmer = self.prewarmer(disk_budget=150)
+        prewarmer.update([busy])
+        wait_for(self.git_pool)
+        prewarmer.update([busy, active])
+        wait_for(self.git_pool)
+        assert prewarmer.disk_usage() == 100
+        assert len(self.cloned()) == 2  # it was under budget then
+
+        prewarmer.update([busy, active])
+        assert prewarmer.disk_usage() == 200
+        assert len(self.cloned()) == 2
+
+        # some/busy is no longer a candidate: its repo goes
+        busy_repo = self.repo_manager.repo_for_project(busy)
+        self.now += 3600
+        prewarmer.update([new_project(2, 'some/active', active_ago=timedelta(0))])
+        wait_for(self.git_pool)
+        assert prewarmer.disk_usage() == 100
+        assert self.repo_manager.repo_for_project(busy) is not busy_repo
+
+    def test_does_not_retry_failed_clones_straight_away(self):
+        project = new_project(1, 'some/busy', active_ago=timedelta(minutes=1))
+        self.git_run.side_effect = marge.git.GitError('no route to host')
+        prewarmer = self.prewarmer()
+        prewarmer.update([project])
+        wait_for(self.git_pool)
+        prewarmer.update([project])
+        wait_for(self.git_pool)
+        assert len(self.cloned()) == 1
+        assert prewarmer.disk_usage() == 0
+
+        # a job clones it again
+        self.git_run.side_effect = None
+        assert not self.repo_manager.clone_in_background(project)
+        wait_for(self.git_pool)
+        assert len(self.cloned()) == 2
+
+        self.now += 601
+        prewarmer.update([project])
+        assert len(self.cloned()) == 2  # the job's repo is up to date
+
+    def test_caps_the_work_in_flight(self, monkeypatch):
+        projects = [new_project(i, 'some/p%s' % i, active_ago=timedelta(minutes=i)) for i in range(1, 6)]
+        started = []
+
+        def repo_future(project):
+            started.append(project.id)
+            return mock.Mock(done=mock.Mock(return_value=False))
+
+        monkeypatch.setattr(self.repo_manager, 'repo_future', repo_future)
+        prewarmer = self.prewarmer(concurrency=3)
+        prewarmer.update(projects)
+        prewarmer.update(projects)
+        assert started == [1, 2, 3]
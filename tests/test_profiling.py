@@ -0,0 +1,84 @@
+import json
+import os
+import threading
+
+from marge import profiling
+
+
+def busy(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def profile_busy_thread(profiler, duration=0.1):
+    stop = threading.Event()
+    thread = threading.Thread(target=busy, args=(stop,), name='busy')
+    thread.start()
+    try:
+        return profiler.profile(duration)
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_profile():
+    profiler = profiling.Profiler(interval=0.005)
+    profile = profile_busy_thread(profiler)
+    assert not profiler.running
+    assert profile.duration >= 0.1
+    busy_stacks = [stack for stack in profile.samples if stack[0] == 'busy']
+    assert busy_stacks
+    assert all(any(frame.startswith('busy (test_profiling.py:') for frame in stack) for stack in busy_stacks)
+    assert not any(stack[0] == 'profiler' for stack in profile.samples)
+
+
+def test_collapsed_and_speedscope():
+    profile = profiling.Profile(interval=0.01)
+    profile.samples[('MainThread', 'main (a.py:1)', 'f (a.py:5)')] = 3
+    profile.samples[('worker', 'run (b.py:2)')] = 1
+    assert profile.collapsed() == 'MainThread;main (a.py:1);f (a.py:5) 3\nworker;run (b.py:2) 1\n'
+
+    speedscope = json.loads(profile.speedscope())
+    assert [frame['name'] for frame in speedscope['shared']['frames']] == [
+        'main (a.py:1)', 'f (a.py:5)', 'run (b.py:2)',
+    ]
+    [main, worker] = speedscope['profiles']
+    assert (main['name'], main['samples'], main['weights']) == ('MainThread', [[0, 1]], [0.03])
+    assert (worker['name'], worker['samples'], worker['weights']) == ('worker', [[2]], [0.01])
+
+
+def test_phase_report():
+    profiler = profiling.Profiler(interval=0.005)
+    profiler.record_phase('ci', 10, 1)  # not profiling: ignored
+    assert profiler.start(duration=10)
+    profiler.record_phase('ci', 10, 1)
+    profiler.record_phase('ci', 20, 2)
+    profiler.record_phase('rebase', 2, 1.5)
+    profile = profiler.stop()
+    assert profile.phase_report().splitlines() == [
+        'phase                 count   wall (s)    cpu (s)  cpu %',
+        'ci                        2      30.00       3.00    10%',
+        'rebase                    1       2.00       1.50    75%',
+    ]
+
+
+def test_toggle_writes_the_profile(tmpdir):
+    profiler = profiling.Profiler(interval=0.005, output_dir=str(tmpdir), output_format=profiling.SPEEDSCOPE)
+    profiler.toggle()
+    assert profiler.running
+    profiler.toggle()
+    assert not profiler.running
+    names = sorted(os.listdir(str(tmpdir)))
+    assert len(names) == 2
+    assert names[0].endswith('.phases.txt') and names[1].endswith('.speedscope.json')
+    with open(str(tmpdir.join(names[1])), encoding='utf-8') as profile_file:
+        assert json.load(profile_file)['profiles'] is not None
+
+
+def test_a_sampler_only_stops_its_own_profile():
+    profiler = profiling.Profiler(interval=0.005)
+    assert profiler.start(duration=10)
+    # the sampler of an earlier profile, stopped and replaced just as its duration ran out
+    profiler._sample(profiling.Profile(0.005), threading.Event(), 0)  # pylint: disable=protected-access
+    assert profiler.running
+    assert profiler.stop() is not None
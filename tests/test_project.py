@@ -1,8 +1,9 @@
-from unittest.mock import Mock
+from datetime import datetime, timezone
+from unittest.mock import Mock, patch
 import pytest
 
 from marge.gitlab import Api, GET, Version
-from marge.project import AccessLevel, Project
+from marge.project import AccessLevel, Project, ProjectCache
 
 
 INFO = {
@@ -117,3 +118,110 @@ class TestProject:
         assert project.access_level == AccessLevel.developer
         with pytest.raises(AssertionError):
             bad_project.access_level  # pylint: disable=pointless-statement
+
+
+SIMPLE_INFO = {
+    'id': 1234,
+    'path_with_namespace': 'cool/project',
+    'ssh_url_to_repo': 'ssh://blah.com/cool/project.git',
+    'default_branch': 'master',
+}
+
+
+def test_fetch_all_mine_simple_since():
+    api = Mock(Api)
+    api.collect_all_pages = Mock(return_value=[dict(SIMPLE_INFO)])
+    api.version = Mock(return_value=Version.parse("11.2.0-ee"))
+    since = datetime(2020, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+    result = Project.fetch_all_mine(api, simple=True, last_activity_after=since)
+    api.collect_all_pages.assert_called_once_with(GET(
+        '/projects',
+        {
+            'membership': True,
+            'with_merge_requests_enabled': True,
+            'archived': False,
+            'min_access_level': AccessLevel.developer.value,
+            'simple': True,
+            'last_activity_after': '2020-01-02T03:04:05+00:00',
+        },
+    ))
+    assert [project.id for project in result] == [1234]
+    assert result[0].access_level == AccessLevel.developer
+
+
+def test_fetch_all_mine_compact():
+    api = Mock(Api)
+    api.collect_all_pages = Mock(return_value=[dict(SIMPLE_INFO, last_activity_at='2020-01-02T03:04:05Z')])
+    api.version = Mock(return_value=Version.parse("11.2.0-ee"))
+    api.call = Mock(return_value=INFO)
+
+    [project] = Project.fetch_all_mine(api, simple=True, compact=True)
+    assert (project.id, project.path_with_namespace) == (1234, 'cool/project')
+    assert project.access_level == AccessLevel.developer
+    assert project.info.get('last_activity_at') == '2020-01-02T03:04:05Z'
+    assert project.ssh_url_to_repo == SIMPLE_INFO['ssh_url_to_repo']  # to clone it
+    assert 'only_allow_merge_if_pipeline_succeeds' not in project.info.to_dict()
+    api.call.assert_not_called()
+
+    # the other fields are fetched on demand, once
+    assert project.only_allow_merge_if_pipeline_succeeds is True
+    assert project.default_branch == INFO['default_branch']
+    api.call.assert_called_once_with(GET('/projects/1234'))
+    assert project.info == INFO
+
+
+# pylint: disable=attribute-defined-outside-init
+class TestProjectCache:
+
+    def setup_method(self, _method):
+        self.api = Mock(Api)
+        self.api.version = Mock(return_value=Version.parse("12.0.0-ee"))
+        self.api.call = Mock(return_value=INFO)
+        self.cache = ProjectCache(self.api, full_refresh_interval=600, details_ttl=60)
+
+    def listing_args(self):
+        return [command.args for (command,), _ in self.api.collect_all_pages.call_args_list]
+
+    def test_incremental_refresh(self):
+        other = dict(SIMPLE_INFO, id=5678, path_with_namespace='cool/other')
+        self.api.collect_all_pages = Mock(return_value=[dict(SIMPLE_INFO), other])
+        with patch('marge.project.time.time', return_value=1000):
+            assert [project.id for project in self.cache.fetch_all_mine()] == [1234, 5678]
+
+        renamed = dict(other, path_with_namespace='cool/renamed')
+        self.api.collect_all_pages = Mock(return_value=[renamed])
+        with patch('marge.project.time.time', return_value=1030):
+            projects = self.cache.fetch_all_mine()
+        assert [project.path_with_namespace for project in projects] == ['cool/project', 'cool/renamed']
+        [args] = self.listing_args()
+        assert args['simple'] is True
+        # 5 minutes of clock skew allowance before the previous refresh at t=1000
+        assert args['last_activity_after'] == datetime.fromtimestamp(700, timezone.utc).isoformat()
+
+    def test_full_refresh_forgets_projects(self):
+        self.api.collect_all_pages = Mock(return_value=[dict(SIMPLE_INFO)])
+        with patch('marge.project.time.time', return_value=1000):
+            self.cache.fetch_all_mine()
+
+        self.api.collect_all_pages = Mock(return_value=[])
+        with patch('marge.project.time.time', return_value=1600):
+            assert self.cache.fetch_all_mine() == []
+        [args] = self.listing_args()
+        assert 'last_activity_after' not in args
+
+    def test_fetch_by_id_is_cached(self):
+        with patch('marge.project.time.time', return_value=1000):
+            project = self.cache.fetch_by_id(1234)
+            assert self.cache.fetch_by_id(1234) is project
+        assert project.only_allow_merge_if_pipeline_succeeds is True
+        self.api.call.assert_called_once_with(GET('/projects/1234'))
+
+        with patch('marge.project.time.time', return_value=1061):
+            assert self.cache.fetch_by_id(1234) is not project
+        assert self.api.call.call_count == 2
+
+        self.cache.invalidate(1234)
+        with patch('marge.project.time.time', return_value=1062):
+            self.cache.fetch_by_id(1234)
+        assert self.api.call.call_count == 3
@@ -0,0 +1,141 @@
+import re
+from unittest.mock import Mock, patch
+
+from marge import metrics
+from marge.gitlab import NotFound
+from marge.scheduler import BRANCH, LABEL, NORMAL, Scheduler
+
+
+def _project(project_id):
+    return Mock(id=project_id)
+
+
+def _merge_request(iid, labels=(), target_branch='master', updated_at=None):
+    return Mock(iid=iid, target_branch=target_branch, info={'labels': list(labels), 'updated_at': updated_at})
+
+
+def _scheduler(**kwargs):
+    return Scheduler(labels=['hotfix'], branch_regexp=re.compile('release/.*'), aging=100, **kwargs)
+
+
+def _at(timestamp):
+    return patch('marge.scheduler.time.time', return_value=timestamp)
+
+
+def test_priority_class():
+    scheduler = _scheduler()
+    assert scheduler.priority_class(_merge_request(1, labels=['hotfix'], target_branch='release/1')) == LABEL
+    assert scheduler.priority_class(_merge_request(1, target_branch='release/1')) == BRANCH
+    assert scheduler.priority_class(_merge_request(1, labels=['docs'])) == NORMAL
+    assert Scheduler().priority_class(_merge_request(1, labels=['hotfix'])) == NORMAL
+
+
+def test_urgent_project_goes_first():
+    scheduler = _scheduler()
+    normal, hotfix = _merge_request(1), _merge_request(2, labels=['hotfix'])
+    with _at(1000):
+        scheduler.enqueue(_project(1), [normal])
+        scheduler.enqueue(_project(2), [normal, hotfix])
+        scheduler.enqueue(_project(3), [_merge_request(3, target_branch='release/2')])
+
+        project, merge_requests = scheduler.pop()
+        assert project.id == 2
+        assert merge_requests == [hotfix, normal]
+        assert scheduler.pop()[0].id == 3
+        assert scheduler.pop()[0].id == 1
+        assert scheduler.pop() is None
+
+
+def test_aging_prevents_starvation():
+    scheduler = _scheduler()
+    with _at(1000):
+        scheduler.enqueue(_project(1), [_merge_request(1)])
+    with _at(1250):
+        scheduler.enqueue(_project(1), [_merge_request(1)])  # still the same MR; keeps waiting
+        scheduler.enqueue(_project(2), [_merge_request(2, labels=['hotfix'])])
+        assert scheduler.pop()[0].id == 1
+
+
+def test_waits_from_assignment_or_last_update():
+    assigned_at = {1: 1000, 2: 0}
+
+    def fetch_assigned_at(merge_request):
+        if merge_request.iid == 3:
+            raise NotFound(404, {'message': '404 Not Found'})
+        return assigned_at[merge_request.iid]
+
+    scheduler = _scheduler(assigned_at=fetch_assigned_at)
+    updated_at = '1970-01-01T00:16:40.000Z'  # 1000
+    with _at(1100):
+        scheduler.enqueue(_project(1), [
+            _merge_request(1),
+            _merge_request(2, updated_at=updated_at),
+            _merge_request(3, labels=['hotfix'], updated_at=updated_at),
+        ])
+        assert scheduler.stats()[NORMAL]['max_wait'] == 100
+        assert scheduler.stats()[LABEL]['max_wait'] == 100
+    with _at(1200):
+        assigned_at[1] = 1150  # only asked once per MR
+        scheduler.enqueue(_project(1), [_merge_request(1)])
+        assert scheduler.stats()[NORMAL]['max_wait'] == 200
+
+
+def test_exports_stats():
+    scheduler = _scheduler()
+    scheduler.record_duration(7, 60)
+    assert metrics.SCHEDULER_EXPECTED_JOB_DURATION.value(project_id=7) == 60
+    with _at(1000):
+        scheduler.enqueue(_project(7), [_merge_request(1), _merge_request(2)])
+    with _at(1030):
+        scheduler.stats()
+        assert metrics.SCHEDULER_QUEUED.value(priority_class=NORMAL) == 2
+        assert metrics.SCHEDULER_LONGEST_WAIT.value(priority_class=NORMAL) == 30
+        dispatched = metrics.SCHEDULER_DISPATCH_WAIT.count(priority_class=NORMAL)
+        scheduler.pop()
+        assert metrics.SCHEDULER_DISPATCH_WAIT.count(priority_class=NORMAL) == dispatched + 1
+
+
+def test_shorter_jobs_go_first():
+    scheduler = _scheduler()
+    scheduler.record_duration(1, 60)
+    scheduler.record_duration(2, 10)
+    with _at(1000):
+        scheduler.enqueue(_project(1), [_merge_request(1)])
+        scheduler.enqueue(_project(2), [_merge_request(2)])
+        assert scheduler.pop()[0].id == 2
+
+
+def test_expected_duration_is_smoothed():
+    scheduler = _scheduler()
+    assert scheduler.expected_duration(1) == 0
+    scheduler.record_duration(1, 100)
+    scheduler.record_duration(1, 200)
+    assert scheduler.expected_duration(1) == 0.3 * 200 + 0.7 * 100
+
+
+def test_stats():
+    scheduler = _scheduler()
+    with _at(1000):
+        scheduler.enqueue(_project(1), [_merge_request(1), _merge_request(2, labels=['hotfix'])])
+    with _at(1030):
+        scheduler.enqueue(_project(2), [_merge_request(1)])
+        stats = scheduler.stats()
+        assert stats[NORMAL] == {'queued': 2, 'max_wait': 30, 'mean_dispatch_wait': None}
+        assert stats[LABEL] == {'queued': 1, 'max_wait': 30, 'mean_dispatch_wait': None}
+        assert stats[BRANCH]['queued'] == 0
+
+        scheduler.pop()
+        stats = scheduler.stats()
+        assert stats[LABEL] == {'queued': 0, 'max_wait': 0, 'mean_dispatch_wait': 30}
+        assert stats[NORMAL]['queued'] == 1
+
+
+def test_merged_requests_are_forgotten():
+    scheduler = _scheduler()
+    with _at(1000):
+        scheduler.enqueue(_project(1), [_merge_request(1)])
+    with _at(1100):
+        scheduler.enqueue(_project(1), [])
+        assert scheduler.pop() is None
+        scheduler.enqueue(_project(1), [_merge_request(1)])
+        assert scheduler.stats()[NORMAL]['max_wait'] == 0
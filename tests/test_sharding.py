@@ -0,0 +1,59 @@
+import time
+from collections import Counter, namedtuple
+
+from marge.sharding import HashRing, ShardCoordinator
+
+Project = namedtuple('Project', 'id')
+
+PROJECTS = [Project(id) for id in range(1, 201)]
+
+
+def test_hash_ring_spreads_projects():
+    ring = HashRing(['a', 'b', 'c'])
+    shares = Counter(ring.owner(project.id) for project in PROJECTS)
+    assert set(shares) == {'a', 'b', 'c'}
+    assert min(shares.values()) > 30
+    assert HashRing([]).owner(1) is None
+
+
+def test_hash_ring_only_moves_the_share_of_a_new_member():
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['c', 'b', 'a', 'd'])
+    for project in PROJECTS:
+        owner = after.owner(project.id)
+        assert owner in ('d', before.owner(project.id))
+
+
+def test_select_splits_projects(tmpdir):
+    path = str(tmpdir.join('shard.db'))
+    first = ShardCoordinator(path, 'first', ttl=60)
+    assert first.select(PROJECTS) == PROJECTS
+
+    second = ShardCoordinator(path, 'second', ttl=60)
+    second.heartbeat()
+    ring = HashRing(['first', 'second'])
+    moved = [project for project in PROJECTS if ring.owner(project.id) == 'second']
+    assert moved
+
+    # first still holds the projects that moved, until its next cycle
+    assert second.select(PROJECTS) == []
+    assert first.select(PROJECTS) == [project for project in PROJECTS if project not in moved]
+    assert second.select(PROJECTS) == moved
+
+    # once second leaves, first takes everything back
+    second.stop()
+    assert first.select(PROJECTS) == PROJECTS
+
+
+def test_dead_instances_are_taken_over(tmpdir, monkeypatch):
+    path = str(tmpdir.join('shard.db'))
+    first = ShardCoordinator(path, 'first', ttl=60)
+    second = ShardCoordinator(path, 'second', ttl=60)
+    first.heartbeat()
+    assert second.select(PROJECTS)
+    assert len(first.select(PROJECTS)) < len(PROJECTS)
+
+    now = time.time()
+    monkeypatch.setattr('marge.sharding.time.time', lambda: now + 61)
+    assert first.select(PROJECTS) == PROJECTS
+    assert first.heartbeat() == ['first']
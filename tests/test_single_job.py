@@ -1,5 +1,6 @@
 # pylint: disable=too-many-locals
 import contextlib
+import time
 from collections import namedtuple
 from datetime import timedelta
 from functools import partial
@@ -12,11 +13,14 @@ import marge.interval
 import marge.git
 import marge.gitlab
 import marge.job
+import marge.pipeline
 import marge.project
 import marge.single_merge_job
 import marge.user
 from marge.gitlab import GET, PUT
-from marge.job import Fusion
+from marge.job import Fusion, JobServices
+from marge.job_state import JobStateStore
+from marge.latency import LatencyStore
 from marge.merge_request import MergeRequest
 from tests.git_repo_mock import RepoMock
 from tests.gitlab_api_mock import Error, Ok, MockLab
@@ -265,7 +269,7 @@ class TestUpdateAndAccept:  # pylint: disable=too-many-public-methods
         def make_mocks(
             initial_master_sha=None, rewritten_sha=None,
             extra_opts=None, extra_mocklab_opts=None,
-            on_push=None
+            on_push=None, job_state=None, latency_store=None,
         ):
             options = options_factory(**(extra_opts or {}))
             initial_master_sha = initial_master_sha or '505050505e'
@@ -309,6 +313,7 @@ class TestUpdateAndAccept:  # pylint: disable=too-many-public-methods
                 api=api, user=user,
                 project=project, merge_request=merge_request, repo=repo,
                 options=options,
+                services=JobServices.none()._replace(job_state=job_state, latency_store=latency_store),
             )
             return self.Mocks(mocklab=mocklab, api=api, job=job)
 
@@ -324,6 +329,39 @@ class TestUpdateAndAccept:  # pylint: disable=too-many-public-methods
         assert api.state == 'merged'
         assert api.notes == []
 
+    def test_records_push_until_merged(self, mocks_factory):
+        job_state = JobStateStore(':memory:')
+        record_push = job_state.record_push
+        recorded = []
+
+        def spy_record_push(*args):
+            recorded.append(args)
+            record_push(*args)
+
+        job_state.record_push = spy_record_push
+        mocklab, api, job = mocks_factory(job_state=job_state)
+        job.execute()
+
+        assert api.state == 'merged'
+        iid = mocklab.merge_request_info['iid']
+        assert recorded == [(1234, iid, mocklab.initial_master_sha, mocklab.rewritten_sha)]
+        assert job_state.merge_request_state(1234, mocklab.merge_request_info['iid']) is None
+
+    def test_records_latency(self, mocks_factory):
+        latency_store = LatencyStore(':memory:')
+        mocklab, api, job = mocks_factory(latency_store=latency_store)
+        iid = mocklab.merge_request_info['iid']
+        latency_store.mark_seen(1234, [iid], now=time.time() - 60)
+        job.execute()
+
+        assert api.state == 'merged'
+        durations = latency_store.durations()
+        phases = {phase for _, phase in durations}
+        assert {'queued', 'rebase', 'push', 'ci', 'merge status', 'approvals', 'accept', 'total'} <= phases
+        [queued] = durations[('cool/project', 'queued')]
+        assert queued >= 60
+        assert latency_store.durations(outcome='cannot merge') == {}
+
     def test_succeeds_with_updated_branch(self, mocks):
         mocklab, api, job = mocks
         api.add_transition(
@@ -357,6 +395,39 @@ class TestUpdateAndAccept:  # pylint: disable=too-many-public-methods
         assert api.state == 'merged'
         assert api.notes == []
 
+    def test_reuses_a_pipeline_that_tested_the_mr_as_it_is(self, mocks_factory):
+        def reject_push(*_args, **_kwargs):
+            assert False, 'pushed an MR whose pipeline could be reused'
+
+        mocklab, api, job = mocks_factory(on_push=reject_push)
+        source_project_id = mocklab.merge_request_info['source_project_id']
+        api.add_transition(
+            GET('/projects/{}/repository/branches/{}'.format(
+                source_project_id, mocklab.merge_request_info['source_branch'],
+            )),
+            Ok({'commit': _commit(commit_id=INITIAL_MR_SHA, status='success')}),
+            from_state='initial',
+        )
+        api.add_transition(
+            PUT(
+                '/projects/1234/merge_requests/{iid}/merge'.format(iid=mocklab.merge_request_info['iid']),
+                dict(sha=INITIAL_MR_SHA, should_remove_source_branch=True, merge_when_pipeline_succeeds=True),
+            ),
+            Ok({}),
+            from_state='initial', to_state='merged',
+        )
+        pipeline = marge.pipeline.Pipeline(api, _pipeline(sha1=INITIAL_MR_SHA, status='success'), 1234)
+        reusable_pipeline = (mocklab.initial_master_sha, pipeline)
+        with patch.object(job, 'find_reusable_pipeline', return_value=reusable_pipeline), \
+                patch.object(job, 'update_from_target_branch_and_push') as update_and_push, \
+                patch.object(job, 'wait_for_ci_to_pass') as wait_for_ci_to_pass:
+            job.execute()
+
+        assert api.state == 'merged'
+        assert api.notes == []
+        update_and_push.assert_not_called()
+        wait_for_ci_to_pass.assert_not_called()
+
     def test_succeeds_if_source_is_master(self, mocks_factory):
         mocklab, api, job = mocks_factory(
             extra_mocklab_opts=dict(merge_request_options={
@@ -783,3 +854,51 @@ class TestUpdateAndAccept:  # pylint: disable=too-many-public-methods
 
         assert api.state == 'initial'
         assert api.notes == ["I couldn't merge this branch: {}".format(expected_message)]
+
+
+MERGE_REQUEST_INFO = {'iid': 54, 'target_branch': 'master'}
+
+
+class TestResumePush:
+    def get_job(self, job_state, merge_request):
+        project = marge.project.Project(api=None, info=TEST_PROJECT_INFO)
+        return marge.single_merge_job.SingleMergeJob(
+            api=None,
+            user=marge.user.User(api=None, info={'id': 1}),
+            project=project,
+            merge_request=merge_request,
+            repo=None,
+            options=marge.job.MergeJobOptions.default(),
+            services=JobServices.none()._replace(job_state=job_state),
+        )
+
+    def test_resumes_unchanged_push(self):
+        job_state = JobStateStore(':memory:')
+        job_state.record_push(1234, 54, 'target-sha', 'pushed-sha')
+        merge_request = MergeRequest(api=None, info=dict(MERGE_REQUEST_INFO, sha='pushed-sha'))
+        job = self.get_job(job_state, merge_request)
+
+        with patch('marge.single_merge_job.Commit.last_on_branch') as last_on_branch:
+            last_on_branch.return_value.id = 'target-sha'
+            state = job.resumable_push()
+            assert (state.target_sha, state.pushed_sha) == ('target-sha', 'pushed-sha')
+            last_on_branch.assert_called_once_with(1234, 'master', None)
+
+            last_on_branch.return_value.id = 'moved-sha'
+            assert job.resumable_push() is None
+        assert job_state.merge_request_state(1234, 54) is None
+
+    def test_forgets_push_overwritten_since(self):
+        job_state = JobStateStore(':memory:')
+        job_state.record_push(1234, 54, 'target-sha', 'pushed-sha')
+        merge_request = MergeRequest(api=None, info=dict(MERGE_REQUEST_INFO, sha='someone-elses'))
+        job = self.get_job(job_state, merge_request)
+
+        with patch('marge.single_merge_job.Commit.last_on_branch') as last_on_branch:
+            assert job.resumable_push() is None
+            last_on_branch.assert_not_called()
+        assert job_state.merge_request_state(1234, 54) is None
+
+    def test_without_job_state(self):
+        merge_request = MergeRequest(api=None, info=dict(MERGE_REQUEST_INFO, sha='pushed-sha'))
+        assert self.get_job(None, merge_request).resumable_push() is None
@@ -1,8 +1,12 @@
 import os.path
 import tempfile
+import threading
 import unittest.mock as mock
 
+import pytest
+
 import marge.git
+import marge.git_pool
 import marge.store
 import marge.user
 
@@ -129,3 +133,39 @@ class TestRepoManager:
 
         # shouldn't fail
         repo_manager.forget_repo(self.new_project(90, 'non/existent'))
+
+    def test_clones_on_the_git_pool(self, git_run):
+        git_pool = marge.git_pool.GitPool(max_workers=1)
+        repo_manager = marge.store.SshRepoManager(
+            user=self.repo_manager.user, root_dir=self.root_dir.name, ssh_key_file='/ssh/key',
+            git_pool=git_pool,
+        )
+        project = self.new_project(1234, 'some/stuff')
+        try:
+            cloned = threading.Event()
+            git_run.side_effect = lambda *args, **kwargs: cloned.wait(5)
+
+            assert not repo_manager.clone_in_background(project)
+            assert not repo_manager.clone_in_background(project)  # already on it
+            cloned.set()
+            repo = repo_manager.repo_for_project(project)
+            assert isinstance(repo, marge.git_pool.PooledRepo)
+            assert repo.remote_url == project.ssh_url_to_repo
+            assert repo_manager.clone_in_background(project)
+            assert git_run.call_count == 3
+
+            repo.fetch('origin')
+            assert git_run.call_count == 4
+        finally:
+            git_pool.close()
+
+    def test_retries_failed_clones(self, git_run):
+        project = self.new_project(1234, 'some/stuff')
+        git_run.side_effect = marge.git.GitError('no route to host')
+        with pytest.raises(marge.git.GitError):
+            self.repo_manager.repo_for_project(project)
+
+        git_run.side_effect = None
+        repo = self.repo_manager.repo_for_project(project)
+        assert repo.remote_url == project.ssh_url_to_repo
+        assert git_run.call_count == 4
@@ -0,0 +1,83 @@
+import json
+import threading
+
+import pytest
+
+from marge import tracing
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+# pylint: disable=attribute-defined-outside-init
+class TestTracer:
+
+    def setup_method(self, _method):
+        self.exporter = ListExporter()
+        self.tracer = tracing.Tracer(self.exporter)
+
+    def test_nested_spans(self):
+        with self.tracer.span('job', project='cool/project') as job:
+            with self.tracer.span('git fetch'):
+                pass
+            job.set_attribute('iid', 5)
+
+        fetch, exported_job = self.exporter.spans
+        assert exported_job is job
+        assert job.parent_id is None
+        assert job.attributes == {'project': 'cool/project', 'iid': 5}
+        assert (fetch.trace_id, fetch.parent_id) == (job.trace_id, job.span_id)
+        assert job.status == fetch.status == 'ok'
+        assert job.duration >= fetch.duration >= 0
+        assert self.tracer.current_span() is None
+
+    def test_error(self):
+        with pytest.raises(KeyError):
+            with self.tracer.span('job'):
+                raise KeyError('foo')
+        [span] = self.exporter.spans
+        assert span.status == 'error'
+        assert span.error == "KeyError: 'foo'"
+
+    def test_attach_across_threads(self):
+        with self.tracer.span('job') as job:
+            def work():
+                with self.tracer.attach(job), self.tracer.span('api call'):
+                    pass
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+
+        api_call, _ = self.exporter.spans
+        assert api_call.parent_id == job.span_id
+
+    def test_off(self):
+        tracer = tracing.Tracer()
+        with tracer.span('job') as span:
+            span.set_attribute('iid', 5)
+            assert tracer.current_span() is None
+
+
+def test_json_lines_exporter(tmpdir):
+    path = str(tmpdir.join('traces.jsonl'))
+    exporter = tracing.JsonLinesExporter(path)
+    tracing.configure(exporter)
+    try:
+        with tracing.span('job', iid=5):
+            tracing.set_attribute('outcome', 'merged')
+    finally:
+        tracing.configure(None)
+        exporter.close()
+
+    with open(path) as trace_file:
+        [line] = trace_file.readlines()
+    span = json.loads(line)
+    assert span['name'] == 'job'
+    assert span['attributes'] == {'iid': 5, 'outcome': 'merged'}
+    assert span['parent_span_id'] is None
+    assert span['end_time'] - span['start_time'] == span['duration']
@@ -1,7 +1,10 @@
-from unittest.mock import ANY, Mock
+import json
+from unittest.mock import ANY, Mock, patch
 
-from marge.gitlab import Api, GET
-from marge.user import User
+import pytest
+
+from marge.gitlab import Api, GET, NotFound
+from marge.user import User, UserCache
 
 
 INFO = {
@@ -46,3 +49,85 @@ class TestProjectWithUser:
         assert user.username == 'john_smith'
         assert user.name == 'John Smith'
         assert user.state == 'active'
+
+
+def _user_info(user_id):
+    return dict(INFO, id=user_id, username='user%s' % user_id)
+
+
+# pylint: disable=attribute-defined-outside-init
+class TestUserCache:
+    def setup_method(self, _method):
+        self.api = Mock(Api)
+        self.api.call = Mock(side_effect=lambda command: _user_info(int(command.endpoint.split('/')[-1])))
+
+    def test_fetches_missing_users_once(self):
+        cache = UserCache(self.api)
+        users = cache.fetch_by_ids([1, 2, 1])
+        assert [user.id for user in users] == [1, 2, 1]
+        assert self.api.call.call_count == 2
+
+        assert cache.fetch_by_id(2).username == 'user2'
+        assert self.api.call.call_count == 2
+
+    def test_entries_expire(self):
+        cache = UserCache(self.api, ttl=60)
+        with patch('marge.user.time.time', return_value=1000):
+            cache.fetch_by_id(1)
+        with patch('marge.user.time.time', return_value=1059):
+            cache.fetch_by_id(1)
+        assert self.api.call.call_count == 1
+        with patch('marge.user.time.time', return_value=1061):
+            cache.fetch_by_id(1)
+        assert self.api.call.call_count == 2
+
+    def test_evicts_least_recently_used(self):
+        cache = UserCache(self.api, max_size=2)
+        cache.fetch_by_ids([1, 2])
+        cache.fetch_by_id(1)
+        cache.fetch_by_id(3)
+        assert self.api.call.call_count == 3
+        cache.fetch_by_ids([1, 3])
+        assert self.api.call.call_count == 3
+        cache.fetch_by_id(2)
+        assert self.api.call.call_count == 4
+
+    def test_invalidates_on_not_found(self, tmpdir):
+        cache_file = str(tmpdir.join('users.json'))
+        cache = UserCache(self.api, ttl=60, cache_file=cache_file)
+        with patch('marge.user.time.time', return_value=1000):
+            cache.fetch_by_ids([1, 2])
+        fetch_user = self.api.call.side_effect
+
+        def fetch_user_but_1(command):
+            if command.endpoint == '/users/1':
+                raise NotFound(404, {'message': '404 User Not Found'})
+            return fetch_user(command)
+
+        self.api.call.side_effect = fetch_user_but_1
+        with patch('marge.user.time.time', return_value=2000):
+            with pytest.raises(NotFound):
+                cache.fetch_by_ids([1, 2])
+            with pytest.raises(NotFound):
+                cache.fetch_by_id(1)
+            assert cache.fetch_by_id(2).id == 2
+        assert self.api.call.call_count == 5
+
+        # the stale entry is gone from the file too
+        with open(cache_file, encoding='utf-8') as saved:
+            assert [info['id'] for _, info in json.load(saved)] == [2]
+
+    def test_persists_to_file(self, tmpdir):
+        cache_file = str(tmpdir.join('users.json'))
+        UserCache(self.api, cache_file=cache_file).fetch_by_ids([1, 2])
+        assert self.api.call.call_count == 2
+
+        restored = UserCache(self.api, cache_file=cache_file)
+        assert [user.username for user in restored.fetch_by_ids([2, 1])] == ['user2', 'user1']
+        assert self.api.call.call_count == 2
+
+    def test_ignores_unreadable_file(self, tmpdir):
+        cache_file = tmpdir.join('users.json')
+        cache_file.write('not json')
+        cache = UserCache(self.api, cache_file=str(cache_file))
+        assert cache.fetch_by_id(1).id == 1